@@ -0,0 +1,273 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from playfair import (_ALPHABET, PlayfairCipher, PlayfairTable, countRange, createTable,
+                      disableInstrumentation, enableInstrumentation, instrumentationSnapshot, normaliseText,
+                      playfairRuleFour, playfairRuleOne, playfairRuleThree, playfairRuleTwo, readChunks,
+                      readRange, splitString)
+
+# The index of each letter of createTable()'s q-less alphabet, by byte value
+_INDEXES = np.full(256, 255, dtype=np.uint8)
+_INDEXES[np.frombuffer(_ALPHABET.encode('ascii'), dtype=np.uint8)] = np.arange(25)
+
+# Names of the rules, in the order of the instrumentation counters
+_RULE_NAMES = tuple(rule.__name__ for rule in (playfairRuleOne, playfairRuleTwo, playfairRuleThree,
+                                               playfairRuleFour))
+
+class BigramStats:
+    '''
+    Running bigram and letter counts over a stream of text, kept as
+    integer arrays over the q-less alphabet of createTable(): a 25x25
+    matrix of pair counts (first letter by row, second by column) and 25
+    letter counts, both in alphabet order.  Text is filtered the way
+    splitString() filters it and cut into the same non-overlapping
+    pairs, so on ciphertext the pairs are exactly the ones the cipher
+    produced.  A letter left without a partner at the end of one update
+    is paired with the first letter of the next.
+
+    Counts are added up with np.bincount() per chunk, so no per-pair
+    strings are made.  Partial results can be combined with merge().
+
+    Letters outside ASCII are dropped.
+    '''
+    def __init__(self):
+        self.bigrams = np.zeros((25, 25), dtype=np.int64)
+        self.letters = np.zeros(25, dtype=np.int64)
+        self.pending = None
+
+    @property
+    def pairs(self):
+        '''
+        Number of pairs counted so far.
+        '''
+        return int(self.bigrams.sum())
+
+    def update(self, text):
+        '''
+        Counts the letters and pairs of the next piece of text.
+
+        Input:   string or bytes:  text
+        Output:  BigramStats:      self
+        '''
+        indexes = _INDEXES[np.frombuffer(normaliseText(text, 'drop'), dtype=np.uint8)]
+        if not indexes.size:
+            return self
+        self.letters += np.bincount(indexes, minlength=25)
+
+        # Finishes the pair left open by the last piece
+        if self.pending is not None:
+            self.bigrams[self.pending, indexes[0]] += 1
+            indexes = indexes[1:]
+            self.pending = None
+        if len(indexes) % 2:
+            self.pending = int(indexes[-1])
+            indexes = indexes[:-1]
+
+        codes = indexes[0::2].astype(np.intp) * 25 + indexes[1::2]
+        self.bigrams += np.bincount(codes, minlength=625).reshape(25, 25)
+        return self
+
+    def updateStream(self, source, chunkSize=1 << 20):
+        '''
+        Counts everything read from a file object or an iterable of
+        pieces of text, one chunk at a time.
+
+        Input:   file or iterable:  text source
+        Input:   int:               characters read at a time
+        Output:  BigramStats:       self
+        '''
+        for chunk in readChunks(source, chunkSize):
+            self.update(chunk)
+        return self
+
+    def merge(self, other):
+        '''
+        Adds the counts of another BigramStats that covered the text
+        right after this one, and takes over its unpaired letter.  This
+        one must not have an unpaired letter of its own, since the other
+        already paired its first letter; pieces cut after an even number
+        of letters, as ciphertext always is, merge exactly.
+
+        Input:   BigramStats:  later partial result
+        Output:  BigramStats:  self
+        '''
+        if self.pending is not None and other.letters.any():
+            raise ValueError("can only merge after a piece with an even number of letters")
+        self.bigrams += other.bigrams
+        self.letters += other.letters
+        if other.pending is not None:
+            self.pending = other.pending
+        return self
+
+    def indexOfCoincidence(self):
+        '''
+        Returns the chance that two letters picked at random are the same.
+        English plaintext is near 0.066 and uniform text near 0.04
+        (1 in 25).
+
+        Output:  float:  index of coincidence (0.0 for fewer than two letters)
+        '''
+        total = int(self.letters.sum())
+        if total < 2:
+            return 0.0
+        return float((self.letters * (self.letters - 1)).sum()) / (total * (total - 1))
+
+    def ruleFractions(self, table, ciphertext=False):
+        '''
+        Returns the fraction of pairs that go through each rule with the
+        given table.  On plaintext playfairRuleOne() counts doubled
+        letters, on top of exactly one of the other three rules.  On
+        ciphertext the row, column or rectangle of a pair is the same as
+        for the plaintext pair it came from, but doubled letters can't be
+        seen, so playfairRuleOne() is left out.
+
+        Input:   list of lists or PlayfairTable:  ciphertable
+        Input:   bool:  True when the counts are of ciphertext
+        Output:  dict:  fraction of pairs for each rule name
+        '''
+        codes = _ruleCodeMatrix(PlayfairTable.fromList(table))
+        counts = np.bincount(codes.ravel(), weights=self.bigrams.ravel(), minlength=6)
+        pairs = counts.sum() or 1
+        fractions = {
+            _RULE_NAMES[1 + rule]: float(counts[rule] + counts[rule + 3]) / pairs for rule in range(3)
+        }
+        if not ciphertext:
+            fractions[_RULE_NAMES[0]] = float(counts[3:].sum()) / pairs
+        return fractions
+
+    def summary(self, table=None, ciphertext=False):
+        '''
+        Returns the main numbers as a plain dict, ready for JSON.
+
+        Input:   list of lists or PlayfairTable:  ciphertable for rule fractions (optional)
+        Input:   bool:  True when the counts are of ciphertext
+        Output:  dict:  letters, pairs, letter counts, index of coincidence and rules
+        '''
+        result = {
+            'letters': int(self.letters.sum()),
+            'pairs': self.pairs,
+            'letterCounts': dict(zip(_ALPHABET, self.letters.tolist())),
+            'indexOfCoincidence': self.indexOfCoincidence(),
+        }
+        if table is not None:
+            result['rules'] = self.ruleFractions(table, ciphertext)
+        return result
+
+def _ruleCodeMatrix(table):
+    '''
+    Gathers the rule codes a compiled cipher keeps for every pair of a
+    table, in alphabet order.  Codes 0 to 2 are rules two to four, and
+    3 to 5 the same after playfairRuleOne() substituted a letter.
+
+    Input:   PlayfairTable:  ciphertable
+    Output:  numpy array:    25x25 rule codes
+    '''
+    ruleCodes = PlayfairCipher(table).ruleCodes
+    return np.array([[ruleCodes[first + second] for second in _ALPHABET]
+                     for first in _ALPHABET], dtype=np.intp)
+
+def analyseFileParallel(path, workers=None, chunkSize=1 << 24):
+    '''
+    Counts the bigrams and letters of a large file on several processes.
+    Like encryptFileParallel(), a first pass counts the letters of each
+    byte range so every worker knows whether its first letter finishes
+    a pair from the range before; the partial results are then merged in
+    order, so the counts match one BigramStats.update() over the whole
+    file.
+
+    Input:   string:       path of the file
+    Input:   int:          number of worker processes (default: all CPUs)
+    Input:   int:          bytes of input per work item
+    Output:  BigramStats:  counts for the whole file
+    '''
+    size = os.path.getsize(path)
+    ranges = [(path, start, min(start + chunkSize, size), 'drop') for start in range(0, size, chunkSize)]
+    total = BigramStats()
+
+    with ProcessPoolExecutor(workers) as pool:
+        parities = []
+        letters = 0
+        for _, count in pool.map(countRange, ranges):
+            parities.append(letters % 2)
+            letters += count
+
+        jobs = [item + (parity,) for item, parity in zip(ranges, parities)]
+        for lead, partial in pool.map(_analyseRange, jobs):
+            total.update(lead)
+            total.merge(partial)
+    return total
+
+def _analyseRange(job):
+    '''
+    Counts one byte range, handing back the first letter on its own when
+    it belongs to a pair opened in an earlier range.
+
+    Input:   tuple:  (path, start, end, policy, parity of letters before start)
+    Output:  tuple:  (leading letter, BigramStats)
+    '''
+    path, start, end, nonAscii, parity = job
+    _, filtered = readRange(path, start, end, nonAscii)
+    return filtered[:parity], BigramStats().update(filtered[parity:])
+
+###############################################################
+
+# Below are the tests for BigramStats
+def test_BigramStats_matchesSplitString():
+    # Tests the counts against splitString() on text fed in odd pieces
+    text = "Quiet, odd text! aa xx 1234 bookkeeper. Q q Q" * 7
+    stats = BigramStats().updateStream(text[i:i+5] for i in range(0, len(text), 5))
+    pairs = splitString(text)
+    if len(''.join(pairs).rstrip('x')) % 2:
+        pairs = pairs[:-1]
+    for first, second in (('b', 'o'), ('o', 'k'), ('a', 'a'), ('x', 'x')):
+        expected = pairs.count(first + second)
+        assert stats.bigrams[_ALPHABET.index(first), _ALPHABET.index(second)] == expected, f"Wrong count of '{first}{second}'."
+    assert stats.letters.sum() == len(normaliseText(text)), "Wrong number of letters."
+    assert stats.pairs == len(normaliseText(text)) // 2, "Wrong number of pairs."
+    pass
+
+def test_BigramStats_ruleFractions():
+    # Tests the rule fractions against the instrumentation counters
+    phrase = "i am entering a pass phrase"
+    message = "enivfmaa" * 3 + "hello there bookkeeper"
+    cipher = PlayfairCipher(createTable(phrase))
+    enableInstrumentation()
+    try:
+        cipher.encryptBatch(message)
+        snapshot = instrumentationSnapshot()
+    finally:
+        disableInstrumentation()
+    plain = BigramStats().update(normaliseText(message) + b'x' * (len(normaliseText(message)) % 2))
+    fractions = plain.ruleFractions(createTable(phrase))
+    for name, count in snapshot['rules'].items():
+        assert abs(fractions[name] - count / snapshot['pairs']) < 1e-9, f"Wrong fraction for {name}."
+    cipherFractions = BigramStats().update(cipher.encryptBatch(message)).ruleFractions(cipher.table, ciphertext=True)
+    for name in _RULE_NAMES[1:]:
+        assert abs(cipherFractions[name] - fractions[name]) < 1e-9, f"Ciphertext should keep the shape for {name}."
+    assert abs(sum(cipherFractions.values()) - 1) < 1e-9, "Fractions should add up to one."
+    pass
+
+def test_BigramStats_mergeAndCoincidence():
+    # Tests merging even pieces, the parallel file path, and the index of coincidence
+    text = "the quick brown fox jumps over the lazy dog " * 40
+    whole = BigramStats().update(text)
+    filtered = normaliseText(text)
+    merged = BigramStats().update(filtered[:100]).merge(BigramStats().update(filtered[100:]))
+    assert (merged.bigrams == whole.bigrams).all() and (merged.letters == whole.letters).all(), "Merge differs."
+    try:
+        BigramStats().update("abc").merge(BigramStats().update("de"))
+        assert False, "Merging after an odd piece should fail."
+    except ValueError:
+        pass
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "text.txt")
+        with open(path, 'w') as outfile:
+            outfile.write(text)
+        parallel = analyseFileParallel(path, workers=2, chunkSize=37)
+    assert (parallel.bigrams == whole.bigrams).all() and parallel.pending == whole.pending, "Parallel counts differ."
+    assert BigramStats().update(_ALPHABET * 40).indexOfCoincidence() < whole.indexOfCoincidence(), "IoC should rise with English."
+    assert abs(BigramStats().update("aabb").indexOfCoincidence() - 4 / 12) < 1e-9, "Wrong index of coincidence."
+    pass
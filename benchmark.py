@@ -0,0 +1,550 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from string import ascii_lowercase
+
+import playfair
+from playfair import (KeyRing, PlayfairCipher, SharedMemoryPool, createTable, disableInstrumentation,
+                      enableInstrumentation, encrypt, encryptFileParallel, encryptMany,
+                      joinPairs, playfairRuleFour, playfairRuleOne, playfairRuleThree,
+                      playfairRuleTwo, splitString)
+
+# Multipliers for the size suffixes accepted by parseSize()
+_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+def makeMessage(size, seed=0):
+    '''
+    Builds a repeatable block of plaintext of roughly the given size in
+    bytes, made of lowercase words, capitals, spaces and punctuation so
+    that the filtering rules have something to do.
+
+    Input:   int:     size of the message in bytes
+    Input:   int:     random seed
+    Output:  string:  plaintext
+    '''
+    rng = random.Random(seed)
+    words = [''.join(rng.choice(ascii_lowercase) for _ in range(rng.randint(1, 9)))
+             for _ in range(500)]
+    words += ["The", "Quiet", "Quail,", "42", "odd!"]
+    block = ' '.join(rng.choice(words) for _ in range(2000)) + ' '
+    return (block * (size // len(block) + 1))[:size]
+
+def messageChunks(size, block):
+    '''
+    Yields size bytes of plaintext by repeating a block, such as one from
+    makeMessage(), so the streaming pipeline can be timed on inputs far
+    bigger than memory.
+
+    Input:   int:        total size in bytes
+    Input:   string:     block of plaintext to repeat
+    Output:  generator:  pieces of plaintext
+    '''
+    sent = 0
+    while sent < size:
+        piece = block[:size - sent]
+        yield piece
+        sent += len(piece)
+
+def parseSize(text):
+    '''
+    Turns a size such as "1K", "64M" or "1G" into bytes (powers of 1024).
+
+    Input:   string:  size with an optional K, M or G suffix
+    Output:  int:     size in bytes
+    '''
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in _UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * _UNITS[unit])
+
+def formatSize(size):
+    '''
+    Turns a size in bytes into a short label such as "1K" or "64M".
+
+    Input:   int:     size in bytes
+    Output:  string:  label
+    '''
+    for unit in ('G', 'M', 'K'):
+        if size >= _UNITS[unit] and size % _UNITS[unit] == 0:
+            return f"{size // _UNITS[unit]}{unit}"
+    return str(size)
+
+def throughput(function, message, repeats=3):
+    '''
+    Runs a function on a message a few times and returns the best speed
+    in megabytes of plaintext per second.
+
+    Input:   function:  takes the message as its only argument
+    Input:   string:    plaintext
+    Input:   int:       number of runs
+    Output:  float:     MB/s
+    '''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(message)
+        best = min(best, time.perf_counter() - start)
+    return len(message) / best / 1e6
+
+def measure(function, nbytes=0, ops=1, minTime=0.2, memory=True):
+    '''
+    Times a function that takes no arguments.  It is run until minTime
+    has passed (at least once) and the fastest run is kept.  The peak
+    memory it allocates is then measured on one more run with
+    tracemalloc, so tracing does not slow down the timed runs.
+
+    Input:   function:  the work to time
+    Input:   int:       bytes handled by one call
+    Input:   int:       operations done by one call
+    Input:   float:     seconds to keep repeating for
+    Input:   bool:      measure peak memory as well
+    Output:  dict:      ops_per_sec, bytes_per_sec, peak_bytes and seconds
+    '''
+    best = float('inf')
+    deadline = time.perf_counter() + minTime
+    while True:
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+        if time.perf_counter() >= deadline:
+            break
+
+    peak = 0
+    if memory:
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    best = max(best, 1e-9)
+    return {'ops_per_sec': ops / best, 'bytes_per_sec': nbytes / best,
+            'peak_bytes': peak, 'seconds': best}
+
+def runSuite(sizes=(1 << 10, 1 << 16, 1 << 20), keyCounts=(1, 100), minTime=0.2,
+             referenceLimit=1 << 20, inMemoryLimit=1 << 26, phrase="i am entering a pass phrase"):
+    '''
+    Times every stage of the pipeline -- createTable, splitString, the
+    four rules, encrypt and joinPairs -- and the end-to-end pipelines at
+    each message size and key count.  The slow reference pipeline is
+    only run up to referenceLimit bytes, and above inMemoryLimit only the
+    streaming pipeline is run, fed from messageChunks(), so sizes up to
+    1G don't need the whole message in memory.
+
+    Input:   list:    message sizes in bytes
+    Input:   list:    numbers of distinct keys
+    Input:   float:   seconds to repeat each measurement for
+    Input:   int:     largest size for the reference pipeline
+    Input:   int:     largest size for the in-memory pipelines
+    Input:   string:  passphrase
+    Output:  dict:    measurement for each benchmark name
+    '''
+    table = createTable(phrase)
+    cipher = PlayfairCipher(table)
+    pairs = list(cipher.bigrams)
+    results = {}
+
+    def record(name, result):
+        results[name] = result
+        print(f"{name:<32} {result['ops_per_sec']:14.1f} ops/s {result['bytes_per_sec'] / 1e6:10.2f} MB/s "
+              f"{result['peak_bytes'] / 1024:10.1f} KiB peak")
+
+    # Rule stages, over all 625 bigrams of one table
+    record("playfairRuleOne/625pairs",
+           measure(lambda: [playfairRuleOne(pair) for pair in pairs], 1250, 625, minTime))
+    for rule in (playfairRuleTwo, playfairRuleThree, playfairRuleFour, encrypt):
+        record(f"{rule.__name__}/625pairs",
+               measure(lambda rule=rule: [rule(pair, table) for pair in pairs], 1250, 625, minTime))
+
+    # Table stages, once per distinct key
+    for keyCount in keyCounts:
+        phrases = [f"{phrase} {i}" for i in range(keyCount)]
+        record(f"createTable/{keyCount}keys",
+               measure(lambda: [createTable(p) for p in phrases], 0, keyCount, minTime))
+        record(f"PlayfairCipher/{keyCount}keys",
+               measure(lambda: [PlayfairCipher(createTable(p)) for p in phrases], 0, keyCount, minTime))
+        records = [(phrases[i % keyCount], makeMessage(1 << 10, i)) for i in range(max(64, keyCount * 4))]
+        record(f"encryptMany/{keyCount}keys",
+               measure(lambda: list(encryptMany(records, workers=1)),
+                       sum(len(message) for _, message in records), len(records), minTime))
+
+    for size in sizes:
+        label = formatSize(size)
+        block = makeMessage(min(size, 1 << 20))
+        record(f"encryptStream/{label}",
+               measure(lambda: sum(len(piece) for piece in cipher.encryptStream(messageChunks(size, block))),
+                       size, 1, minTime))
+        if size > inMemoryLimit:
+            continue
+
+        message = makeMessage(size)
+        bigrams = splitString(message)
+        encrypted = cipher.encryptPairs(bigrams)
+        record(f"splitString/{label}", measure(lambda: splitString(message), size, len(bigrams), minTime))
+        record(f"joinPairs/{label}", measure(lambda: joinPairs(encrypted), size, len(encrypted), minTime))
+        record(f"encryptMessage/{label}", measure(lambda: cipher.encryptMessage(message), size, 1, minTime))
+        record(f"encryptBatch/{label}", measure(lambda: cipher.encryptBatch(message), size, 1, minTime))
+        if size <= referenceLimit:
+            record(f"pipeline/{label}",
+                   measure(lambda: joinPairs([encrypt(pair, table) for pair in splitString(message)]),
+                           size, 1, minTime))
+        del message, bigrams, encrypted
+
+    return results
+
+def saveBaseline(results, path):
+    '''
+    Writes suite results to a JSON baseline file.
+
+    Input:   dict:    results from runSuite()
+    Input:   string:  path of the baseline file
+    '''
+    with open(path, 'w') as outfile:
+        json.dump({'python': sys.version.split()[0], 'results': results}, outfile, indent=2, sort_keys=True)
+
+def loadBaseline(path):
+    '''
+    Reads suite results back from a JSON baseline file.
+
+    Input:   string:  path of the baseline file
+    Output:  dict:    results as saved by saveBaseline()
+    '''
+    with open(path) as infile:
+        return json.load(infile)['results']
+
+def compareResults(baseline, current, threshold=0.10, memorySlack=64 << 10):
+    '''
+    Finds the benchmarks that got worse than the baseline by more than
+    threshold: fewer ops/sec, or a higher memory peak (ignoring growth
+    under memorySlack bytes, which is just noise).  Benchmarks missing
+    from either side are skipped.
+
+    Input:   dict:   baseline results
+    Input:   dict:   current results
+    Input:   float:  allowed fraction of slowdown or extra memory
+    Input:   int:    memory growth in bytes that never counts
+    Output:  list:   (name, metric, baseline value, current value) regressions
+    '''
+    regressions = []
+    for name in sorted(set(baseline) & set(current)):
+        old, new = baseline[name], current[name]
+        if new['ops_per_sec'] < old['ops_per_sec'] * (1 - threshold):
+            regressions.append((name, 'ops_per_sec', old['ops_per_sec'], new['ops_per_sec']))
+        if (new['peak_bytes'] > old['peak_bytes'] * (1 + threshold)
+                and new['peak_bytes'] - old['peak_bytes'] > memorySlack):
+            regressions.append((name, 'peak_bytes', old['peak_bytes'], new['peak_bytes']))
+    return regressions
+
+def benchmarkEncrypt(size=1000000, phrase="i am entering a pass phrase"):
+    '''
+    Prints the throughput of the reference rule pipeline, the compiled
+    lookup table and the NumPy batch path on the same message.
+
+    Input:   int:     size of the message in bytes
+    Input:   string:  passphrase
+    Output:  dict:    MB/s for each path
+    '''
+    table = createTable(phrase)
+    cipher = PlayfairCipher(table)
+    message = makeMessage(size)
+
+    def reference(text):
+        return joinPairs([encrypt(pair, table) for pair in splitString(text)])
+
+    results = {
+        'encrypt': throughput(reference, message, repeats=1),
+        'encryptMessage': throughput(cipher.encryptMessage, message),
+        'encryptBatch': throughput(cipher.encryptBatch, message),
+    }
+    for name, speed in results.items():
+        print(f"{name:>16}: {speed:8.2f} MB/s")
+    return results
+
+def benchmarkParallel(size=64000000, workerCounts=None, chunkSize=1 << 22,
+                      phrase="i am entering a pass phrase"):
+    '''
+    Prints the speedup curve of encryptFileParallel() against the number
+    of worker processes, measured against the sequential encryptFile().
+
+    Input:   int:     size of the test file in bytes
+    Input:   list:    worker counts to try (default: 1 up to all CPUs)
+    Input:   int:     bytes of input per work item
+    Input:   string:  passphrase
+    Output:  dict:    speedup for each worker count
+    '''
+    table = createTable(phrase)
+    cipher = PlayfairCipher(table)
+    if workerCounts is None:
+        workerCounts = range(1, (os.cpu_count() or 1) + 1)
+
+    with tempfile.TemporaryDirectory() as folder:
+        inPath = os.path.join(folder, "plain.txt")
+        outPath = os.path.join(folder, "cipher.txt")
+        with open(inPath, 'w') as infile:
+            infile.write(makeMessage(size))
+
+        start = time.perf_counter()
+        with open(inPath) as infile, open(outPath, 'w') as outfile:
+            cipher.encryptFile(infile, outfile, chunkSize)
+        sequential = time.perf_counter() - start
+        print(f"  sequential: {size / sequential / 1e6:8.2f} MB/s")
+
+        speedups = {}
+        for workers in workerCounts:
+            start = time.perf_counter()
+            encryptFileParallel(inPath, outPath, table, workers, chunkSize)
+            elapsed = time.perf_counter() - start
+            speedups[workers] = sequential / elapsed
+            print(f"{workers:4d} workers: {size / elapsed / 1e6:8.2f} MB/s  speedup {speedups[workers]:5.2f}x")
+    return speedups
+
+def benchmarkSharedMemory(size=64000000, workers=None, chunkSize=1 << 22, referenceSize=1 << 20,
+                          phrase="i am entering a pass phrase"):
+    '''
+    Prints the throughput of SharedMemoryPool on an in-memory message,
+    next to the same message cut into chunks and sent through
+    encryptMany() on processes (which pickles every chunk and its
+    ciphertext), encryptBatch() on one process, and the reference
+    encrypt() loop.  The reference loop is slow, so it only gets a
+    referenceSize sample.
+
+    Input:   int:     size of the message in bytes
+    Input:   int:     number of worker processes (default: all CPUs)
+    Input:   int:     letters per work item
+    Input:   int:     size of the sample for the reference loop
+    Input:   string:  passphrase
+    Output:  dict:    MB/s for each path
+    '''
+    table = createTable(phrase)
+    cipher = PlayfairCipher(table)
+    message = makeMessage(size)
+
+    def reference(text):
+        return joinPairs([encrypt(pair, table) for pair in splitString(text)])
+
+    def pickled(text):
+        chunks = [text[i:i + chunkSize] for i in range(0, len(text), chunkSize)]
+        return ''.join(encryptMany(((phrase, chunk) for chunk in chunks), workers, processes=True))
+
+    results = {
+        'encrypt': throughput(reference, message[:referenceSize], repeats=1),
+        'encryptBatch': throughput(cipher.encryptBatch, message),
+        'pickled': throughput(pickled, message),
+    }
+    with SharedMemoryPool(table, workers, chunkSize) as pool:
+        # Warms the workers up so their start-up is not counted
+        pool.encrypt(message[:chunkSize])
+        results['sharedMemory'] = throughput(pool.encrypt, message)
+    for name, speed in results.items():
+        print(f"{name:>16}: {speed:8.2f} MB/s")
+    return results
+
+def benchmarkKeyRing(keys=20000, lookups=2000, seed=0):
+    '''
+    Prints how long it takes to import keys into a KeyRing and to open
+    it, and the latency of table and cipher lookups from it, next to
+    building the same ciphers from their passphrases.
+
+    Input:   int:   number of keys in the keyring
+    Input:   int:   number of random lookups to time
+    Input:   int:   random seed
+    Output:  dict:  seconds for import and open, and p50/p99 latencies
+    '''
+    rng = random.Random(seed)
+    phrases = {f"tenant-{i}": ''.join(rng.choice(ascii_lowercase) for _ in range(12)) for i in range(keys)}
+    sample = rng.choices(list(phrases), k=lookups)
+
+    def latencies(function):
+        times = []
+        for keyId in sample:
+            start = time.perf_counter()
+            function(keyId)
+            times.append(time.perf_counter() - start)
+        times.sort()
+        return times[len(times) // 2], times[min(len(times) - 1, int(0.99 * len(times)))]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "keys.ring")
+        start = time.perf_counter()
+        KeyRing.write(path, phrases.items())
+        results['import'] = time.perf_counter() - start
+        start = time.perf_counter()
+        ring = KeyRing(path)
+        results['open'] = time.perf_counter() - start
+        with ring:
+            results['table'] = latencies(ring.table)
+            results['cipher'] = latencies(ring.cipher)
+        results['createTable'] = latencies(lambda keyId: PlayfairCipher(createTable(phrases[keyId])))
+
+    print(f"{'import':>16}: {results['import']:8.3f} s for {keys} keys")
+    print(f"{'open':>16}: {results['open'] * 1e6:8.1f} us")
+    for name in ('table', 'cipher', 'createTable'):
+        p50, p99 = results[name]
+        print(f"{name:>16}: p50 {p50 * 1e6:8.1f} us  p99 {p99 * 1e6:8.1f} us")
+    return results
+
+def benchmarkInstrumentation(size=1 << 20, minTime=0.5, phrase="i am entering a pass phrase", threshold=0.10):
+    '''
+    Times the reference pipeline, encrypt() pair by pair,
+    encryptMessage() and the batch path with instrumentation never
+    turned on, turned on, and turned off again, and prints MB/s for
+    each.  While it is off the module functions and cipher methods are
+    the plain ones, with no check for instrumentation left in them, which
+    is asserted before the "off" and "off again" runs; those runs are
+    then checked against each other with compareResults(), so anything
+    instrumentation leaves behind once it is off shows up as a
+    regression.  The results are named like the suite's, e.g.
+    "encryptBatch/off", so they can be saved and compared as a baseline.
+
+    Input:   int:     size of the message in bytes
+    Input:   float:   seconds to repeat each measurement for
+    Input:   string:  passphrase
+    Input:   float:   allowed fraction of slowdown once turned off again
+    Output:  tuple:   (measurement for each name, list of regressions)
+    '''
+    cipher = PlayfairCipher(createTable(phrase))
+    message = makeMessage(size)
+    small = message[:size // 64]
+    pairs = playfair.splitString(small)
+
+    def reference():
+        # Looks the functions up on the module, as wrapping replaces them there
+        table = playfair.createTable(phrase)
+        return playfair.joinPairs([playfair.encrypt(pair, table) for pair in playfair.splitString(small)])
+
+    paths = {'reference': (reference, len(small)),
+             'encrypt': (lambda: [cipher.encrypt(pair) for pair in pairs], len(small)),
+             'encryptMessage': (lambda: cipher.encryptMessage(small), len(small)),
+             'encryptBatch': (lambda: cipher.encryptBatch(message), size)}
+    states = ('off', 'on', 'off-again')
+    results = {}
+    for state in states:
+        if state == 'on':
+            enableInstrumentation()
+        else:
+            assert not any(hasattr(function, '__wrapped__') for function in
+                           (playfair.encrypt, PlayfairCipher.encrypt, PlayfairCipher.encryptPairs,
+                            PlayfairCipher._lookup)), "Instrumentation should leave nothing behind when off."
+        for name, (function, nbytes) in paths.items():
+            results[f"{name}/{state}"] = measure(function, nbytes, 1, minTime, memory=False)
+        if state == 'on':
+            disableInstrumentation()
+
+    assert playfair.encrypt is encrypt, "Turning instrumentation off should restore encrypt()."
+    print(f"{'':>14} " + ' '.join(f"{state:>10}" for state in states) + "   MB/s")
+    for name in paths:
+        print(f"{name:>14} " + ' '.join(f"{results[f'{name}/{state}']['bytes_per_sec'] / 1e6:10.2f}"
+                                        for state in states))
+
+    regressions = compareResults({name: results[f"{name}/off"] for name in paths},
+                                 {name: results[f"{name}/off-again"] for name in paths}, threshold)
+    for name, metric, old, new in regressions:
+        print(f"REGRESSION {name} {metric} after turning off: {old:.1f} -> {new:.1f}")
+    return results, regressions
+
+def main(argv=None):
+    '''
+    Runs the benchmarks from the command line.  "suite" (the default)
+    and "instrumentation" can save a JSON baseline or compare against
+    one, exiting with status 1 when something regressed;
+    "instrumentation" also fails when turning it off again left any
+    slowdown behind.
+
+    Input:   list:  command-line arguments (default: sys.argv[1:])
+    Output:  int:   exit status
+    '''
+    parser = argparse.ArgumentParser(description="Playfair benchmarks")
+    parser.add_argument('benchmark', nargs='?', default='suite',
+                        choices=['suite', 'encrypt', 'parallel', 'shared', 'keyring', 'instrumentation'])
+    parser.add_argument('--sizes', default='1K,64K,1M',
+                        help="comma-separated message sizes, e.g. 1K,1M,1G")
+    parser.add_argument('--keys', default='1,100', help="comma-separated key counts")
+    parser.add_argument('--min-time', type=float, default=0.2, help="seconds per measurement")
+    parser.add_argument('--save', help="write the results to this JSON baseline")
+    parser.add_argument('--compare', help="compare the results with this JSON baseline")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="fraction of slowdown or extra memory that counts as a regression")
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'encrypt':
+        benchmarkEncrypt()
+        return 0
+    if args.benchmark == 'parallel':
+        benchmarkParallel()
+        return 0
+    if args.benchmark == 'shared':
+        benchmarkSharedMemory()
+        return 0
+    if args.benchmark == 'keyring':
+        benchmarkKeyRing()
+        return 0
+
+    regressions = []
+    if args.benchmark == 'instrumentation':
+        # Checks "off again" against "off" first, then against any baseline
+        results, regressions = benchmarkInstrumentation(threshold=args.threshold)
+    else:
+        results = runSuite([parseSize(size) for size in args.sizes.split(',')],
+                           [int(count) for count in args.keys.split(',')], args.min_time)
+    if args.save:
+        saveBaseline(results, args.save)
+    if args.compare:
+        against = compareResults(loadBaseline(args.compare), results, args.threshold)
+        for name, metric, old, new in against:
+            print(f"REGRESSION {name} {metric}: {old:.1f} -> {new:.1f}")
+        regressions += against
+    if regressions:
+        return 1
+    if args.compare or args.benchmark == 'instrumentation':
+        print("No regressions")
+    return 0
+
+###############################################################
+
+# Below are the tests for the benchmark helpers
+def test_parseSize():
+    # Tests the size suffixes and their labels
+    assert parseSize("1K") == 1024, "Failed on kilobytes."
+    assert parseSize("64m") == 64 << 20, "Failed on lowercase megabytes."
+    assert parseSize("1GB") == 1 << 30, "Failed on gigabytes with a B."
+    assert formatSize(1 << 30) == "1G" and formatSize(1000) == "1000", "Failed on labels."
+    pass
+
+def test_messageChunks():
+    # Tests that the pieces add up to the asked size
+    pieces = list(messageChunks(2500, makeMessage(1000)))
+    assert [len(piece) for piece in pieces] == [1000, 1000, 500], "Failed to cut the message into pieces."
+    pass
+
+def test_compareResults():
+    # Tests that only changes past the threshold count
+    baseline = {'a': {'ops_per_sec': 100.0, 'peak_bytes': 1 << 20},
+                'b': {'ops_per_sec': 100.0, 'peak_bytes': 0}}
+    current = {'a': {'ops_per_sec': 95.0, 'peak_bytes': 2 << 20},
+               'b': {'ops_per_sec': 80.0, 'peak_bytes': 1000},
+               'c': {'ops_per_sec': 1.0, 'peak_bytes': 0}}
+    expected = [('a', 'peak_bytes', 1 << 20, 2 << 20), ('b', 'ops_per_sec', 100.0, 80.0)]
+    assert compareResults(baseline, current, 0.10) == expected, "Failed to find regressions."
+    pass
+
+def test_benchmarkInstrumentation():
+    # Tests that every path is measured in every state and checked after turning off
+    with contextlib.redirect_stdout(io.StringIO()):
+        results, regressions = benchmarkInstrumentation(size=1 << 12, minTime=0.01, threshold=1.0)
+    names = {f"{name}/{state}" for name in ('reference', 'encrypt', 'encryptMessage', 'encryptBatch')
+             for state in ('off', 'on', 'off-again')}
+    assert set(results) == names, "Failed to measure every path in every state."
+    assert regressions == [], "Nothing can slow down by more than 100%."
+    assert playfair.instrumentationSnapshot() is None, "Instrumentation should be off afterwards."
+    pass
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,669 @@
+import argparse
+import functools
+import io
+import os
+import random
+import tempfile
+import time
+import unicodedata
+
+from pipeline import FieldPipeline
+from playfair import (_ALPHABET, KeyRing, OffsetIndex, PlayfairCascade, PlayfairCipher, PlayfairTable,
+                      PlayfairVariant, PlayfairVariantCipher, SharedMemoryPool, TableCache, _compileBigrams, decrypt,
+                      decryptFileParallel, decryptFileRange, encrypt, encryptFileParallel, encryptMany, joinPairs,
+                      normaliseText, playfairRuleOne, splitString)
+
+# Every bigram over the table letters, in alphabet order
+_PAIRS = [first + second for first in _ALPHABET for second in _ALPHABET]
+
+# Characters the fuzzer builds messages from: letters with extra q and x,
+# doubled letters, padding, and non-ASCII letters, some of which (the
+# Kelvin sign, dotted capital I) lowercase to ASCII letters
+_FUZZ_PIECES = list(_ALPHABET) + list(_ALPHABET.upper()) + ['q', 'Q', 'qq', 'x', 'xx', 'X', 'ee', 'll'] * 4 + \
+               [' ', ', ', '.', '!', '7', '42', '\n', '\t', '-'] * 2
+_FOREIGN_PIECES = ['é', 'ß', 'ü', 'Ａ', 'ａ', 'ǅ', 'ñ', 'ø', 'Ж', 'λ', 'K', 'İ', 'é', '😀', ' ']
+
+# The table variants checked on top of the default table, which is
+# checked again through PlayfairVariantCipher
+_VARIANTS = [PlayfairVariant(), PlayfairVariant.classic(), PlayfairVariant.alphanumeric()]
+
+def referenceSplit(text):
+    '''
+    The original splitString(): lowercases, keeps letters that are not
+    q, and pads an odd result with 'x'.  It skips the ASCII fast path
+    of splitString(), so that path is checked against it too.
+
+    Input:   string:  plaintext
+    Output:  list:    bigrams
+    '''
+    filtered = ''.join(filter(lambda x: x.isalpha() and x != 'q', text.lower()))
+    if len(filtered) % 2 != 0:
+        filtered += 'x'
+    return [filtered[i:i+2] for i in range(0, len(filtered), 2)]
+
+def referenceFilter(text, nonAscii):
+    '''
+    The filter of the original splitString() with the 'drop' or 'fold'
+    policy of normaliseText(), one character at a time and without its
+    byte tables: lowercases, then for 'fold' splits every character into
+    the ones it is built on with unicodedata and lowercases those again,
+    and keeps the ASCII letters that are not q.
+
+    Input:   string:  plaintext
+    Input:   string:  'drop' or 'fold'
+    Output:  string:  filtered plaintext
+    '''
+    kept = []
+    for char in text.lower():
+        parts = unicodedata.normalize('NFKD', char).lower() if nonAscii == 'fold' else char
+        kept += [part for part in parts if part.isascii() and part.isalpha() and part != 'q']
+    return ''.join(kept)
+
+def referenceVariantSplit(variant, text):
+    '''
+    splitString() for a table variant, one character at a time:
+    lowercases, reads merged letters as their targets, keeps the letters
+    of the variant and pads an odd result with its padding letter.
+    Letters outside ASCII are kept, as the original splitString() keeps
+    them, so they show up as pairs the table can't encrypt.
+
+    Input:   PlayfairVariant:  variant of the table
+    Input:   string:           plaintext
+    Output:  list:             bigrams
+    '''
+    merged = {source.lower(): target for source, target in variant.merged.items()}
+    filtered = ''.join(char for char in (merged.get(char, char) for char in text.lower())
+                       if char in variant.alphabet or (char.isalpha() and not char.isascii()))
+    if len(filtered) % 2 != 0:
+        filtered += variant.padding
+    return [filtered[i:i+2] for i in range(0, len(filtered), 2)]
+
+def adversarialTables():
+    '''
+    Yields tables that put the quirks of the rules at the edges of the
+    grid: the alphabet in order and reversed, and for every cell, 'x'
+    there with 'z' right after it in the same row, right below it in
+    the same column (both wrapping), and on the far corner of a
+    rectangle.  'xx' becomes 'xz' through playfairRuleOne(), so these
+    send it through every rule at every edge.
+
+    Output:  generator:  25-letter table strings, row by row
+    '''
+    yield _ALPHABET
+    yield _ALPHABET[::-1]
+    others = [char for char in _ALPHABET if char not in 'xz']
+    for cell in range(25):
+        row, column = divmod(cell, 5)
+        for partner in (row * 5 + (column + 1) % 5, (row + 1) % 5 * 5 + column,
+                        (row + 2) % 5 * 5 + (column + 3) % 5):
+            letters = iter(others)
+            yield ''.join('x' if i == cell else 'z' if i == partner else next(letters) for i in range(25))
+
+def randomTable(rng):
+    '''
+    Returns a random table.
+
+    Input:   Random:  random number generator
+    Output:  string:  25-letter table, row by row
+    '''
+    return ''.join(rng.sample(_ALPHABET, 25))
+
+def variantPieces(variant):
+    '''
+    Returns the characters to build messages for a table variant from:
+    its letters in both cases, the letters it merges, doubled padding
+    letters, and the usual punctuation.
+
+    Input:   PlayfairVariant:  variant of the table
+    Output:  list:             pieces of text
+    '''
+    merged = [case(source) for source in variant.merged for case in (str.lower, str.upper)]
+    doubled = [variant.padding, variant.padding * 2, variant.fallback * 2, variant.padding * 3]
+    return list(variant.alphabet) + list(variant.alphabet.upper()) + (merged + doubled) * 4 + \
+           [' ', ', ', '.', '!', '7', '42', '\n', '\t', '-', 'q'] * 2
+
+def randomMessage(rng, foreign=0.1, pieces=_FUZZ_PIECES):
+    '''
+    Returns a random message of 0 to 200 pieces, so both odd and even
+    lengths and both short and long messages come up.  Some have
+    non-ASCII letters in them.
+
+    Input:   Random:  random number generator
+    Input:   float:   chance of a message with non-ASCII letters
+    Input:   list:    pieces to build the message from
+    Output:  string:  message
+    '''
+    length = rng.choice((rng.randrange(8), rng.randrange(40), rng.randrange(200)))
+    pieces = rng.choices(pieces, k=length)
+    if rng.random() < foreign:
+        for _ in range(rng.randrange(1, 4)):
+            pieces.insert(rng.randrange(len(pieces) + 1), rng.choice(_FOREIGN_PIECES))
+    return ''.join(pieces)
+
+class _Reference:
+    '''
+    The expected output for one table, worked out with encrypt() and
+    decrypt() on each of the 625 bigrams.
+
+    Input:   string:  25-letter table
+    '''
+    def __init__(self, letters):
+        self.table = [list(letters[row * 5:row * 5 + 5]) for row in range(5)]
+        self.encrypted = {pair: encrypt(pair, self.table) for pair in _PAIRS}
+        self.decrypted = {pair: decrypt(pair, self.table) for pair in set(self.encrypted.values())}
+
+    def split(self, message):
+        return referenceSplit(message)
+
+    def ruleOne(self, pair):
+        return playfairRuleOne(pair)
+
+    def accepts(self, message):
+        '''
+        Returns False when a letter of the message is not in the table,
+        so encrypt() can't handle it and the engines should refuse it.
+        '''
+        return all(pair in self.encrypted for pair in self.split(message))
+
+    def encrypt(self, message):
+        return joinPairs([self.encrypted[pair] for pair in self.split(message)])
+
+    def plaintext(self, message):
+        '''
+        Returns the message as encrypt() sees it, after playfairRuleOne(),
+        which is what decrypting gives back.
+        '''
+        return joinPairs([self.ruleOne(pair) for pair in self.split(message)])
+
+    def compiled(self):
+        '''
+        Returns the bigram tables _compileBigrams() should give: the two
+        output letters of every bigram with letters in table order, and
+        b'\\0\\0' for doubled pairs in the decryption table.
+        '''
+        letters = ''.join(''.join(row) for row in self.table)
+        pairs = [first + second for first in letters for second in letters]
+        return (''.join(self.encrypted[pair] for pair in pairs).encode('ascii'),
+                ''.join(self.decrypted.get(pair, '\0\0') for pair in pairs).encode('ascii'))
+
+@functools.lru_cache(maxsize=4)
+def _reference(letters):
+    '''
+    Returns the reference of a table, kept for the next few tables since
+    every table is also the second round of the cascade checked before it.
+    '''
+    return _Reference(letters)
+
+class _VariantReference(_Reference):
+    '''
+    The expected output for one table of a variant, worked out with the
+    variant's encrypt() and with decrypt() on each of its bigrams.
+
+    Input:   PlayfairVariant:  variant of the table
+    Input:   string:           the letters of the table, row by row
+    '''
+    def __init__(self, variant, letters):
+        self.variant = variant
+        size = variant.size
+        self.table = [list(letters[row * size:(row + 1) * size]) for row in range(size)]
+        self.encrypted = {first + second: variant.encrypt(first + second, self.table)
+                          for first in variant.alphabet for second in variant.alphabet}
+        self.decrypted = {pair: decrypt(pair, self.table) for pair in set(self.encrypted.values())}
+
+    def split(self, message):
+        return referenceVariantSplit(self.variant, message)
+
+    def ruleOne(self, pair):
+        return self.variant.playfairRuleOne(pair)
+
+def _cipherEngines(cipher):
+    '''
+    Returns the engines of one compiled cipher that encrypt a list of
+    messages, by name.
+
+    Input:   PlayfairCipher:  cipher for the table
+    Output:  list:            (name, function) pairs
+    '''
+    def stream(messages):
+        # Odd chunk sizes split pairs and letters across chunks
+        return [''.join(cipher.encryptStream(message[i:i+7] for i in range(0, len(message), 7)))
+                for message in messages]
+
+    def session(messages):
+        results = []
+        for message in messages:
+            current = cipher.encryptSession()
+            pieces = [current.feed(message[i:i+3]) for i in range(0, len(message), 3)]
+            results.append(''.join(pieces) + current.finish())
+        return results
+
+    return [
+        ('encryptMessage', lambda messages: [cipher.encryptMessage(message) for message in messages]),
+        ('encryptBatch', lambda messages: [cipher.encryptBatch(message) for message in messages]),
+        ('encryptMessages', cipher.encryptMessages),
+        ('encryptStream', stream),
+        ('encryptSession', session),
+    ]
+
+def checkTable(letters, messages, keyRing, keyId, heavy=False, folder=None, nextLetters=None, nextKeyId=None,
+               cache=None):
+    '''
+    Checks every engine against the reference rules for one table.  The
+    compiled bigram tables are checked whole, as one array each, and
+    every engine encrypts and decrypts the text of all 625 bigrams.  The
+    random messages then only go through the paths that handle messages
+    (filtering, padding, chunking, grouping and ordering); the engines
+    that only differ in how the table is built, like fromCompiled() and
+    KeyRing, are covered by the bigram sweep.  Messages the reference
+    can't encrypt must be refused.  With heavy set, SharedMemoryPool and
+    the parallel file functions are checked on all of it joined into one
+    text.
+
+    The next table is the second round of a PlayfairCascade, checked
+    against the two references one round after the other, and the second
+    key of the encryptMany() and FieldPipeline batches.
+
+    Input:   string:      25-letter table
+    Input:   list:        messages to fuzz with
+    Input:   KeyRing:     keyring holding the table
+    Input:   string:      key id of the table
+    Input:   bool:        also check the engines that start processes
+    Input:   string:      folder for the files of the checks (default: a new one)
+    Input:   string:      25-letter table of the next round (default: the same table)
+    Input:   string:      key id of that table in the keyring (default: keyId)
+    Input:   TableCache:  cache shared by the checks of all tables (default: a new one)
+    Output:  tuple:       (number of cases, list of failures)
+    '''
+    if folder is None:
+        with tempfile.TemporaryDirectory() as folder:
+            return checkTable(letters, messages, keyRing, keyId, heavy, folder, nextLetters, nextKeyId, cache)
+    if nextLetters is None:
+        nextLetters, nextKeyId = letters, keyId
+    cache = cache or TableCache(4)
+    reference = _reference(letters)
+    following = _reference(nextLetters)
+    table = PlayfairTable(letters)
+    failures = []
+    cases = 0
+
+    accepted = [message for message in messages if reference.accepts(message)]
+    refused = [message for message in messages if not reference.accepts(message)]
+    sweep = ''.join(_PAIRS)
+    inputs = [sweep] + accepted
+    expected = [reference.encrypt(message) for message in inputs]
+    plain = [reference.plaintext(message) for message in inputs]
+
+    # The compiled tables, as KeyRing stores them
+    compiled = _compileBigrams(table)
+    for name, wanted, result in zip(('compileBigrams', 'compileBigrams.decrypt'), reference.compiled(), compiled):
+        cases += _compareArray(name, letters, wanted, result, failures)
+
+    # encryptMany() compiles both tables into the cache, where the cipher
+    # checked below comes from, so every table is compiled once
+    records = [(phrase, message) for message in inputs for phrase in (letters, nextLetters)]
+    wanted = [text for message, text in zip(inputs, expected) for text in (text, following.encrypt(message))]
+    cases += _compareAll('encryptMany', letters, records, wanted,
+                         lambda records: encryptMany(records, workers=2, chunkSize=7, cache=cache), failures)
+    cipher = cache.get(letters)
+
+    for message in inputs:
+        cases += _compare('splitString', letters, message, referenceSplit(message), splitString(message), failures)
+    engines = _cipherEngines(cipher)
+    for name, engine in engines:
+        cases += _compareAll(name, letters, inputs, expected, engine, failures)
+    cases += _compareAll('decryptMessages', letters, expected, plain, cipher.decryptMessages, failures)
+    cases += _compareAll('decrypt', letters, expected, plain,
+                         lambda texts: [joinPairs([reference.decrypted[pair] for pair in splitString(text)])
+                                        for text in texts], failures)
+    cases += _checkPipeline(letters, inputs, expected, plain, keyRing, keyId, nextKeyId, following, failures)
+    cases += _checkFile(letters, cipher, ''.join(inputs), reference, folder, failures)
+
+    # Engines that share the lookups of a cipher built another way
+    cascade = PlayfairCascade([reference.table, PlayfairTable(nextLetters)])
+    cascaded = joinPairs([following.encrypted[reference.encrypted[pair]] for pair in _PAIRS])
+    for name, built, wanted in (('PlayfairCascade', cascade, cascaded),
+                                ('fromCompiled', PlayfairCipher.fromCompiled(table, *compiled), expected[0]),
+                                ('KeyRing', keyRing.cipher(keyId), expected[0])):
+        cases += _compareAll(name, letters, [sweep], [wanted], built.encryptMessages, failures)
+        cases += _compareAll(name + '.decrypt', letters, [wanted], plain[:1], built.decryptMessages, failures)
+
+    for name, engine in engines[:2]:
+        for message in refused:
+            try:
+                engine([message])
+                failures.append({'engine': name, 'table': letters, 'input': message,
+                                 'expected': "an error", 'got': "no error"})
+            except (ValueError, KeyError):
+                pass
+            cases += 1
+
+    # The other policies are checked against referenceFilter(); the tables come
+    # from _compileBigrams() since building a cipher is most of the cost here
+    for policy in ('drop', 'fold'):
+        filtered = [referenceFilter(message, policy) for message in messages]
+        cases += _compareAll(policy, letters, messages, [reference.encrypt(text) for text in filtered],
+                             PlayfairCipher.fromCompiled(table, *compiled, policy).encryptMessages, failures)
+
+    if heavy:
+        cases += _checkHeavy(letters, table, ''.join(inputs), reference, folder, failures)
+    return cases, failures
+
+def checkVariant(variant, letters, messages):
+    '''
+    Checks PlayfairVariantCipher against the variant's rules for one
+    table: on all its bigrams, on each message, and on decrypting them
+    back.  Messages the reference can't encrypt must be refused.
+
+    Input:   PlayfairVariant:  variant of the table
+    Input:   string:           the letters of the table, row by row
+    Input:   list:             messages to fuzz with
+    Output:  tuple:            (number of cases, list of failures)
+    '''
+    reference = _VariantReference(variant, letters)
+    cipher = PlayfairVariantCipher(reference.table, variant)
+    failures = []
+    cases = 0
+
+    accepted = [message for message in messages if reference.accepts(message)]
+    refused = [message for message in messages if not reference.accepts(message)]
+    inputs = [''.join(reference.encrypted)] + accepted
+    expected = [reference.encrypt(message) for message in inputs]
+
+    engines = _cipherEngines(cipher)
+    for name, engine in engines:
+        cases += _compareAll(name, letters, inputs, expected, engine, failures)
+
+    plain = [reference.plaintext(message) for message in inputs]
+    cases += _compareAll('decryptMessages', letters, expected, plain, cipher.decryptMessages, failures)
+
+    for name, engine in engines[:2]:
+        for message in refused:
+            try:
+                engine([message])
+                failures.append({'engine': name, 'table': letters, 'input': message,
+                                 'expected': "an error", 'got': "no error"})
+            except (ValueError, KeyError):
+                pass
+            cases += 1
+    return cases, failures
+
+def _checkPipeline(letters, inputs, expected, plain, keyRing, keyId, nextKeyId, following, failures):
+    '''
+    Checks FieldPipeline on records that take turns between the two key
+    ids, in batches small enough that both keys share most of them, and
+    decrypts its output back.
+
+    Output:  int:  number of cases
+    '''
+    keys = [keyId, nextKeyId] * len(inputs)
+    texts = [message for message in inputs for _ in range(2)]
+    wanted = [text for message, text in zip(inputs, expected) for text in (text, following.encrypt(message))]
+    back = [text for text in plain for _ in range(2)]
+
+    def run(texts, decrypting=False):
+        pipeline = FieldPipeline(['text'], 'key', keyRing, decrypting, batchSize=5)
+        records = ({'key': key, 'text': text} for key, text in zip(keys, texts))
+        return [record['text'] for record in pipeline.run(records)]
+
+    cases = _compareAll('FieldPipeline', letters, texts, wanted, run, failures)
+    return cases + _compareAll('FieldPipeline.decrypt', letters, wanted, back,
+                               lambda texts: run(texts, decrypting=True), failures)
+
+def _checkFile(letters, cipher, text, reference, folder, failures):
+    '''
+    Checks encryptFile() with an OffsetIndex whose checkpoints fall
+    between its reads, and decryptFileRange() on a few ranges of the
+    ciphertext file it wrote.
+
+    Output:  int:  number of cases
+    '''
+    data = text.encode('utf-8')
+    index = OffsetIndex()
+    output = io.StringIO()
+    cipher.encryptFile(io.BytesIO(data), output, chunkSize=97, index=index, indexInterval=61)
+    expected = reference.encrypt(text)
+    cases = _compare('encryptFile', letters, text, expected, output.getvalue(), failures)
+
+    path = os.path.join(folder, "range.txt")
+    with open(path, 'w') as outfile:
+        outfile.write(output.getvalue())
+    plain = reference.plaintext(text)
+    size = len(data)
+    for start, end in ((0, size // 3), (size // 4, size // 2 + 1), (size // 2, size)):
+        cipherStart, cipherEnd = index.locate(start, end)
+        before = len(referenceFilter(data[:start].decode('utf-8', 'ignore'), 'drop'))
+        through = len(referenceFilter(data[:end].decode('utf-8', 'ignore'), 'drop'))
+        if cipherStart > before or cipherEnd < min(through, len(plain)):
+            failures.append({'engine': 'OffsetIndex', 'table': letters, 'input': f"bytes {start}:{end}",
+                             'expected': f"letters {before}:{through}", 'got': f"letters {cipherStart}:{cipherEnd}"})
+        cases += _compare('decryptFileRange', letters, f"bytes {start}:{end}", plain[cipherStart:cipherEnd],
+                          decryptFileRange(path, index, cipher, start, end), failures)
+    return cases
+
+def _checkHeavy(letters, table, text, reference, folder, failures):
+    '''
+    Checks SharedMemoryPool and the parallel file functions on one text,
+    with work items small enough that pairs are cut between them.
+
+    Output:  int:  number of cases
+    '''
+    expected = reference.encrypt(text)
+    cases = 0
+    with SharedMemoryPool(table, workers=2, chunkSize=64) as pool:
+        cases += _compare('SharedMemoryPool', letters, text, expected, pool.encrypt(text), failures)
+        cases += _compare('SharedMemoryPool.decrypt', letters, expected, reference.plaintext(text),
+                          pool.decrypt(expected), failures)
+
+    plainPath = os.path.join(folder, "plain.txt")
+    cipherPath = os.path.join(folder, "cipher.txt")
+    backPath = os.path.join(folder, "back.txt")
+    with open(plainPath, 'w') as outfile:
+        outfile.write(text)
+    encryptFileParallel(plainPath, cipherPath, table, workers=2, chunkSize=61)
+    decryptFileParallel(cipherPath, backPath, table, workers=2, chunkSize=61)
+    with open(cipherPath) as infile:
+        cases += _compare('encryptFileParallel', letters, text, expected, infile.read(), failures)
+    with open(backPath) as infile:
+        cases += _compare('decryptFileParallel', letters, expected, reference.plaintext(text), infile.read(),
+                          failures)
+    return cases
+
+def _compareAll(name, letters, inputs, expected, engine, failures):
+    '''
+    Runs an engine on a list of inputs and records every output that
+    differs from the expected one, or the error it raised.
+
+    Output:  int:  number of bigrams compared
+    '''
+    try:
+        results = list(engine(inputs))
+    except Exception as error:
+        failures.append({'engine': name, 'table': letters, 'input': None,
+                         'expected': None, 'got': f"{type(error).__name__}: {error}"})
+        return 0
+    if len(results) != len(inputs):
+        failures.append({'engine': name, 'table': letters, 'input': None,
+                         'expected': f"{len(inputs)} outputs", 'got': f"{len(results)} outputs"})
+    return sum(_compare(name, letters, text, wanted, result, failures)
+               for text, wanted, result in zip(inputs, expected, results))
+
+def _compare(name, letters, text, expected, result, failures):
+    '''
+    Records a failure when a result differs from the expected one,
+    pointing at the first pair that differs.
+
+    Output:  int:  number of bigrams compared, at least 1
+    '''
+    size = max(1, len(expected) // 2 if isinstance(expected, str) else len(expected))
+    if result == expected:
+        return size
+    if isinstance(result, str) and isinstance(expected, str):
+        first = next((i for i in range(0, len(expected), 2) if result[i:i+2] != expected[i:i+2]), len(expected))
+        expected, result = expected[first:first + 2], result[first:first + 2]
+    failures.append({'engine': name, 'table': letters, 'input': text[:200],
+                     'expected': expected, 'got': result})
+    return size
+
+def _compareArray(name, letters, expected, result, failures):
+    '''
+    Compares a compiled bigram table with the expected one in one go,
+    and records the first bigram that differs when they don't match.
+
+    Output:  int:  number of bigrams compared
+    '''
+    if bytes(result) != expected:
+        result = bytes(result)
+        first = next((i for i in range(0, len(expected), 2) if result[i:i+2] != expected[i:i+2]), len(expected))
+        pair = letters[first // 50] + letters[first // 2 % 25] if first < len(expected) else None
+        failures.append({'engine': name, 'table': letters, 'input': pair,
+                         'expected': expected[first:first + 2], 'got': result[first:first + 2]})
+    return len(expected) // 2
+
+def checkConformance(randomTables=100, messagesPerTable=20, seed=0, heavyTables=1, adversarial=True,
+                     variantTables=5):
+    '''
+    Checks every engine against encrypt(), decrypt() and the four rules
+    over the adversarial tables and a number of random ones, fuzzing each
+    table with random messages.  All tables are written to one keyring
+    first so the KeyRing engine can be checked too, and each table is
+    checked with the one after it as its second key and cascade round.
+    The engines that start processes are slow to start, so they are only
+    run on the first heavyTables tables.  PlayfairVariantCipher is then
+    checked the same way for every variant, on the alphabet in order,
+    reversed, and variantTables random tables.
+
+    A case is one bigram of output from one engine compared with the
+    reference (a compiled table or the sweep of a table counts all its
+    bigrams, an empty output counts one), or one message an engine had
+    to refuse.
+
+    Input:   int:   number of random tables
+    Input:   int:   random messages per table
+    Input:   int:   seed for the tables and messages
+    Input:   int:   tables to run the process-based engines on
+    Input:   bool:  include adversarialTables()
+    Input:   int:   random tables of each variant
+    Output:  dict:  tables, variant tables, cases, seconds, cases/sec and failures
+    '''
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    tables = list(adversarialTables()) if adversarial else []
+    tables += [randomTable(rng) for _ in range(randomTables)]
+    failures = []
+    cases = 0
+    cache = TableCache(4)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "tables.pfkr")
+        KeyRing.write(path, ((str(i), letters) for i, letters in enumerate(tables)))
+        with KeyRing(path) as keyRing:
+            for i, letters in enumerate(tables):
+                messages = [randomMessage(rng) for _ in range(messagesPerTable)]
+                following = (i + 1) % len(tables)
+                count, found = checkTable(letters, messages, keyRing, str(i), i < heavyTables, folder,
+                                          tables[following], str(following), cache)
+                cases += count
+                failures += found
+
+    variants = 0
+    for variant in _VARIANTS:
+        pieces = variantPieces(variant)
+        alphabet = variant.alphabet
+        for letters in [alphabet, alphabet[::-1]] + [''.join(rng.sample(alphabet, len(alphabet)))
+                                                      for _ in range(variantTables)]:
+            messages = [randomMessage(rng, pieces=pieces) for _ in range(messagesPerTable)]
+            count, found = checkVariant(variant, letters, messages)
+            cases += count
+            failures += found
+            variants += 1
+
+    seconds = time.perf_counter() - started
+    return {
+        'tables': len(tables),
+        'variantTables': variants,
+        'cases': cases,
+        'seconds': seconds,
+        'casesPerSecond': cases / seconds if seconds else 0.0,
+        'failures': failures,
+    }
+
+def main(argv=None):
+    '''
+    Runs the harness from the command line and prints the result.
+
+    Input:   list:  command-line arguments (default: sys.argv[1:])
+    Output:  int:   exit status, 1 when any engine disagrees
+    '''
+    parser = argparse.ArgumentParser(description="Check the fast engines against the reference rules")
+    parser.add_argument('--tables', type=int, default=1000, help="random tables on top of the adversarial ones")
+    parser.add_argument('--messages', type=int, default=20, help="random messages per table")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--heavy', type=int, default=2, help="tables to run the process-based engines on")
+    parser.add_argument('--variant-tables', type=int, default=50, help="random tables of each table variant")
+    args = parser.parse_args(argv)
+
+    report = checkConformance(args.tables, args.messages, args.seed, args.heavy, variantTables=args.variant_tables)
+    print(f"{report['tables']} tables, {report['variantTables']} variant tables, {report['cases']} cases "
+          f"in {report['seconds']:.1f} s ({report['casesPerSecond']:.0f} cases/sec)")
+    for failure in report['failures'][:20]:
+        print(failure)
+    return 1 if report['failures'] else 0
+
+###############################################################
+
+# Below are the tests for the conformance harness
+def test_checkConformance_allEngines():
+    # Tests every engine on the adversarial tables, a few random ones and fuzzed messages
+    report = checkConformance(randomTables=5, messagesPerTable=10, seed=1)
+    assert report['tables'] == 2 + 75 + 5, "Wrong number of tables."
+    assert report['variantTables'] == 3 * (2 + 5), "Wrong number of variant tables."
+    assert not report['failures'], f"Engines disagree with the reference: {report['failures'][:3]}"
+    assert report['cases'] > 10000, "Too few cases."
+    pass
+
+def test_checkTable_findsMismatch():
+    # Tests that a wrong engine is reported at the first pair that differs
+    failures = []
+    assert _compareAll('broken', _ALPHABET, ["hello"], ["abcdef"], lambda texts: ["abxdef"], failures) == 3, \
+        "Every bigram of an output should be one case."
+    assert failures == [{'engine': 'broken', 'table': _ALPHABET, 'input': "hello", 'expected': "cd", 'got': "xd"}], \
+        "Failed to point at the first bad pair."
+    rng = random.Random(3)
+    messages = [randomMessage(rng, foreign=0.5) for _ in range(300)]
+    assert any(len(''.join(referenceSplit(message))) != len(normaliseText(message, 'drop')) for message in messages), \
+        "The fuzzer should make odd lengths."
+    assert any(not _Reference(_ALPHABET).accepts(message) for message in messages), "The fuzzer should add foreign letters."
+    assert len(set(adversarialTables())) == 77, "Adversarial tables should all differ."
+    encrypted, plain = _Reference(_ALPHABET).compiled()
+    broken = bytearray(encrypted)
+    broken[2 * 26 + 1] ^= 1
+    assert _compareArray('table', _ALPHABET, encrypted, broken, failures) == 625, "A table should be 625 cases."
+    assert failures[-1]['input'] == "bb" and failures[-1]['expected'] == encrypted[52:54], \
+        "Failed to point at the first bad bigram of a table."
+    pass
+
+def test_referenceFilter():
+    # Tests the per-character reference for the 'drop' and 'fold' policies
+    text = "Café Noël, ℌ Ａ K quiet ß 😀"
+    assert referenceFilter(text, 'drop') == "cafnolkuiet", "Failed to drop letters outside ASCII."
+    assert referenceFilter(text, 'fold') == "cafenoelhakuiet", "Failed to fold letters to the ones they are built on."
+    for policy in ('drop', 'fold'):
+        assert normaliseText(text, policy).decode('ascii') == referenceFilter(text, policy), \
+            f"normaliseText() differs on {policy}."
+    pass
+
+def test_checkVariant_wrapsBySize():
+    # Tests the 6x6 variant against its rules, which wrap after six letters
+    variant = PlayfairVariant.alphanumeric()
+    rng = random.Random(4)
+    messages = [randomMessage(rng, pieces=variantPieces(variant)) for _ in range(20)]
+    cases, failures = checkVariant(variant, variant.alphabet, messages)
+    assert cases > 0 and not failures, f"The variant cipher disagrees with its rules: {failures[:3]}"
+    reference = _VariantReference(variant, variant.alphabet)
+    assert reference.encrypted['ab'] == 'bc' and reference.encrypted['ef'] == 'fa', "Rows should wrap after six."
+    assert reference.encrypted['ag'] == 'gm' and reference.encrypted['a4'] == 'ga', "Columns should wrap after six."
+    assert referenceVariantSplit(PlayfairVariant.classic(), "Jj é") == ['ii', 'éx'], "Failed to merge and keep letters."
+    pass
+
+if __name__ == "__main__":
+    raise SystemExit(main())
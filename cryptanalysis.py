@@ -0,0 +1,727 @@
+import math
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from playfair import _ALPHABET, PlayfairCipher, canonicalKey, createTable, normaliseText, playfairRuleOne
+
+# Byte value of every letter of the q-less alphabet, by alphabet index
+_LETTER_BYTES = np.frombuffer(_ALPHABET.encode('ascii'), dtype=np.uint8)
+
+# Alphabet index of every byte value (255 for anything else)
+_ALPHABET_INDEXES = np.full(256, 255, dtype=np.uint8)
+_ALPHABET_INDEXES[_LETTER_BYTES] = np.arange(25)
+
+class NgramScorer:
+    '''
+    Scores text by how much it looks like a language, as the sum of the
+    log10 probabilities of its n-grams.  N-grams that never showed up in
+    the model get a small floor probability instead of minus infinity.
+
+    Input:   dict:  count of every n-gram (lowercase, no Qs)
+    '''
+    def __init__(self, counts):
+        lengths = {len(gram) for gram in counts}
+        if len(lengths) != 1:
+            raise ValueError("all n-grams in a model must have the same length")
+        self.n = lengths.pop()
+        self.counts = dict(counts)
+        total = sum(counts.values())
+        self.logProbabilities = {gram: math.log10(count / total) for gram, count in counts.items()}
+        self.floor = math.log10(0.01 / total)
+
+    @classmethod
+    def fromFile(cls, path):
+        '''
+        Loads a model from a file with one "NGRAM COUNT" pair per line,
+        the format commonly used for English quadgram statistics.
+
+        Input:   string:       path of the model file
+        Output:  NgramScorer:  the model
+        '''
+        counts = {}
+        with open(path) as infile:
+            for line in infile:
+                fields = line.split()
+                if len(fields) == 2:
+                    gram = fields[0].lower()
+                    counts[gram] = counts.get(gram, 0) + int(fields[1])
+        return cls(counts)
+
+    @classmethod
+    def fromText(cls, text, n=4):
+        '''
+        Builds a model by counting the n-grams of some sample text after
+        the same filtering splitString() does.  Accented letters in the
+        sample are folded to their ASCII base letters.
+
+        Input:   string:       sample text
+        Input:   int:          n-gram length
+        Output:  NgramScorer:  the model
+        '''
+        letters = normaliseText(text, 'fold').decode('ascii')
+        counts = {}
+        for i in range(len(letters) - n + 1):
+            gram = letters[i:i+n]
+            counts[gram] = counts.get(gram, 0) + 1
+        return cls(counts)
+
+    def score(self, text):
+        '''
+        Scores filtered lowercase text; higher is more language-like.
+
+        Input:   string:  text
+        Output:  float:   sum of the n-gram log probabilities
+        '''
+        get = self.logProbabilities.get
+        floor = self.floor
+        n = self.n
+        return sum(get(text[i:i+n], floor) for i in range(len(text) - n + 1))
+
+    def scoreIndexes(self, indexes):
+        '''
+        Scores text held as alphabet indexes.
+
+        Input:   numpy array:  alphabet indexes
+        Output:  float:        sum of the n-gram log probabilities
+        '''
+        return self.score(fromIndexes(indexes))
+
+    def rescore(self, score, oldIndexes, newIndexes):
+        '''
+        Scores new text given the score of the text it replaced.  This
+        dictionary model simply scores the new text from scratch; see
+        ArrayNgramScorer for one that only rescores what changed.
+
+        Input:   float:        score of the old text
+        Input:   numpy array:  old text as alphabet indexes
+        Input:   numpy array:  new text as alphabet indexes, of the same length
+        Output:  float:        score of the new text
+        '''
+        return self.scoreIndexes(newIndexes)
+
+class ArrayNgramScorer:
+    '''
+    The same scoring as NgramScorer, but with the model held in one flat
+    array of 25**n log probabilities indexed by the base-25 code of each
+    n-gram over the q-less alphabet of createTable(), so a whole buffer is
+    scored with array operations instead of one dictionary lookup per
+    n-gram.  rescore() only looks at the windows that overlap letters
+    which changed, which is what a key search needs after a mutation.
+
+    Input:   dict:  count of every n-gram (lowercase, no Qs)
+    '''
+    def __init__(self, counts):
+        lengths = {len(gram) for gram in counts}
+        if len(lengths) != 1:
+            raise ValueError("all n-grams in a model must have the same length")
+        self.n = lengths.pop()
+        total = sum(counts.values())
+        self.floor = math.log10(0.01 / total)
+        self.logProbabilities = np.full(25 ** self.n, self.floor)
+        for gram, count in counts.items():
+            # N-grams with a q (or anything else off the table) can never show up
+            indexes = _ALPHABET_INDEXES[np.frombuffer(gram.encode('ascii', 'replace'), dtype=np.uint8)]
+            if (indexes == 255).any():
+                continue
+            self.logProbabilities[self._codes(indexes)[0]] = math.log10(count / total)
+        # Powers of 25 for the letters of one window, most significant first
+        self._weights = 25 ** np.arange(self.n - 1, -1, -1, dtype=np.intp)
+
+    @classmethod
+    def fromFile(cls, path):
+        '''
+        Loads a model from a file with one "NGRAM COUNT" pair per line.
+
+        Input:   string:            path of the model file
+        Output:  ArrayNgramScorer:  the model
+        '''
+        return cls(NgramScorer.fromFile(path).counts)
+
+    @classmethod
+    def fromText(cls, text, n=4):
+        '''
+        Builds a model by counting the n-grams of some sample text.
+
+        Input:   string:            sample text
+        Input:   int:               n-gram length
+        Output:  ArrayNgramScorer:  the model
+        '''
+        return cls(NgramScorer.fromText(text, n).counts)
+
+    def _codes(self, indexes, starts=None):
+        '''
+        Returns the base-25 code of the n-gram at every window start.
+
+        Input:   numpy array:  alphabet indexes
+        Input:   numpy array:  window starts (default: every window)
+        Output:  numpy array:  codes
+        '''
+        n = self.n
+        if starts is None:
+            starts = np.arange(max(len(indexes) - n + 1, 0))
+        codes = np.zeros(len(starts), dtype=np.intp)
+        for offset in range(n):
+            codes = codes * 25 + indexes[starts + offset]
+        return codes
+
+    def score(self, text):
+        '''
+        Scores filtered lowercase text; higher is more language-like.
+
+        Input:   string:  text
+        Output:  float:   sum of the n-gram log probabilities
+        '''
+        return self.scoreIndexes(toIndexes(text))
+
+    def scoreIndexes(self, indexes):
+        '''
+        Scores text held as alphabet indexes, all windows at once.
+
+        Input:   numpy array:  alphabet indexes
+        Output:  float:        sum of the n-gram log probabilities
+        '''
+        return float(self.logProbabilities[self._codes(indexes)].sum())
+
+    def rescore(self, score, oldIndexes, newIndexes):
+        '''
+        Scores new text given the score of the text it replaced, looking
+        only at the windows that overlap a letter that changed.
+
+        Input:   float:        score of the old text
+        Input:   numpy array:  old text as alphabet indexes
+        Input:   numpy array:  new text as alphabet indexes, of the same length
+        Output:  float:        score of the new text
+        '''
+        windows = len(newIndexes) - self.n + 1
+        changed = np.flatnonzero(oldIndexes != newIndexes)
+        if windows <= 0 or changed.size == 0:
+            return score
+
+        # Every window starting up to n-1 letters before a change overlaps it
+        affected = np.zeros(windows, dtype=bool)
+        for offset in range(self.n):
+            starts = changed - offset
+            affected[starts[(starts >= 0) & (starts < windows)]] = True
+        starts = np.flatnonzero(affected)
+
+        logProbabilities = self.logProbabilities
+        return float(score
+                     + logProbabilities[self._codes(newIndexes, starts)].sum()
+                     - logProbabilities[self._codes(oldIndexes, starts)].sum())
+
+def toIndexes(text):
+    '''
+    Turns text into an array of alphabet indexes (a=0 ... z=24, no q),
+    dropping everything the splitString() filtering would drop.
+
+    Input:   string:        text
+    Output:  numpy array:   uint8 alphabet indexes
+    '''
+    return _ALPHABET_INDEXES[np.frombuffer(normaliseText(text), dtype=np.uint8)]
+
+def fromIndexes(indexes):
+    '''
+    Turns an array of alphabet indexes back into lowercase text.
+
+    Input:   numpy array:  alphabet indexes
+    Output:  string:       text
+    '''
+    return _LETTER_BYTES[indexes].tobytes().decode('ascii')
+
+def decryptWithKey(key, cipherIndexes):
+    '''
+    Decrypts ciphertext held as alphabet indexes with the table given as
+    a key -- a sequence of 25 alphabet indexes, row by row -- all as
+    array operations.  Nothing is precomputed per key, so it is cheap
+    enough to call for every candidate in a search.
+
+    Input:   numpy array:  table as 25 alphabet indexes
+    Input:   numpy array:  ciphertext as alphabet indexes (even length)
+    Output:  numpy array:  plaintext as alphabet indexes
+    '''
+    key = np.asarray(key)
+    where = np.empty(25, dtype=np.intp)
+    where[key] = np.arange(25)
+
+    first, second = where[cipherIndexes[0::2]], where[cipherIndexes[1::2]]
+    row1, col1 = np.divmod(first, 5)
+    row2, col2 = np.divmod(second, 5)
+    sameRow = row1 == row2
+    sameCol = col1 == col2
+
+    # Rectangle by default, then the row and column shifts on top
+    plain1 = row1 * 5 + col2
+    plain2 = row2 * 5 + col1
+    plain1 = np.where(sameRow, row1 * 5 + (col1 - 1) % 5, plain1)
+    plain2 = np.where(sameRow, row2 * 5 + (col2 - 1) % 5, plain2)
+    plain1 = np.where(sameCol, ((row1 - 1) % 5) * 5 + col1, plain1)
+    plain2 = np.where(sameCol, ((row2 - 1) % 5) * 5 + col2, plain2)
+
+    plain = np.empty(len(cipherIndexes), dtype=np.uint8)
+    plain[0::2] = key[plain1]
+    plain[1::2] = key[plain2]
+    return plain
+
+def mutateKey(key, rng):
+    '''
+    Returns a slightly changed copy of a key: most of the time two
+    letters are swapped, otherwise two rows or two columns are swapped,
+    or the rows, the columns or the whole key are reversed.
+
+    Input:   numpy array:    table as 25 alphabet indexes
+    Input:   random.Random:  random source
+    Output:  numpy array:    the changed key
+    '''
+    grid = key.reshape(5, 5).copy()
+    choice = rng.random()
+    if choice < 0.90:
+        a, b = rng.sample(range(25), 2)
+        flat = grid.reshape(25)
+        flat[a], flat[b] = flat[b], flat[a]
+    elif choice < 0.94:
+        a, b = rng.sample(range(5), 2)
+        grid[[a, b]] = grid[[b, a]]
+    elif choice < 0.98:
+        a, b = rng.sample(range(5), 2)
+        grid[:, [a, b]] = grid[:, [b, a]]
+    elif choice < 0.99:
+        grid = grid[::-1]
+    elif choice < 0.995:
+        grid = grid[:, ::-1]
+    else:
+        grid = grid.reshape(25)[::-1]
+    return np.ascontiguousarray(grid).reshape(25)
+
+def searchKey(ciphertext, scorer, iterations=20000, startTemperature=20.0, threshold=None,
+              startKey=None, seed=0, stopEvent=None):
+    '''
+    Runs one simulated-annealing search for the key of a ciphertext.
+    Starting from startKey (or a random key), it keeps mutating the
+    current key, always accepting better candidates and sometimes worse
+    ones while the temperature is high; the temperature falls linearly
+    to zero, so the end is plain hill climbing.  It stops early once a
+    candidate scores at least threshold, or once stopEvent is set.
+
+    Input:   string:       ciphertext
+    Input:   scorer:       NgramScorer or ArrayNgramScorer
+    Input:   int:          number of candidates to try
+    Input:   float:        starting temperature
+    Input:   float:        score to stop at, or None
+    Input:   string:       key or passphrase to start from, or None for random
+    Input:   int:          random seed
+    Input:   Event:        checked every 256 candidates to stop early, or None
+    Output:  tuple:        (best score, best key as 25 letters, candidates tried)
+    '''
+    rng = random.Random(seed)
+    cipherIndexes = toIndexes(ciphertext)
+    if startKey is None:
+        current = np.array(rng.sample(range(25), 25), dtype=np.uint8)
+    else:
+        current = toIndexes(canonicalKey(startKey))
+
+    currentPlain = decryptWithKey(current, cipherIndexes)
+    currentScore = scorer.scoreIndexes(currentPlain)
+    best, bestScore = current, currentScore
+    tried = 1
+
+    for step in range(iterations):
+        if threshold is not None and bestScore >= threshold:
+            break
+        if stopEvent is not None and step % 256 == 0 and stopEvent.is_set():
+            break
+        temperature = startTemperature * (1 - step / iterations)
+        candidate = mutateKey(current, rng)
+        plain = decryptWithKey(candidate, cipherIndexes)
+        score = scorer.rescore(currentScore, currentPlain, plain)
+        tried += 1
+
+        change = score - currentScore
+        if change >= 0 or (temperature > 0 and rng.random() < math.exp(change / temperature)):
+            current, currentScore, currentPlain = candidate, score, plain
+            if score > bestScore:
+                best, bestScore = candidate, score
+
+    return bestScore, fromIndexes(best), tried
+
+def recoverKey(ciphertext, scorer, restarts=8, workers=None, iterations=20000,
+               startTemperature=20.0, threshold=None, seed=0):
+    '''
+    Recovers the key of a ciphertext by running independent searchKey()
+    restarts on a process pool and keeping the best result.  As soon as
+    one restart reaches threshold, the ones still queued are cancelled
+    and the running ones are told to stop through a shared event.
+
+    Input:   string:       ciphertext
+    Input:   scorer:       NgramScorer or ArrayNgramScorer
+    Input:   int:          number of independent restarts
+    Input:   int:          number of worker processes (default: all CPUs)
+    Input:   int:          candidates per restart
+    Input:   float:        starting temperature
+    Input:   float:        score to stop at, or None
+    Input:   int:          random seed of the first restart
+    Output:  dict:         key, score, plaintext, candidates, seconds and keys_per_sec
+    '''
+    start = time.perf_counter()
+    best = (-math.inf, None)
+    candidates = 0
+
+    stop = multiprocessing.Event()
+    with ProcessPoolExecutor(workers, initializer=_initSearchWorker, initargs=(stop,)) as pool:
+        pending = {pool.submit(_searchRestart, ciphertext, scorer, iterations, startTemperature,
+                               threshold, seed + restart)
+                   for restart in range(restarts)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                score, key, tried = future.result()
+                candidates += tried
+                if score > best[0]:
+                    best = (score, key)
+            if threshold is not None and best[0] >= threshold:
+                stop.set()
+                for future in pending:
+                    future.cancel()
+                break
+
+    seconds = time.perf_counter() - start
+    score, key = best
+    plaintext = fromIndexes(decryptWithKey(toIndexes(key), toIndexes(ciphertext)))
+    return {'key': key, 'score': score, 'plaintext': plaintext, 'candidates': candidates,
+            'seconds': seconds, 'keys_per_sec': candidates / seconds if seconds else 0.0}
+
+# Stop event of recoverKey(), shared with each of its worker processes
+_stopEvent = None
+
+def _initSearchWorker(stop):
+    '''
+    Keeps the shared stop event when a worker process starts.
+
+    Input:   Event:  set once any restart reaches the threshold
+    '''
+    global _stopEvent
+    _stopEvent = stop
+
+def _searchRestart(ciphertext, scorer, iterations, startTemperature, threshold, seed):
+    '''
+    Runs one restart of recoverKey() in a worker process.
+
+    Input:   string:       ciphertext
+    Input:   scorer:       NgramScorer or ArrayNgramScorer
+    Input:   int:          candidates to try
+    Input:   float:        starting temperature
+    Input:   float:        score to stop at, or None
+    Input:   int:          random seed
+    Output:  tuple:        the result of searchKey()
+    '''
+    return searchKey(ciphertext, scorer, iterations, startTemperature, threshold, None, seed, _stopEvent)
+
+def dictionaryAttack(wordlistPath, plaintext, ciphertext, workers=None, batchSize=5000,
+                     stopAtFirst=True, nonAscii='fold'):
+    '''
+    Tries every passphrase of a wordlist (one per line) against a known
+    plaintext/ciphertext sample.  The file is streamed, and each phrase
+    is reduced with canonicalKey() -- the same filtering as createTable()
+    -- so phrases that give a table already tried are skipped.  Letters
+    outside ASCII are handled by the nonAscii policy, and phrases it
+    refuses are skipped and counted; the known plaintext is filtered
+    the same way up front, so under 'strict' an accented plaintext
+    raises ValueError before any work starts.  Each new key is checked
+    pair by pair against the distinct known bigrams with a 25-entry
+    position lookup, stopping at the first pair that doesn't match, on
+    a process pool in batches of batchSize keys.  Finished batches are
+    picked up after every submit, so with stopAtFirst the first match
+    stops the reading and the batches not started yet are cancelled.
+
+    Input:   string:  path of the wordlist
+    Input:   string:  known plaintext
+    Input:   string:  ciphertext of that plaintext
+    Input:   int:     number of worker processes (default: all CPUs)
+    Input:   int:     keys sent to a worker at a time
+    Input:   bool:    stop reading once a matching phrase is found
+    Input:   string:  'strict', 'drop' or 'fold' (see normaliseText)
+    Output:  dict:    matches as (phrase, key) pairs, candidates read, unique
+                      keys tried, phrases skipped, seconds and candidates_per_sec
+    '''
+    knownPairs = _knownPairs(plaintext, ciphertext, nonAscii)
+    start = time.perf_counter()
+    seen = set()
+    matches = []
+    candidates = 0
+    unique = 0
+    skipped = 0
+
+    with ProcessPoolExecutor(workers, initializer=_initAttackWorker, initargs=(knownPairs,)) as pool, \
+         open(wordlistPath, encoding='utf-8', errors='replace') as wordlist:
+        pending = set()
+        batch = []
+        limit = 2 * (workers or os.cpu_count() or 1)
+
+        def collect(timeout, returnWhen):
+            nonlocal pending
+            done, pending = wait(pending, timeout, returnWhen)
+            for future in done:
+                matches.extend(future.result())
+
+        for line in wordlist:
+            phrase = line.rstrip('\r\n')
+            candidates += 1
+            try:
+                key = canonicalKey(phrase, nonAscii)
+            except ValueError:
+                skipped += 1
+                continue
+            if key in seen:
+                continue
+            seen.add(key)
+            unique += 1
+            batch.append((phrase, key))
+
+            if len(batch) >= batchSize:
+                pending.add(pool.submit(_checkKeys, batch))
+                batch = []
+                # Picks up the batches already done, and waits for one while
+                # too many are in flight so memory stays bounded
+                collect(None if len(pending) >= limit else 0, FIRST_COMPLETED)
+                if stopAtFirst and matches:
+                    break
+
+        if batch and not (stopAtFirst and matches):
+            pending.add(pool.submit(_checkKeys, batch))
+        if stopAtFirst:
+            # One batch at a time, so the rest can be dropped after a match
+            while pending and not matches:
+                collect(None, FIRST_COMPLETED)
+            for future in pending:
+                future.cancel()
+        elif pending:
+            collect(None, ALL_COMPLETED)
+
+    seconds = time.perf_counter() - start
+    return {'matches': matches, 'candidates': candidates, 'unique': unique, 'skipped': skipped,
+            'seconds': seconds, 'candidates_per_sec': candidates / seconds if seconds else 0.0}
+
+def _knownPairs(plaintext, ciphertext, nonAscii='strict'):
+    '''
+    Lines up a known plaintext with its ciphertext as distinct pairs of
+    (plaintext bigram after playfairRuleOne, ciphertext bigram), in the
+    order they first appear.  The plaintext is filtered with
+    normaliseText() under the nonAscii policy, the way a cipher with
+    that policy filters it, so every pair holds table letters.
+
+    Input:   string:  known plaintext
+    Input:   string:  its ciphertext
+    Input:   string:  'strict', 'drop' or 'fold' (see normaliseText)
+    Output:  list:    (plaintext bigram, ciphertext bigram) pairs
+    '''
+    cipherLetters = normaliseText(ciphertext).decode('ascii')
+    cipherPairs = [cipherLetters[i:i+2] for i in range(0, len(cipherLetters) - 1, 2)]
+    plainLetters = normaliseText(plaintext, nonAscii).decode('ascii')
+    if len(plainLetters) % 2 != 0:
+        plainLetters += 'x'
+    plainPairs = [playfairRuleOne(plainLetters[i:i+2]) for i in range(0, len(plainLetters), 2)]
+    if not plainPairs or len(plainPairs) != len(cipherPairs):
+        raise ValueError("plaintext and ciphertext must have the same, non-zero number of pairs")
+    return list(dict.fromkeys(zip(plainPairs, cipherPairs)))
+
+def keyMatches(key, knownPairs):
+    '''
+    Checks whether a table encrypts every known plaintext bigram to its
+    ciphertext bigram, stopping at the first one that differs.
+
+    Input:   string:  table as 25 letters
+    Input:   list:    (plaintext bigram, ciphertext bigram) pairs from _knownPairs()
+    Output:  bool:    True if the table fits every pair
+    '''
+    where = {char: divmod(index, 5) for index, char in enumerate(key)}
+    for plain, cipher in knownPairs:
+        (row1, col1), (row2, col2) = where[plain[0]], where[plain[1]]
+        if row1 == row2:
+            col1, col2 = (col1 + 1) % 5, (col2 + 1) % 5
+        elif col1 == col2:
+            row1, row2 = (row1 + 1) % 5, (row2 + 1) % 5
+        else:
+            col1, col2 = col2, col1
+        if key[row1 * 5 + col1] != cipher[0] or key[row2 * 5 + col2] != cipher[1]:
+            return False
+    return True
+
+# Known pairs of dictionaryAttack(), kept by each of its worker processes
+_workerPairs = None
+
+def _initAttackWorker(knownPairs):
+    '''
+    Keeps the known pairs when a worker process starts.
+
+    Input:   list:  (plaintext bigram, ciphertext bigram) pairs
+    '''
+    global _workerPairs
+    _workerPairs = knownPairs
+
+def _checkKeys(batch):
+    '''
+    Checks one batch of keys in a worker process.
+
+    Input:   list:  (phrase, key) pairs
+    Output:  list:  the (phrase, key) pairs that fit
+    '''
+    return [(phrase, key) for phrase, key in batch if keyMatches(key, _workerPairs)]
+
+###############################################################
+
+# Sample text used by the tests below
+_SAMPLE = '''
+It was the best of times, it was the worst of times, it was the age of wisdom,
+it was the age of foolishness, it was the epoch of belief, it was the epoch of
+incredulity, it was the season of light, it was the season of darkness, it was
+the spring of hope, it was the winter of despair, we had everything before us,
+we had nothing before us, we were all going direct to heaven, we were all going
+direct the other way. In short, the period was so far like the present period,
+that some of its noisiest authorities insisted on its being received, for good
+or for evil, in the superlative degree of comparison only.
+'''
+
+# Below are the tests for the key search
+def test_decryptWithKey_matchesCipher():
+    # Tests the array decryption against the compiled cipher for several keys
+    for phrase in ("i am entering a pass phrase", "simple", "zyxwvutsr"):
+        cipher = PlayfairCipher(createTable(phrase))
+        ciphertext = cipher.encryptMessage(_SAMPLE)
+        plain = decryptWithKey(toIndexes(canonicalKey(phrase)), toIndexes(ciphertext))
+        assert fromIndexes(plain) == cipher.decryptMessage(ciphertext), f"Failed with key '{phrase}'."
+    pass
+
+def test_mutateKey_keepsLetters():
+    # Tests that mutations only reorder the 25 letters
+    rng = random.Random(1)
+    key = toIndexes(canonicalKey("simple"))
+    for _ in range(500):
+        key = mutateKey(key, rng)
+        assert sorted(key.tolist()) == list(range(25)), "Mutation lost or duplicated a letter."
+    pass
+
+def test_searchKey_nearbyStart():
+    # Tests recovering a key from a start two swaps away from it
+    scorer = NgramScorer.fromText(_SAMPLE * 3, 4)
+    phrase = "playfair example"
+    ciphertext = PlayfairCipher(createTable(phrase)).encryptMessage(_SAMPLE)
+    key = list(canonicalKey(phrase))
+    key[0], key[7] = key[7], key[0]
+    key[3], key[20] = key[20], key[3]
+    target = scorer.score(fromIndexes(decryptWithKey(toIndexes(canonicalKey(phrase)), toIndexes(ciphertext))))
+    score, found, tried = searchKey(ciphertext, scorer, iterations=5000, startTemperature=0,
+                                    threshold=target, startKey=''.join(key), seed=3)
+    assert found == canonicalKey(phrase), "Failed to recover the key."
+    assert tried < 5000, "Search should stop early at the threshold."
+    pass
+
+def test_recoverKey_threshold():
+    # Tests that restarts stop as soon as the threshold is reached
+    scorer = NgramScorer.fromText(_SAMPLE, 4)
+    result = recoverKey("hjntntirnpginprnpm", scorer, restarts=4, workers=2, iterations=100000,
+                        threshold=-math.inf)
+    assert result['candidates'] < 10, "Restarts should stop straight away."
+    assert len(result['key']) == 25 and result['keys_per_sec'] > 0, "Failed to report the result."
+    pass
+
+def test_ArrayNgramScorer_matchesDictionary():
+    # Tests that both scorers give the same score
+    dictionary = NgramScorer.fromText(_SAMPLE, 4)
+    array = ArrayNgramScorer.fromText(_SAMPLE, 4)
+    for text in ("itwasthebestoftimes", "zzzzxxkv", "abc", normaliseText(_SAMPLE).decode('ascii')):
+        assert abs(dictionary.score(text) - array.score(text)) < 1e-6, f"Scores differ for '{text[:20]}'."
+    pass
+
+def test_ArrayNgramScorer_rescore():
+    # Tests that rescoring after key mutations matches scoring from scratch
+    scorer = ArrayNgramScorer.fromText(_SAMPLE, 4)
+    cipherIndexes = toIndexes(PlayfairCipher(createTable("simple")).encryptMessage(_SAMPLE))
+    rng = random.Random(5)
+    key = toIndexes(canonicalKey("simple"))
+    plain = decryptWithKey(key, cipherIndexes)
+    score = scorer.scoreIndexes(plain)
+    for _ in range(200):
+        key = mutateKey(key, rng)
+        newPlain = decryptWithKey(key, cipherIndexes)
+        score = scorer.rescore(score, plain, newPlain)
+        plain = newPlain
+        assert abs(score - scorer.scoreIndexes(plain)) < 1e-6, "Rescored value drifted from the full score."
+    pass
+
+def test_ArrayNgramScorer_fromFile():
+    # Tests loading a model file, where n-grams with a q are dropped
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "quadgrams.txt")
+        with open(path, 'w') as outfile:
+            outfile.write("TION 30\nTHER 20\nQUIT 50\n")
+        scorer = ArrayNgramScorer.fromFile(path)
+    assert abs(scorer.score("tion") - math.log10(0.3)) < 1e-9, "Failed on a known quadgram."
+    assert scorer.score("abcd") == scorer.floor, "Unknown quadgrams should get the floor."
+    pass
+
+def test_keyMatches_againstCipher():
+    # Tests the pair check against the compiled cipher
+    plaintext = "the quick brown fox jumps over the lazy dog, twice"
+    ciphertext = PlayfairCipher(createTable("right key")).encryptMessage(plaintext)
+    knownPairs = _knownPairs(plaintext, ciphertext)
+    assert keyMatches(canonicalKey("right key"), knownPairs), "The right key should match."
+    assert not keyMatches(canonicalKey("wrong key"), knownPairs), "A wrong key should not match."
+    pass
+
+def test_dictionaryAttack_findsPhrase():
+    # Tests a wordlist with decoys and phrases that give the same table
+    plaintext = "meet me by the old oak tree at midnight"
+    ciphertext = PlayfairCipher(createTable("Secret Garden")).encryptMessage(plaintext)
+    rng = random.Random(2)
+    words = [''.join(rng.sample(_ALPHABET, 8)) for i in range(300)]
+    words += ["secret garden", "SECRET, GARDEN!", "decoy 1", "decoy 2"]
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "words.txt")
+        with open(path, 'w') as outfile:
+            outfile.write("\n".join(words) + "\n")
+        result = dictionaryAttack(path, plaintext, ciphertext, workers=2, batchSize=16, stopAtFirst=False)
+    assert result['matches'] == [("secret garden", canonicalKey("secret garden"))], "Failed to find the phrase."
+    assert result['candidates'] == len(words), "Failed to count candidates."
+    assert result['unique'] == len({canonicalKey(word) for word in words}) == 302, "Phrases with a table already tried should be skipped."
+    pass
+
+def test_dictionaryAttack_junkLines():
+    # Tests that accented and undecodable lines don't stop the attack
+    plaintext = "meet me by the old oak tree at midnight"
+    ciphertext = PlayfairCipher(createTable("secret garden")).encryptMessage(plaintext)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "words.txt")
+        with open(path, 'wb') as outfile:
+            outfile.write("café\nñandú\n".encode('utf-8') + b"\xff\xfe junk\nsecret garden\n")
+        folded = dictionaryAttack(path, plaintext, ciphertext, workers=1, stopAtFirst=False)
+        strict = dictionaryAttack(path, plaintext, ciphertext, workers=1, stopAtFirst=False, nonAscii='strict')
+    for result in (folded, strict):
+        assert [phrase for phrase, _ in result['matches']] == ["secret garden"], "Failed to find the phrase."
+    assert folded['unique'] == 4 and folded['skipped'] == 0, "Accented phrases should be folded."
+    assert strict['unique'] == 2 and strict['skipped'] == 2, "Accented phrases should be skipped under 'strict'."
+    pass
+
+def test_dictionaryAttack_stopsAtFirst():
+    # Tests that the first match stops the reading, and an accented plaintext is filtered up front
+    plaintext = "rendez-vous au café, près de la forêt"
+    ciphertext = PlayfairCipher(createTable("secret garden"), 'fold').encryptMessage(plaintext)
+    rng = random.Random(6)
+    words = ["secret garden"] + [''.join(rng.sample(_ALPHABET, 8)) for i in range(5000)]
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "words.txt")
+        with open(path, 'w') as outfile:
+            outfile.write("\n".join(words) + "\n")
+        result = dictionaryAttack(path, plaintext, ciphertext, workers=1, batchSize=16)
+        try:
+            dictionaryAttack(path, plaintext, ciphertext, workers=1, nonAscii='strict')
+            assert False, "An accented plaintext should be refused under 'strict'."
+        except ValueError:
+            pass
+    assert [phrase for phrase, _ in result['matches']] == ["secret garden"], "Failed to find the phrase."
+    assert result['candidates'] < 1000, "Reading should stop soon after the match."
+    pass
@@ -0,0 +1,316 @@
+import argparse
+import csv
+import functools
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+from playfair import KeyRing, PlayfairCipher, PlayfairTable, canonicalKey, createTable
+
+class FieldPipeline:
+    '''
+    Encrypts or decrypts chosen fields of a stream of records, such as
+    the rows of a CSV or JSONL export, where every row names its own key
+    in keyField.  Records are taken batchSize at a time; inside a batch
+    the cells are grouped by key so each table is looked up once, and
+    every group goes through one encryptMessages() or decryptMessages()
+    call on the compiled cipher.  Records come back in input order, and
+    only one batch is held at a time, so memory stays bounded however
+    long the stream is.
+
+    Keys are looked up in keys, which can be a KeyRing of key ids, a
+    dict from key id to passphrase, or None when keyField holds the
+    passphrase itself.  The last cacheSize ciphers are kept.  Empty and
+    missing cells are left as they are; any other value that is not a
+    string, like a JSON number, raises TypeError, as does a key that is
+    not a non-empty string.  A record without keyField raises ValueError
+    naming the record.
+
+    Input:   list:                   names of the fields to transform
+    Input:   string:                 name of the field holding the key id
+    Input:   KeyRing, dict or None:  where key ids are looked up
+    Input:   bool:                   decrypt instead of encrypt
+    Input:   int:                    records per batch
+    Input:   string:                 'strict', 'drop' or 'fold' (see normaliseText)
+    Input:   int:                    largest number of ciphers to keep
+    '''
+    def __init__(self, fields, keyField, keys=None, decrypting=False, batchSize=10000,
+                 nonAscii='strict', cacheSize=1024):
+        if batchSize < 1:
+            raise ValueError("batchSize must be at least 1")
+        self.fields = list(fields)
+        self.keyField = keyField
+        self.keys = keys
+        self.decrypting = decrypting
+        self.batchSize = batchSize
+        self.nonAscii = nonAscii
+        self.rows = 0
+        self.cells = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self._cipher = functools.lru_cache(maxsize=cacheSize)(self._loadCipher)
+
+    def run(self, records):
+        '''
+        Transforms the fields of every record, yielding new records in
+        input order.  The records passed in are not changed.
+
+        Input:   iterable:   records as dicts
+        Output:  generator:  transformed records
+        '''
+        records = iter(records)
+        while True:
+            batch = [dict(record) for record in itertools.islice(records, self.batchSize)]
+            if not batch:
+                return
+            # Times only the work on the batch, not reading the records
+            started = time.perf_counter()
+
+            # Groups the cells of every row that share a key
+            groups = {}
+            for position, record in enumerate(batch, self.rows + 1):
+                if self.keyField not in record:
+                    raise ValueError(f"record {position} has no field '{self.keyField}'")
+                keyId = record[self.keyField]
+                if not isinstance(keyId, str) or not keyId:
+                    raise TypeError(f"field '{self.keyField}' holds {type(keyId).__name__} {keyId!r}, not a key")
+                for field in self.fields:
+                    value = record.get(field)
+                    if value is None or value == '':
+                        continue
+                    if not isinstance(value, str):
+                        raise TypeError(f"field '{field}' holds {type(value).__name__} {value!r}, not text")
+                    cells, texts = groups.setdefault(keyId, ([], []))
+                    cells.append((record, field))
+                    texts.append(value)
+
+            for keyId, (cells, texts) in groups.items():
+                cipher = self._cipher(keyId)
+                transform = cipher.decryptMessages if self.decrypting else cipher.encryptMessages
+                for (record, field), text in zip(cells, transform(texts)):
+                    record[field] = text
+                self.cells += len(texts)
+
+            self.rows += len(batch)
+            self.batches += 1
+            self.seconds += time.perf_counter() - started
+            yield from batch
+
+    def processCsv(self, infile, outfile):
+        '''
+        Transforms a CSV file with a header row into another with the
+        same columns.  Both files should be opened with newline=''.
+
+        Input:   file:  CSV input
+        Input:   file:  CSV output
+        Output:  dict:  the counters from stats()
+        '''
+        reader = csv.DictReader(infile)
+        writer = csv.DictWriter(outfile, reader.fieldnames or [])
+        if reader.fieldnames:
+            writer.writeheader()
+        # writerows() pulls records a batch at a time through the generator
+        writer.writerows(self.run(reader))
+        return self.stats()
+
+    def processJsonl(self, infile, outfile):
+        '''
+        Transforms a file of JSON objects, one per line, into another.
+        Blank lines are skipped.
+
+        Input:   file:  JSONL input
+        Input:   file:  JSONL output
+        Output:  dict:  the counters from stats()
+        '''
+        records = (json.loads(line) for line in infile if line.strip())
+        for record in self.run(records):
+            outfile.write(json.dumps(record) + '\n')
+        return self.stats()
+
+    def stats(self):
+        '''
+        Returns the pipeline counters.  The time counts only grouping and
+        transforming the batches, not reading, parsing or writing records.
+
+        Output:  dict:  rows, cells, batches, seconds and rows/sec
+        '''
+        return {
+            'rows': self.rows,
+            'cells': self.cells,
+            'batches': self.batches,
+            'seconds': self.seconds,
+            'rowsPerSecond': self.rows / self.seconds if self.seconds else 0.0,
+        }
+
+    def _loadCipher(self, keyId):
+        '''
+        Builds the cipher for a key id; called through the LRU cache.
+        Raises KeyError when the id is unknown.
+
+        Input:   string:          key id
+        Output:  PlayfairCipher:  compiled cipher
+        '''
+        if isinstance(self.keys, KeyRing):
+            return self.keys.cipher(keyId, self.nonAscii)
+        phrase = keyId if self.keys is None else self.keys[keyId]
+        return PlayfairCipher(PlayfairTable(canonicalKey(phrase, self.nonAscii)), self.nonAscii)
+
+def main(argv=None):
+    '''
+    Runs the pipeline from the command line and prints its counters to
+    stderr.
+
+    Input:   list:  command-line arguments (default: sys.argv[1:])
+    Output:  int:   exit status
+    '''
+    parser = argparse.ArgumentParser(description="Encrypt or decrypt fields of a CSV or JSONL file")
+    parser.add_argument('mode', choices=['encrypt', 'decrypt'])
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+    parser.add_argument('--fields', required=True, help="comma-separated fields to transform")
+    parser.add_argument('--key-field', required=True, help="field holding each row's key id")
+    keys = parser.add_mutually_exclusive_group()
+    keys.add_argument('--keyring', help="keyring file the key ids are looked up in")
+    keys.add_argument('--keys', help="JSON file mapping key ids to passphrases")
+    parser.add_argument('-i', '--input', default='-', help="input file (default: stdin)")
+    parser.add_argument('-o', '--output', default='-', help="output file (default: stdout)")
+    parser.add_argument('--batch-size', type=int, default=10000, help="records per batch")
+    parser.add_argument('--non-ascii', choices=['strict', 'drop', 'fold'], default='strict')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.keyring is not None:
+            with KeyRing(args.keyring) as keyring:
+                stats = _runFiles(args, keyring)
+        elif args.keys is not None:
+            with open(args.keys) as keyfile:
+                stats = _runFiles(args, json.load(keyfile))
+        else:
+            stats = _runFiles(args, None)
+    except (KeyError, TypeError, ValueError, OSError) as error:
+        print(f"pipeline: {error}", file=sys.stderr)
+        return 1
+    print(f"{stats['rows']} rows, {stats['cells']} cells in {stats['seconds']:.3f} s "
+          f"({stats['rowsPerSecond']:.0f} rows/sec)", file=sys.stderr)
+    return 0
+
+def _runFiles(args, keys):
+    '''
+    Runs the pipeline over the files named on the command line.
+
+    Input:   Namespace:              parsed arguments
+    Input:   KeyRing, dict or None:  where key ids are looked up
+    Output:  dict:                   the counters from stats()
+    '''
+    pipeline = FieldPipeline(args.fields.split(','), args.key_field, keys, args.mode == 'decrypt',
+                             args.batch_size, args.non_ascii)
+    process = pipeline.processCsv if args.format == 'csv' else pipeline.processJsonl
+
+    infile = sys.stdin if args.input == '-' else open(args.input, newline='', encoding='utf-8')
+    try:
+        outfile = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+        try:
+            return process(infile, outfile)
+        finally:
+            if args.output != '-':
+                outfile.close()
+    finally:
+        if args.input != '-':
+            infile.close()
+
+###############################################################
+
+# Below are the tests for FieldPipeline
+def test_FieldPipeline_matchesPerCell():
+    # Tests mixed keys and small batches against encrypting cell by cell
+    phrases = {'a': "i am entering a pass phrase", 'b': "simple", 'c': "SIMPLE"}
+    records = [{'id': str(i), 'key': 'abc'[i % 3], 'name': f"name number {i}", 'note': "odd" * (i % 4)}
+               for i in range(50)]
+    pipeline = FieldPipeline(['name', 'note'], 'key', phrases, batchSize=7)
+    results = list(pipeline.run(records))
+    for record, result in zip(records, results):
+        cipher = PlayfairCipher(createTable(phrases[record['key']]))
+        assert result['id'] == record['id'] and result['key'] == record['key'], "Other fields should not change."
+        assert result['name'] == cipher.encryptMessage(record['name']), "Wrong ciphertext."
+        assert result['note'] == (cipher.encryptMessage(record['note']) if record['note'] else ''), "Wrong note."
+    assert records[0]['name'] == "name number 0", "The input records should not change."
+    stats = pipeline.stats()
+    assert stats['rows'] == 50 and stats['batches'] == 8 and stats['cells'] == 50 + 37, "Wrong counters."
+    pass
+
+def test_FieldPipeline_csvJsonlRoundTrip():
+    # Tests CSV and JSONL files with key ids from a keyring
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "keys.pfkr")
+        KeyRing.write(path, [('k1', "i am entering a pass phrase"), ('k2', "simple")])
+        with KeyRing(path) as keyring:
+            text = "key,message,other\nk1,this is a test message,1\nk2,hello there,2\nk1,,3\n"
+            encrypted = io.StringIO()
+            FieldPipeline(['message'], 'key', keyring).processCsv(io.StringIO(text, newline=''), encrypted)
+            lines = encrypted.getvalue().splitlines()
+            assert lines[1] == "k1,hjntntirnpginprnpm,1" and lines[3] == "k1,,3", "Wrong CSV output."
+            decrypted = io.StringIO()
+            FieldPipeline(['message'], 'key', keyring, decrypting=True).processCsv(
+                io.StringIO(encrypted.getvalue(), newline=''), decrypted)
+            assert decrypted.getvalue().splitlines()[2] == "k2,helxothere,2", "Failed to decrypt CSV."
+
+            rows = '{"key": "k2", "message": "hello there", "n": 1}\n\n{"key": "k1", "message": null}\n'
+            output = io.StringIO()
+            stats = FieldPipeline(['message'], 'key', keyring).processJsonl(io.StringIO(rows), output)
+            records = [json.loads(line) for line in output.getvalue().splitlines()]
+            expected = PlayfairCipher(createTable("simple")).encryptMessage("hello there")
+            assert records == [{'key': 'k2', 'message': expected, 'n': 1}, {'key': 'k1', 'message': None}], "Wrong JSONL."
+            assert stats['rows'] == 2, "Blank lines should be skipped."
+            try:
+                list(FieldPipeline(['message'], 'key', keyring).run([{'key': 'k9', 'message': "text"}]))
+                assert False, "An unknown key id should fail."
+            except KeyError:
+                pass
+    pass
+
+def test_FieldPipeline_nonStringValues():
+    # Tests that numbers and bools are refused with a clear error, also from the command line
+    for value in (123, True, 4.5, ["text"]):
+        try:
+            list(FieldPipeline(['message'], 'key').run([{'key': "simple", 'message': value}]))
+            assert False, f"{value!r} should be refused."
+        except TypeError as error:
+            assert "'message'" in str(error), "The error should name the field."
+    for value in (5, '', None):
+        try:
+            list(FieldPipeline(['message'], 'key').run([{'key': value, 'message': "text"}]))
+            assert False, f"Key {value!r} should be refused."
+        except TypeError as error:
+            assert str(error).startswith("field 'key'"), "The error should name the key field."
+    try:
+        list(FieldPipeline(['message'], 'key', batchSize=1).run([{'key': "simple"}, {'message': "text"}]))
+        assert False, "A record without a key should be refused."
+    except ValueError as error:
+        assert str(error) == "record 2 has no field 'key'", "The error should name the record."
+    folded = FieldPipeline(['message'], 'key', nonAscii='fold').run([{'key': "café", 'message': "crème"}])
+    assert next(folded)['message'] == PlayfairCipher(createTable("cafe"), 'fold').encryptMessage("creme"), \
+        "The key should be folded like the text."
+    try:
+        list(FieldPipeline(['message'], 'key').run([{'key': "café", 'message': "text"}]))
+        assert False, "A strict pipeline should refuse an accented key."
+    except ValueError:
+        pass
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "rows.jsonl")
+        with open(path, 'w') as outfile:
+            outfile.write('{"key": "simple", "message": 123}\n')
+        stderr, sys.stderr = sys.stderr, io.StringIO()
+        try:
+            status = main(['encrypt', '--format', 'jsonl', '--fields', 'message', '--key-field', 'key',
+                           '-i', path, '-o', os.path.join(folder, "out.jsonl")])
+            message = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+    assert status == 1 and message.startswith("pipeline: field 'message'"), "main() should report the error."
+    pass
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,71 @@
 
-from string import ascii_lowercase
+import argparse
+import array
+import bisect
+import functools
+import io
+import itertools
+import mmap
+import os
+import pickle
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from string import ascii_letters, ascii_lowercase, ascii_uppercase, digits
 
-def createTable(phrase):
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional; without it encryptBatch() uses the lookup table
+    np = None
+
+# Byte tables for filtering ASCII text: the first lowercases letters and
+# the second lists every byte that splitString() would throw away
+_LOWERCASE_BYTES = bytes.maketrans(ascii_uppercase.encode(), ascii_lowercase.encode())
+_DROPPED_BYTES = bytes(code for code in range(256) if chr(code) not in ascii_letters) + b'qQ'
+
+# Inputs shorter than this many letters are looked up pair by pair,
+# which beats the fixed cost of a NumPy gather
+_SMALL_LOOKUP = 96
+
+# What normaliseText() can do with letters that are not ASCII
+_NON_ASCII_POLICIES = ('strict', 'drop', 'fold')
+
+# First bytes of a file written by OffsetIndex.save()
+_INDEX_MAGIC = b'PFIX\x00\x01'
+
+# First bytes of a KeyRing file, the header after them (id size and
+# number of records) and the size of a record without its id
+_KEYRING_MAGIC = b'PFKR\x00\x01'
+_KEYRING_HEADER = struct.Struct('<IQ')
+_KEYRING_RECORD = 25 + 26 + 26 + 1250 + 1250
+
+# The letters of every table, in the order createTable() fills them in
+_ALPHABET = ascii_lowercase.replace('q', '')
+
+def createTable(phrase, nonAscii='strict'):
     '''
     Given an input string, create a lowercase playfair table.  The
     table should include no spaces, no punctuation, no numbers, and 
     no Qs -- just the letters [a-p]+[r-z] in some order.  Note that 
     the input phrase may contain uppercase characters which should 
-    be converted to lowercase.
+    be converted to lowercase.  Letters outside ASCII are handled by
+    the nonAscii policy, so the table always holds the 25 letters.
     
     Input:   string:         a passphrase
+    Input:   string:         'strict', 'drop' or 'fold' (see normaliseText)
     Output:  list of lists:  a ciphertable
     '''
-    # Converts to lowercase and removes non-alpha chars and q
-    phrase = phrase.lower()
-    filtered_phrase = ''.join(filter(str.isalpha, phrase)).replace('q', '')
+    # Converts to lowercase and removes non-alpha chars and q, in one
+    # bytes.translate() pass when the phrase is ASCII
+    filtered_phrase = _filterPhrase(phrase, nonAscii)
     seen = set()
     table = []
 
@@ -45,11 +96,15 @@ def splitString(plaintext):
     Input:   string:  plaintext to be encrypted
     Output:  list:    collection of plaintext bigrams
     '''
-   # Converts to lowercase
-    lowercase_text = plaintext.lower()
-    
-    # Removes non-alphabetic characters and q
-    filtered_text = ''.join(filter(lambda x: x.isalpha() and x != 'q', lowercase_text))
+    # ASCII text is lowercased and filtered in one bytes.translate() pass
+    if plaintext.isascii():
+        filtered_text = plaintext.encode('ascii').translate(_LOWERCASE_BYTES, _DROPPED_BYTES).decode('ascii')
+    else:
+        # Converts to lowercase
+        lowercase_text = plaintext.lower()
+
+        # Removes non-alphabetic characters and q
+        filtered_text = ''.join(filter(lambda x: x.isalpha() and x != 'q', lowercase_text))
     
     # Appends x if the length of the string is odd
     if len(filtered_text) % 2 != 0:
@@ -111,8 +166,8 @@ def playfairRuleTwo(pair, table):
     # Checks if both chars are in the same row
     if first_char_pos[0] == second_char_pos[0]:
         # Wraps around if the character is at the end of the row
-        first_char_new_pos = (first_char_pos[0], (first_char_pos[1] + 1) % 5)
-        second_char_new_pos = (second_char_pos[0], (second_char_pos[1] + 1) % 5)
+        first_char_new_pos = (first_char_pos[0], (first_char_pos[1] + 1) % len(table[first_char_pos[0]]))
+        second_char_new_pos = (second_char_pos[0], (second_char_pos[1] + 1) % len(table[second_char_pos[0]]))
 
         # Replaces chars with the ones to their immediate right
         new_pair = table[first_char_new_pos[0]][first_char_new_pos[1]] + table[second_char_new_pos[0]][second_char_new_pos[1]]
@@ -146,8 +201,8 @@ def playfairRuleThree(pair, table):
            idx1 = col.index(pair[0])
            idx2 = col.index(pair[1])
            # Determines the new chars by wrapping around to the top if necessary
-           new_char1 = transposed_table[col_index][(idx1 + 1) % 5]
-           new_char2 = transposed_table[col_index][(idx2 + 1) % 5]
+           new_char1 = transposed_table[col_index][(idx1 + 1) % len(table)]
+           new_char2 = transposed_table[col_index][(idx2 + 1) % len(table)]
            # Forms the new pair with the charss below the original chars
            new_pair = new_char1 + new_char2
            return new_pair
@@ -206,6 +261,38 @@ def encrypt(pair, table):
     return pair
     pass
 
+def decrypt(pair, table):
+    '''
+    Given a ciphertext pair, undo playfairRuleTwo() to playfairRuleFour():
+    letters on the same row are replaced with the letters to their
+    immediate left, letters in the same column with the letters
+    immediately above (both wrapping around), and otherwise the corners
+    of the rectangle are swapped back.  playfairRuleOne() can't be undone,
+    so a pair that was 'aa' before encrypting decrypts to 'ax'.
+    
+    Input:   string:         ciphertext bigram
+    Input:   list of lists:  ciphertable
+    Output:  string:         plaintext bigram
+    '''
+    # Ciphertext pairs never contain the same letter twice
+    if pair[0] == pair[1]:
+        raise ValueError(f"'{pair}' is not a valid ciphertext pair")
+
+    # Finds the row and column of each letter in the pair
+    pos = {char: (row_idx, row.index(char))
+           for row_idx, row in enumerate(table)
+           for char in row if char in pair}
+    (row1, col1), (row2, col2) = pos[pair[0]], pos[pair[1]]
+
+    if row1 == row2:
+        # Shifts left along the row
+        return table[row1][(col1 - 1) % len(table[row1])] + table[row2][(col2 - 1) % len(table[row2])]
+    if col1 == col2:
+        # Shifts up the column
+        return table[(row1 - 1) % len(table)][col1] + table[(row2 - 1) % len(table)][col2]
+    # Swaps the columns back, keeping the rows the same
+    return table[row1][col2] + table[row2][col1]
+
 def joinPairs(pairsList):
     '''
     Given a list of many encrypted pairs, join them all into the 
@@ -219,6 +306,2323 @@ def joinPairs(pairsList):
     return ciphertext
     pass
 
+def normaliseText(text, nonAscii='strict'):
+    '''
+    Applies the filtering rules of splitString() -- lowercase, letters
+    only, no Qs -- and returns the result as ASCII bytes, ready for the
+    lookup engine.  ASCII input of any kind (str, bytes, bytearray or
+    memoryview) goes through one bytes.translate() call with the
+    precomputed tables above; bytes and bytearray are not copied first.
+    Bytes holding anything else are read as UTF-8.
+    
+    Letters outside ASCII, which str.isalpha() lets through, are handled
+    by the nonAscii policy: 'strict' raises ValueError, 'drop' throws
+    them away like punctuation, and 'fold' keeps the ASCII letter they
+    are built on ('é' becomes 'e') and drops the rest.
+    
+    Input:   string or bytes:  plaintext
+    Input:   string:           'strict', 'drop' or 'fold'
+    Output:  bytes:            filtered plaintext
+    '''
+    return _normaliseWith(text, nonAscii, _LOWERCASE_BYTES, _DROPPED_BYTES)
+
+def _normaliseWith(text, nonAscii, translation, dropped):
+    '''
+    Body of normaliseText() with the byte tables passed in, so a
+    PlayfairVariant can filter to its own letters.
+    
+    Input:   string or bytes:  plaintext
+    Input:   string:           'strict', 'drop' or 'fold'
+    Input:   bytes:            translation table for bytes.translate()
+    Input:   bytes:            bytes to throw away
+    Output:  bytes:            filtered plaintext
+    '''
+    if nonAscii not in _NON_ASCII_POLICIES:
+        raise ValueError(f"unknown non-ASCII policy '{nonAscii}'")
+
+    if isinstance(text, (bytes, bytearray, memoryview)):
+        if isinstance(text, memoryview):
+            text = text.tobytes()
+        # Every non-ASCII byte is already in the delete table, so dropping
+        # needs no decoding
+        if nonAscii == 'drop' or text.isascii():
+            return bytes(text.translate(translation, dropped))
+        text = text.decode('utf-8')
+    elif text.isascii():
+        return text.encode('ascii').translate(translation, dropped)
+
+    # Lowercases first, the same as splitString(), since a few non-ASCII
+    # capitals (like the Kelvin sign) lowercase to ASCII letters
+    lowered = text.lower()
+    if nonAscii == 'fold':
+        lowered = unicodedata.normalize('NFKD', lowered)
+    elif nonAscii == 'strict':
+        if any(char.isalpha() for char in set(lowered) if not char.isascii()):
+            raise ValueError("plaintext contains letters that are not in the table")
+    return lowered.encode('ascii', 'ignore').translate(translation, dropped)
+
+def _filterPhrase(phrase, nonAscii, normalise=normaliseText):
+    '''
+    Filters a passphrase with normaliseText(), or a variant's, with an
+    error that names the passphrase when it has letters outside ASCII
+    under 'strict'.
+    
+    Input:   string:    a passphrase
+    Input:   string:    'strict', 'drop' or 'fold'
+    Input:   function:  filter to use (default: normaliseText)
+    Output:  string:    filtered passphrase
+    '''
+    try:
+        return normalise(phrase, nonAscii).decode('ascii')
+    except ValueError:
+        if nonAscii != 'strict':
+            raise
+        raise ValueError("passphrase contains letters that are not in the table "
+                         "(use the 'fold' or 'drop' policy)") from None
+
+def _utf8Boundary(data, end):
+    '''
+    Returns the largest offset at or before end where no UTF-8
+    character of data is cut in two.
+    
+    Input:   bytes:  UTF-8 text
+    Input:   int:    offset
+    Output:  int:    offset of a character boundary
+    '''
+    start = end
+    # Steps back over continuation bytes (0b10xxxxxx) to the lead byte
+    while start > max(0, end - 4) and 0x80 <= data[start - 1] < 0xC0:
+        start -= 1
+    if start == 0 or data[start - 1] < 0xC0:
+        return end
+    lead = data[start - 1]
+    length = 4 if lead >= 0xF0 else 3 if lead >= 0xE0 else 2
+    return start - 1 if end - start + 1 < length else end
+
+def readChunks(source, chunkSize):
+    '''
+    Yields the pieces of a file object (read chunkSize at a time) or
+    the items of any other iterable of strings.
+    
+    Input:   file or iterable:  text source
+    Input:   int:               size of each read
+    Output:  generator:         pieces of text
+    '''
+    if hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunkSize)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        yield from source
+
+class PlayfairTable:
+    '''
+    A compact, immutable ciphertable.  The 25 letters are kept as one
+    25-byte string, row by row, next to two 26-entry byte arrays that
+    give the row and column of every letter a-z (255 for the letter that
+    is left out).  A table is hashable, compares equal to other tables
+    and to the list-of-lists form with the same letters, and pickles as
+    just its key.
+    
+    It also reads like the list of lists made by createTable(): table[r]
+    is row r as a 5-letter string, table[r][c] is a letter and a slice
+    like table[1:3] is a tuple of rows, so the rule functions accept it
+    unchanged.
+    
+    Input:   string or bytes:  the 25 letters of the table, row by row
+    '''
+    __slots__ = ('key', 'rows', 'cols')
+
+    def __init__(self, key):
+        if isinstance(key, str):
+            if not key.isascii():
+                raise ValueError("a table must hold 25 different ASCII letters")
+            key = key.encode('ascii')
+        key = bytes(key)
+        if len(key) != 25 or len(set(key)) != 25 or not key.isalpha() or not key.islower():
+            raise ValueError("a table must hold 25 different lowercase ASCII letters")
+
+        rows = bytearray(b'\xff' * 26)
+        cols = bytearray(b'\xff' * 26)
+        for index, code in enumerate(key):
+            rows[code - 97], cols[code - 97] = divmod(index, 5)
+
+        object.__setattr__(self, 'key', key)
+        object.__setattr__(self, 'rows', bytes(rows))
+        object.__setattr__(self, 'cols', bytes(cols))
+
+    @classmethod
+    def fromPhrase(cls, phrase):
+        '''
+        Builds the table createTable() would make for a passphrase.
+        
+        Input:   string:         a passphrase
+        Output:  PlayfairTable:  its table
+        '''
+        return cls(canonicalKey(phrase))
+
+    @classmethod
+    def fromList(cls, table):
+        '''
+        Builds a table from the list-of-lists form.  A PlayfairTable is
+        returned as it is, since it can't change.
+        
+        Input:   list of lists:  a ciphertable
+        Output:  PlayfairTable:  the same table
+        '''
+        if isinstance(table, cls):
+            return table
+        return cls(''.join(''.join(row) for row in table))
+
+    def toList(self):
+        '''
+        Returns the table in the list-of-lists form of createTable().
+        
+        Output:  list of lists:  a new ciphertable
+        '''
+        letters = self.letters
+        return [list(letters[i:i+5]) for i in range(0, 25, 5)]
+
+    @property
+    def letters(self):
+        '''
+        The 25 letters of the table, row by row, as a string.
+        '''
+        return self.key.decode('ascii')
+
+    def position(self, char):
+        '''
+        Returns where a letter is in the table.  Raises KeyError for a
+        letter the table does not hold.
+        
+        Input:   string:  a lowercase letter
+        Output:  tuple:   (row, col)
+        '''
+        code = ord(char) - 97
+        if not 0 <= code < 26 or self.rows[code] == 255:
+            raise KeyError(char)
+        return self.rows[code], self.cols[code]
+
+    def __getitem__(self, row):
+        # A slice gives a tuple of row strings, as the table is immutable
+        if isinstance(row, slice):
+            return tuple(self[index] for index in range(5)[row])
+        if not -5 <= row < 5:
+            raise IndexError("table row out of range")
+        row %= 5
+        return self.key[row * 5:row * 5 + 5].decode('ascii')
+
+    def __len__(self):
+        return 5
+
+    def __iter__(self):
+        letters = self.letters
+        return (letters[i:i+5] for i in range(0, 25, 5))
+
+    def __eq__(self, other):
+        if isinstance(other, PlayfairTable):
+            return self.key == other.key
+        if isinstance(other, list):
+            return self.toList() == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PlayfairTable is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("PlayfairTable is immutable")
+
+    def __reduce__(self):
+        # Pickles as the 25-byte key; the position arrays are rebuilt
+        return (PlayfairTable, (self.key,))
+
+    def __repr__(self):
+        return f"PlayfairTable({self.letters!r})"
+
+class PlayfairCipher:
+    '''
+    A compiled playfair cipher.  It is built once from a table made by
+    createTable() and precomputes the (row, col) position of every
+    letter plus the ciphertext of all 625 possible bigrams, so that
+    encrypting a pair is a single lookup instead of four table scans.
+    It also keeps the inverse table, mapping each of the 600 possible
+    ciphertext bigrams back to its plaintext, for decryption.
+    
+    The bigram tables are filled in by running encrypt() and decrypt()
+    themselves on every pair, so the output is byte-for-byte the same as
+    the rule functions.  Letters outside ASCII in the input are handled
+    by the given normaliseText() policy.
+    
+    Input:   list of lists or PlayfairTable:  a ciphertable
+    Input:   string:  'strict', 'drop' or 'fold' (see normaliseText)
+    '''
+    # Letter that pads a plaintext with an odd number of letters
+    _padding = b'x'
+
+    def __init__(self, table, nonAscii='strict'):
+        instrumentation = _instrumentation
+        if instrumentation is not None:
+            start = time.perf_counter()
+
+        if nonAscii not in _NON_ASCII_POLICIES:
+            raise ValueError(f"unknown non-ASCII policy '{nonAscii}'")
+        self.nonAscii = nonAscii
+
+        # Keeps an immutable copy so later changes to the table can't leak in
+        self.table = PlayfairTable.fromList(table)
+        self.letters = self.table.letters
+
+        # Maps every letter to its (row, col) in the table
+        self.positions = {char: self.table.position(char) for char in self.letters}
+
+        # Runs every possible bigram through the reference rules once,
+        # bypassing instrumentation so building isn't counted as traffic.
+        # The rules scan the table, which is quickest in list form.
+        encryptPair = _reference('encrypt')
+        listTable = self.table.toList()
+        self.bigrams = {first + second: encryptPair(first + second, listTable)
+                        for first in self.letters
+                        for second in self.letters}
+
+        # Which rules each bigram goes through, for instrumentation
+        self.ruleCodes = {pair: _ruleCode(pair, self.positions) for pair in self.bigrams}
+
+        # Ciphertext never holds a doubled letter, so only 600 pairs can be decrypted
+        self.plainBigrams = {first + second: decrypt(first + second, listTable)
+                             for first in self.letters
+                             for second in self.letters
+                             if first != second}
+
+        self._compileArrays()
+
+        if instrumentation is not None:
+            instrumentation.addStage('PlayfairCipher', time.perf_counter() - start)
+
+    @classmethod
+    def fromCompiled(cls, table, bigramBytes, plainBytes, nonAscii='strict'):
+        '''
+        Builds a cipher from bigram tables compiled earlier, such as the
+        ones kept in a KeyRing, without running the rule functions.  Each
+        holds 1250 bytes: the two output letters of bigram first*25+second,
+        with letters in table order, and b'\0\0' for doubled pairs in the
+        decryption table.  With NumPy the arrays use the given buffers
+        without copying them, and bigrams, plainBigrams and ruleCodes are
+        only filled in from them if something asks for them.
+        
+        Input:   PlayfairTable:  ciphertable
+        Input:   buffer:         encryption table
+        Input:   buffer:         decryption table
+        Input:   string:         'strict', 'drop' or 'fold' (see normaliseText)
+        Output:  PlayfairCipher: compiled cipher
+        '''
+        if nonAscii not in _NON_ASCII_POLICIES:
+            raise ValueError(f"unknown non-ASCII policy '{nonAscii}'")
+        cipher = cls.__new__(cls)
+        cipher.nonAscii = nonAscii
+        cipher.table = PlayfairTable.fromList(table)
+        cipher.letters = cipher.table.letters
+        cipher.positions = {char: cipher.table.position(char) for char in cipher.letters}
+        if np is None:
+            # Without NumPy the dicts are the lookup tables, so they are needed now
+            cipher.bigrams = cipher._unpack(bigramBytes)
+            cipher.plainBigrams = cipher._unpack(plainBytes)
+        cipher._compileArrays(bigramBytes, plainBytes)
+        return cipher
+
+    @functools.cached_property
+    def bigrams(self):
+        '''
+        The ciphertext of every bigram.  __init__() fills it in; a cipher
+        from fromCompiled() builds it from its arrays on first use.
+        '''
+        return self._unpack(self._bigramBytes)
+
+    @functools.cached_property
+    def plainBigrams(self):
+        '''
+        The plaintext of every bigram without a doubled letter, filled in
+        like bigrams.
+        '''
+        return self._unpack(self._plainBytes)
+
+    @functools.cached_property
+    def ruleCodes(self):
+        '''
+        Which rules each bigram goes through, for instrumentation, filled
+        in like bigrams.
+        '''
+        return {pair: _ruleCode(pair, self.positions) for pair in self.bigrams}
+
+    @functools.cached_property
+    def _ruleArray(self):
+        '''
+        ruleCodes as an array in table order, for counting the rules of a
+        whole batch at once.
+        '''
+        return np.array([self.ruleCodes[first + second] for first in self.letters for second in self.letters],
+                        dtype=np.uint8)
+
+    def _unpack(self, packed):
+        '''
+        Reads a packed bigram table back into a dict, leaving out the
+        doubled pairs of a decryption table.
+        
+        Input:   buffer:  two output bytes per bigram, in table order
+        Output:  dict:    bigram to output bigram
+        '''
+        text = bytes(packed).decode('ascii')
+        pairs = (first + second for first in self.letters for second in self.letters)
+        return {pair: text[2 * i:2 * i + 2] for i, pair in enumerate(pairs) if text[2 * i] != '\0'}
+
+    def _compileArrays(self, bigramBytes=None, plainBytes=None):
+        '''
+        Packs the bigram tables into the NumPy arrays used by _lookup(),
+        or uses the packed tables given.
+        
+        Input:   buffer:  encryption table made earlier (optional)
+        Input:   buffer:  decryption table made earlier (optional)
+        '''
+        if np is not None:
+            # Maps byte values to letter indexes (255 marks "not in table")
+            self._indexes = np.full(256, 255, dtype=np.uint8)
+            self._indexes[np.frombuffer(self.letters.encode('ascii'), dtype=np.uint8)] = np.arange(len(self.letters))
+
+            # Row first*n+second, for n letters, holds the two output bytes of
+            # that bigram; doubled pairs get b'\0\0' in the decryption table
+            if bigramBytes is None:
+                pairs = [first + second for first in self.letters for second in self.letters]
+                bigramBytes = ''.join(self.bigrams[pair] for pair in pairs).encode('ascii')
+                plainBytes = ''.join(self.plainBigrams.get(pair, '\0\0') for pair in pairs).encode('ascii')
+            self._bigramBytes = np.frombuffer(bigramBytes, dtype=np.uint8).reshape(-1, 2)
+            self._plainBytes = np.frombuffer(plainBytes, dtype=np.uint8).reshape(-1, 2)
+
+    def encrypt(self, pair):
+        '''
+        Encrypts a single lowercase bigram with one lookup.  While
+        instrumentation is on, the pair is counted against its rules.
+        
+        Input:   string:  plaintext bigram
+        Output:  string:  ciphertext bigram
+        '''
+        return self.bigrams[pair]
+
+    def decrypt(self, pair):
+        '''
+        Decrypts a single lowercase ciphertext bigram with one lookup.
+        
+        Input:   string:  ciphertext bigram
+        Output:  string:  plaintext bigram
+        '''
+        return self.plainBigrams[pair]
+
+    def encryptPairs(self, pairs):
+        '''
+        Encrypts a list of bigrams, such as the output of splitString().
+        While instrumentation is on, the time taken is recorded as a
+        lookup and every pair is counted against its rules.
+        
+        Input:   list:  collection of plaintext bigrams
+        Output:  list:  collection of ciphertext bigrams
+        '''
+        bigrams = self.bigrams
+        return [bigrams[pair] for pair in pairs]
+
+    def decryptPairs(self, pairs):
+        '''
+        Decrypts a list of ciphertext bigrams.
+        
+        Input:   list:  collection of ciphertext bigrams
+        Output:  list:  collection of plaintext bigrams
+        '''
+        plainBigrams = self.plainBigrams
+        return [plainBigrams[pair] for pair in pairs]
+
+    def encryptMessage(self, plaintext):
+        '''
+        Runs the whole pipeline on a message one pair at a time and
+        returns the ciphertext.  The message is filtered like the batch
+        methods filter it, under the cipher's non-ASCII policy, so
+        'strict' raises ValueError for letters outside ASCII.
+        
+        Input:   string:  plaintext to be encrypted
+        Output:  string:  ciphertext
+        '''
+        filtered = self._normalise(plaintext)
+        # Appends x if the length of the filtered text is odd
+        if len(filtered) % 2 != 0:
+            filtered += self._padding
+        filtered = filtered.decode('ascii')
+        return joinPairs(self.encryptPairs([filtered[i:i+2] for i in range(0, len(filtered), 2)]))
+
+    def decryptMessage(self, ciphertext):
+        '''
+        Decrypts a whole ciphertext.  Anything that is not a letter is
+        ignored, the same way splitString() ignores it.  Doubled letters
+        and padding added when encrypting can't be told apart from real
+        text, so the result is the plaintext as encrypt() saw it.
+        
+        Input:   string:  ciphertext
+        Output:  string:  plaintext
+        '''
+        filtered = self._normalise(ciphertext).decode('ascii')
+        if len(filtered) % 2 != 0:
+            raise ValueError("ciphertext has an odd number of letters")
+        try:
+            return joinPairs(self.decryptPairs([filtered[i:i+2] for i in range(0, len(filtered), 2)]))
+        except KeyError:
+            raise ValueError("ciphertext contains a doubled pair or letters that are not in the table") from None
+
+    def encryptBatch(self, plaintext):
+        '''
+        Encrypts a whole message at once with NumPy.  The filtered text
+        becomes an array of letter indexes, every bigram is turned into a
+        row number of the precomputed 625-entry table, and the ciphertext
+        is gathered in one step without making any per-pair strings.
+        Doubled letters land on the diagonal of that table, which already
+        holds the result of playfairRuleOne().  The output is the same as
+        encryptMessage(); without NumPy the pairs are looked up one by one.
+        
+        Input:   string:  plaintext to be encrypted
+        Output:  string:  ciphertext
+        '''
+        filtered = self._normalise(plaintext)
+        # Appends x if the length of the filtered text is odd
+        if len(filtered) % 2 != 0:
+            filtered += self._padding
+        return self._encryptFiltered(filtered)
+
+    def decryptBatch(self, ciphertext):
+        '''
+        Decrypts a whole ciphertext at once with NumPy, the same way
+        encryptBatch() encrypts.  The output is the same as
+        decryptMessage(); without NumPy the pairs are looked up one by one.
+        
+        Input:   string:  ciphertext
+        Output:  string:  plaintext
+        '''
+        filtered = self._normalise(ciphertext)
+        if len(filtered) % 2 != 0:
+            raise ValueError("ciphertext has an odd number of letters")
+        return self._decryptFiltered(filtered)
+
+    def encryptMessages(self, messages):
+        '''
+        Encrypts many separate messages with one call to the lookup
+        engine.  Each message is filtered and padded on its own, the
+        results are joined, encrypted together and cut apart again, so
+        every entry matches encryptMessage() on that message.
+        
+        Input:   list:  plaintexts
+        Output:  list:  ciphertexts, in the same order
+        '''
+        return self._transformMessages(messages, self._encryptFiltered, self._padding)
+
+    def decryptMessages(self, messages):
+        '''
+        Decrypts many separate ciphertexts with one call to the lookup
+        engine, the same way encryptMessages() encrypts them.
+        
+        Input:   list:  ciphertexts
+        Output:  list:  plaintexts, in the same order
+        '''
+        return self._transformMessages(messages, self._decryptFiltered, None)
+
+    def encryptStream(self, source, chunkSize=1 << 16):
+        '''
+        Encrypts text from a file object or an iterable of strings piece
+        by piece, yielding ciphertext as soon as it is ready.  A dangling
+        odd letter is carried over to the next chunk, and an 'x' is only
+        added at the true end of the input, so joining everything that is
+        yielded gives the same result as encryptMessage() on the whole
+        text while only one chunk is held in memory at a time.  Bytes are
+        read as UTF-8, and a character cut in two by a chunk is carried
+        over the same way.
+        
+        Input:   file or iterable:  text (or UTF-8 bytes) to be encrypted
+        Input:   int:               characters read from a file at a time
+        Output:  generator:         ciphertext pieces
+        '''
+        return self._stream(source, chunkSize, False)
+
+    def decryptStream(self, source, chunkSize=1 << 16):
+        '''
+        Decrypts ciphertext from a file object or an iterable of strings
+        piece by piece, like encryptStream().  Raises ValueError at the end
+        if the ciphertext had an odd number of letters.
+        
+        Input:   file or iterable:  ciphertext (or UTF-8 bytes)
+        Input:   int:               characters read from a file at a time
+        Output:  generator:         plaintext pieces
+        '''
+        return self._stream(source, chunkSize, True)
+
+    def encryptFile(self, infile, outfile, chunkSize=1 << 16, index=None, indexInterval=None):
+        '''
+        Encrypts everything read from one file object and writes the
+        ciphertext to another as it goes, using encryptStream().  When
+        an OffsetIndex is given, a checkpoint is added every
+        indexInterval bytes or characters of input (by default every
+        chunkSize), whatever size the reads are.
+        
+        Input:   file:         plaintext source opened for reading
+        Input:   file:         text file opened for writing
+        Input:   int:          characters read at a time
+        Input:   OffsetIndex:  index to fill in (optional)
+        Input:   int:          spacing of the index checkpoints (default: chunkSize)
+        Output:  int:          number of ciphertext characters written
+        '''
+        if index is None:
+            return _writePieces(self.encryptStream(infile, chunkSize), outfile)
+        interval = indexInterval or chunkSize
+        if interval < 1:
+            raise ValueError("indexInterval must be at least 1")
+
+        session = self.encryptSession()
+        written = 0
+        offset = 0
+        checkpoint = 0
+        for chunk in readChunks(infile, chunkSize):
+            # Feeds the chunk in pieces that end on the checkpoints
+            start = 0
+            while start < len(chunk):
+                if offset + start == checkpoint:
+                    # Bytes of a character cut in two belong after the checkpoint
+                    index.add(checkpoint - len(session._carry), session.letters)
+                    checkpoint += interval
+                stop = min(len(chunk), checkpoint - offset)
+                piece = session.feed(chunk[start:stop])
+                outfile.write(piece)
+                written += len(piece)
+                start = stop
+            offset += len(chunk)
+        piece = session.finish()
+        outfile.write(piece)
+        written += len(piece)
+        index.add(offset, written)
+        return written
+
+    def decryptFile(self, infile, outfile, chunkSize=1 << 16):
+        '''
+        Decrypts everything read from one file object and writes the
+        plaintext to another as it goes, using decryptStream().
+        
+        Input:   file:  ciphertext source opened for reading
+        Input:   file:  text file opened for writing
+        Input:   int:   characters read at a time
+        Output:  int:   number of plaintext characters written
+        '''
+        return _writePieces(self.decryptStream(infile, chunkSize), outfile)
+
+    def encryptSession(self):
+        '''
+        Starts an incremental encryption; see PlayfairSession.
+        
+        Output:  PlayfairSession:  new session
+        '''
+        return PlayfairSession(self)
+
+    def decryptSession(self):
+        '''
+        Starts an incremental decryption; see PlayfairSession.
+        
+        Output:  PlayfairSession:  new session
+        '''
+        return PlayfairSession(self, True)
+
+    def _transformMessages(self, messages, transform, padding):
+        '''
+        Shared body of encryptMessages() and decryptMessages().  A message
+        with an odd number of letters is padded with the given byte, or is
+        an error when padding is None.
+        
+        Input:   list:           messages
+        Input:   function:       _encryptFiltered or _decryptFiltered
+        Input:   bytes or None:  padding letter
+        Output:  list:           output texts, in the same order
+        '''
+        pieces = []
+        for message in messages:
+            filtered = self._normalise(message)
+            if len(filtered) % 2 != 0:
+                if padding is None:
+                    raise ValueError("ciphertext has an odd number of letters")
+                filtered += padding
+            pieces.append(filtered)
+
+        joined = transform(b''.join(pieces))
+        results = []
+        offset = 0
+        for piece in pieces:
+            results.append(joined[offset:offset + len(piece)])
+            offset += len(piece)
+        return results
+
+    def _stream(self, source, chunkSize, decrypting):
+        '''
+        Shared loop of encryptStream() and decryptStream(), feeding each
+        chunk through a PlayfairSession.
+        
+        Input:   file or iterable:  text source
+        Input:   int:               characters read at a time
+        Input:   bool:              True to decrypt, False to encrypt
+        Output:  generator:         output pieces
+        '''
+        session = PlayfairSession(self, decrypting)
+        for chunk in readChunks(source, chunkSize):
+            piece = session.feed(chunk)
+            if piece:
+                yield piece
+        piece = session.finish()
+        if piece:
+            yield piece
+
+    def _normalise(self, text):
+        '''
+        Filters text for the lookup engine with normaliseText().
+        
+        Input:   string or bytes:  text
+        Output:  bytes:            filtered text
+        '''
+        return normaliseText(text, self.nonAscii)
+
+    def _encryptFiltered(self, filtered, out=None):
+        '''
+        Encrypts filtered text of even length, as made by normaliseText().
+        
+        Input:   bytes:   filtered plaintext
+        Input:   buffer:  writable buffer to put the ciphertext in (optional)
+        Output:  string:  ciphertext, or None when it went into out
+        '''
+        try:
+            return self._lookup(filtered, self.bigrams, '_bigramBytes', True, out)
+        except KeyError:
+            raise ValueError("plaintext contains letters that are not in the table") from None
+
+    def _decryptFiltered(self, filtered, out=None):
+        '''
+        Decrypts filtered ciphertext of even length.
+        
+        Input:   bytes:   filtered ciphertext
+        Input:   buffer:  writable buffer to put the plaintext in (optional)
+        Output:  string:  plaintext, or None when it went into out
+        '''
+        try:
+            return self._lookup(filtered, self.plainBigrams, '_plainBytes', False, out)
+        except KeyError:
+            raise ValueError("ciphertext contains a doubled pair or letters that are not in the table") from None
+
+    def _lookup(self, filtered, bigrams, pairBytes, encrypting=False, out=None):
+        '''
+        Replaces every bigram of some filtered text through a lookup
+        table, with NumPy when it is there and the text is long enough to
+        be worth it.  Raises KeyError for a pair the table does not hold.
+        When a writable buffer of the same length is given, the output is
+        written straight into it instead of being returned.  While
+        instrumentation is on, the time taken and (when encrypting) the
+        rules each pair went through are recorded.
+        
+        Input:   bytes:   filtered text of even length
+        Input:   dict:    bigram table for short text or without NumPy
+        Input:   string:  name of the matching 625x2 byte array
+        Input:   bool:    True when the text is plaintext being encrypted
+        Input:   buffer:  where to write the output (optional)
+        Output:  string:  replaced text, or None when it went into out
+        '''
+        if np is None or (out is None and len(filtered) < _SMALL_LOOKUP):
+            text = str(filtered, 'ascii')
+            output = ''.join([bigrams[text[i:i+2]] for i in range(0, len(text), 2)])
+            if out is not None:
+                out[:len(output)] = output.encode('ascii')
+                output = None
+        else:
+            indexes = self._indexes[np.frombuffer(filtered, dtype=np.uint8)]
+            if indexes.size and indexes.max() == 255:
+                raise KeyError("letter not in table")
+
+            rows = indexes[0::2].astype(np.intp) * len(self.letters) + indexes[1::2]
+            if out is None:
+                output = getattr(self, pairBytes)[rows]
+            else:
+                # Gathers straight into the caller's buffer
+                output = np.frombuffer(out, dtype=np.uint8, count=2 * len(rows)).reshape(-1, 2)
+                np.take(getattr(self, pairBytes), rows, axis=0, out=output)
+            # Only the decryption table has empty rows, for doubled pairs
+            if output.size and not output[:, 0].all():
+                raise KeyError("doubled pair")
+            output = output.tobytes().decode('ascii') if out is None else None
+        return output
+
+class PlayfairCascade(PlayfairCipher):
+    '''
+    A cascade of playfair rounds, each with its own table, where the
+    ciphertext of one round is the plaintext of the next.  Every round
+    keeps the pairs lined up and maps each of the 625 bigrams to another
+    bigram, so the rounds are composed here into one 625-entry table
+    (and one inverse table) up front.  Encrypting with any number of
+    rounds then costs the same as one, and all the methods of
+    PlayfairCipher work unchanged.
+    
+    The composed table is filled in by following every bigram through
+    each round's own table, so doubled letters are handled by
+    playfairRuleOne() in the first round exactly as they are when the
+    rounds run one by one.  Instrumentation counts the rules of the
+    first round.
+    
+    Input:   list:    ciphertables, first round first
+    Input:   string:  'strict', 'drop' or 'fold' (see normaliseText)
+    '''
+    def __init__(self, tables, nonAscii='strict'):
+        instrumentation = _instrumentation
+        if instrumentation is not None:
+            start = time.perf_counter()
+
+        self.rounds = [PlayfairCipher(table, nonAscii) for table in tables]
+        if not self.rounds:
+            raise ValueError("a cascade needs at least one table")
+        first = self.rounds[0]
+        if any(set(cipher.letters) != set(first.letters) for cipher in self.rounds):
+            raise ValueError("every table of a cascade must hold the same letters")
+
+        self.nonAscii = nonAscii
+        self.table = first.table
+        self.letters = first.letters
+        self.positions = first.positions
+        self.ruleCodes = first.ruleCodes
+
+        # Follows every bigram through the rounds in turn
+        self.bigrams = {}
+        for pair in first.bigrams:
+            output = pair
+            for cipher in self.rounds:
+                output = cipher.bigrams[output]
+            self.bigrams[pair] = output
+
+        # Decryption undoes the rounds in reverse order
+        self.plainBigrams = {}
+        for pair in first.plainBigrams:
+            output = pair
+            for cipher in reversed(self.rounds):
+                output = cipher.plainBigrams[output]
+            self.plainBigrams[pair] = output
+
+        self._compileArrays()
+
+        if instrumentation is not None:
+            instrumentation.addStage('PlayfairCascade', time.perf_counter() - start)
+
+class PlayfairVariant:
+    '''
+    Describes a variant of the playfair table: the letters it holds, in
+    the order they fill in after the passphrase, the number of rows and
+    columns, letters that are read as other letters before anything
+    else (the classic table reads 'j' as 'i'), and the padding letters.
+    Anything else, like 'q' in the default variant, is dropped the way
+    splitString() drops it.  padding is added to a message with an odd
+    number of letters and replaces the second letter of a doubled pair,
+    as in playfairRuleOne(); fallback replaces it when the first letter
+    is the padding letter itself.
+    
+    PlayfairVariant() is the q-less 5x5 table of createTable().  classic()
+    gives the 5x5 table with I and J merged and alphanumeric() the 6x6
+    table of letters and digits.  cipher() compiles a table of the
+    variant into the same lookup engine as PlayfairCipher.
+    
+    Input:   string:  letters of the table, in fill order
+    Input:   int:     number of rows and columns
+    Input:   dict:    letters read as other letters, like {'j': 'i'}
+    Input:   string:  padding letter
+    Input:   string:  padding letter used after a doubled padding letter
+    '''
+    def __init__(self, alphabet=_ALPHABET, size=5, merged=None, padding='x', fallback='z'):
+        merged = dict(merged or {})
+        if len(alphabet) != size * size or len(set(alphabet)) != len(alphabet):
+            raise ValueError(f"alphabet must hold {size * size} different letters")
+        if not (alphabet.isascii() and alphabet.isalnum() and alphabet == alphabet.lower()):
+            raise ValueError("alphabet must hold lowercase ASCII letters and digits")
+        if padding == fallback or padding not in alphabet or fallback not in alphabet:
+            raise ValueError("padding and fallback must be two different letters of the alphabet")
+        for source, target in merged.items():
+            if len(source) != 1 or not source.isascii() or source.lower() in alphabet or target not in alphabet:
+                raise ValueError(f"can't merge '{source}' into '{target}'")
+        self.alphabet = alphabet
+        self.size = size
+        self.merged = merged
+        self.padding = padding
+        self.fallback = fallback
+
+        # Byte tables for normaliseText(): lowercase and merge, then drop
+        # every byte that does not end up as a letter of the table
+        translation = bytearray(_LOWERCASE_BYTES)
+        for source, target in merged.items():
+            translation[ord(source.lower())] = translation[ord(source.upper())] = ord(target)
+        self._translation = bytes(translation)
+        self._dropped = bytes(code for code in range(256) if chr(translation[code]) not in alphabet)
+
+    @classmethod
+    def classic(cls):
+        '''
+        Returns the classic 5x5 variant, where 'j' is read as 'i'.
+        
+        Output:  PlayfairVariant:  variant
+        '''
+        return cls(ascii_lowercase.replace('j', ''), merged={'j': 'i'})
+
+    @classmethod
+    def alphanumeric(cls):
+        '''
+        Returns the 6x6 variant holding the 26 letters and 10 digits.
+        
+        Output:  PlayfairVariant:  variant
+        '''
+        return cls(ascii_lowercase + digits, size=6)
+
+    def normaliseText(self, text, nonAscii='strict'):
+        '''
+        Filters text down to the letters of the variant, like the module
+        function normaliseText() does for the default table.
+        
+        Input:   string or bytes:  text
+        Input:   string:           'strict', 'drop' or 'fold'
+        Output:  bytes:            filtered text
+        '''
+        return _normaliseWith(text, nonAscii, self._translation, self._dropped)
+
+    def createTable(self, phrase, nonAscii='strict'):
+        '''
+        Makes a table of the variant from a passphrase, the way
+        createTable() does: the letters of the phrase the first time each
+        shows up, then the rest of the alphabet.  Letters outside ASCII
+        in the phrase are handled by the nonAscii policy, as there.
+        
+        Input:   string:         passphrase
+        Input:   string:         'strict', 'drop' or 'fold' (see normaliseText)
+        Output:  list of lists:  ciphertable
+        '''
+        key = ''.join(dict.fromkeys(_filterPhrase(phrase, nonAscii, self.normaliseText) + self.alphabet))
+        return [list(key[row * self.size:(row + 1) * self.size]) for row in range(self.size)]
+
+    def splitString(self, plaintext):
+        '''
+        Filters a message and splits it into bigrams, padding an odd one.
+        
+        Input:   string:  plaintext
+        Output:  list:    bigrams
+        '''
+        filtered = self.normaliseText(plaintext).decode('ascii')
+        if len(filtered) % 2 != 0:
+            filtered += self.padding
+        return [filtered[i:i+2] for i in range(0, len(filtered), 2)]
+
+    def playfairRuleOne(self, pair):
+        '''
+        playfairRuleOne() with the padding letters of the variant.
+        
+        Input:   string:  plaintext bigram
+        Output:  string:  potentially modified bigram
+        '''
+        if pair[0] != pair[1]:
+            return pair
+        return pair[0] + (self.fallback if pair[0] == self.padding else self.padding)
+
+    def encrypt(self, pair, table):
+        '''
+        encrypt() for a table of the variant: its own rule one, then
+        playfairRuleTwo() to playfairRuleFour(), which wrap around the
+        size of the table.
+        
+        Input:   string:         plaintext bigram
+        Input:   list of lists:  ciphertable
+        Output:  string:         ciphertext bigram
+        '''
+        pair = self.playfairRuleOne(pair)
+        pair = playfairRuleTwo(pair, table)
+        pair = playfairRuleThree(pair, table)
+        pair = playfairRuleFour(pair, table)
+        return pair
+
+    def cipher(self, phrase, nonAscii='strict'):
+        '''
+        Makes the table of a passphrase and compiles it, with the same
+        non-ASCII policy for the passphrase and the text.
+        
+        Input:   string:  passphrase
+        Input:   string:  'strict', 'drop' or 'fold' (see normaliseText)
+        Output:  PlayfairVariantCipher:  compiled cipher
+        '''
+        return PlayfairVariantCipher(self.createTable(phrase, nonAscii), self, nonAscii)
+
+class PlayfairVariantCipher(PlayfairCipher):
+    '''
+    A compiled cipher for a table of any PlayfairVariant.  Every bigram
+    of the table is run through the variant's rules once, and the result
+    is packed into the same lookup tables as PlayfairCipher, so the
+    batch, message, stream, session and file methods all work unchanged
+    and just as fast.  Text is filtered and padded the variant's way.
+    The parallel file functions, SharedMemoryPool and KeyRing only hold
+    the default table.
+    
+    Input:   list of lists:    ciphertable made by variant.createTable()
+    Input:   PlayfairVariant:  variant of the table (default: PlayfairVariant())
+    Input:   string:  'strict', 'drop' or 'fold' (see normaliseText)
+    '''
+    def __init__(self, table, variant=None, nonAscii='strict'):
+        instrumentation = _instrumentation
+        if instrumentation is not None:
+            start = time.perf_counter()
+
+        if nonAscii not in _NON_ASCII_POLICIES:
+            raise ValueError(f"unknown non-ASCII policy '{nonAscii}'")
+        self.variant = variant or PlayfairVariant()
+        self.nonAscii = nonAscii
+        self._padding = self.variant.padding.encode('ascii')
+
+        # Keeps a copy so later changes to the table can't leak in
+        self.table = [list(row) for row in table]
+        self.letters = ''.join(''.join(row) for row in self.table)
+        if len(self.table) != self.variant.size or any(len(row) != self.variant.size for row in self.table) \
+                or sorted(self.letters) != sorted(self.variant.alphabet):
+            raise ValueError("table does not hold the letters of its variant")
+        self.positions = {char: (row, col) for row, line in enumerate(self.table) for col, char in enumerate(line)}
+
+        self.bigrams = {first + second: self.variant.encrypt(first + second, self.table)
+                        for first in self.letters
+                        for second in self.letters}
+        self.ruleCodes = {pair: _ruleCode(pair, self.positions, self.variant.playfairRuleOne)
+                          for pair in self.bigrams}
+        self.plainBigrams = {first + second: decrypt(first + second, self.table)
+                             for first in self.letters
+                             for second in self.letters
+                             if first != second}
+
+        self._compileArrays()
+
+        if instrumentation is not None:
+            instrumentation.addStage('PlayfairVariantCipher', time.perf_counter() - start)
+
+    def _normalise(self, text):
+        '''
+        Filters text for the lookup engine with the variant's tables.
+        
+        Input:   string or bytes:  text
+        Output:  bytes:            filtered text
+        '''
+        return self.variant.normaliseText(text, self.nonAscii)
+
+# The table variants "python -m playfair --variant" knows
+_VARIANTS = {'default': PlayfairVariant, 'classic': PlayfairVariant.classic,
+             'alphanumeric': PlayfairVariant.alphanumeric}
+
+class PlayfairSession:
+    '''
+    An incremental encryptor (or decryptor) for text that arrives a few
+    characters at a time, such as chat or log streams.  Each call to
+    feed() returns the output of every bigram completed so far, and the
+    one letter still waiting for a partner is kept until the next call,
+    so the work per call is proportional to the fragment.  finish()
+    pads that last letter with an 'x'.  All the output joined together
+    matches encryptMessage() on the whole input.
+    
+    Bytes fragments are read as UTF-8, and a character cut in two by a
+    fragment is kept back the same way.  str and bytes fragments can be
+    mixed, except that a character cut at the end of a bytes fragment
+    must be finished by the next bytes fragment.  The letters attribute
+    counts the letters taken in so far.  Use encryptSession() or
+    decryptSession() on a PlayfairCipher to make one.
+    
+    Input:   PlayfairCipher:  compiled cipher
+    Input:   bool:            True to decrypt, False to encrypt
+    '''
+    def __init__(self, cipher, decrypting=False):
+        self.cipher = cipher
+        self.decrypting = decrypting
+        self.finished = False
+        self._transform = cipher._decryptFiltered if decrypting else cipher._encryptFiltered
+        self.letters = 0
+        self._pending = b''
+        self._carry = b''
+
+    def feed(self, text):
+        '''
+        Adds a fragment and returns the output of the bigrams it
+        completes, which may be empty.
+        
+        Input:   string or bytes:  next fragment
+        Output:  string:           output ready so far
+        '''
+        if self.finished:
+            raise ValueError("session is already finished")
+
+        if isinstance(text, str):
+            # Text can't hold the rest of a UTF-8 character, so it would
+            # end up after letters that came later
+            if self._carry:
+                raise ValueError("a str fragment can't finish the character cut at the end of the last bytes fragment")
+        else:
+            if isinstance(text, memoryview):
+                text = text.tobytes()
+            if self._carry:
+                text = self._carry + text
+                self._carry = b''
+            if not text.isascii():
+                # Keeps back a character that is cut in two at the end
+                cut = _utf8Boundary(text, len(text))
+                text, self._carry = text[:cut], text[cut:]
+
+        filtered = self.cipher._normalise(text)
+        self.letters += len(filtered)
+        if self._pending:
+            filtered = self._pending + filtered
+        # Holds back the last letter if it has no partner yet
+        cut = len(filtered) - len(filtered) % 2
+        self._pending = filtered[cut:]
+        return self._transform(filtered[:cut]) if cut else ''
+
+    def finish(self):
+        '''
+        Ends the session and returns the rest of the output.  When
+        encrypting, a leftover letter is padded with an 'x'; when
+        decrypting it is an error.
+        
+        Output:  string:  the last of the output
+        '''
+        if self.finished:
+            raise ValueError("session is already finished")
+        self.finished = True
+
+        # A character still cut short here is a decoding error
+        if self._carry:
+            self.cipher._normalise(self._carry)
+        if not self._pending:
+            return ''
+        if self.decrypting:
+            raise ValueError("ciphertext has an odd number of letters")
+        return self._transform(self._pending + self.cipher._padding)
+
+def _writePieces(pieces, outfile):
+    '''
+    Writes pieces of text to a file object as they come.
+    
+    Input:   iterable:  pieces of text
+    Input:   file:      text file opened for writing
+    Output:  int:       number of characters written
+    '''
+    written = 0
+    for piece in pieces:
+        outfile.write(piece)
+        written += len(piece)
+    return written
+
+# State of the instrumentation layer; None while it is turned off
+_instrumentation = None
+
+# Module functions that enableInstrumentation() wraps with timers
+_TIMED_STAGES = ('createTable', 'splitString', 'encrypt', 'joinPairs')
+
+# Lookup methods of PlayfairCipher that enableInstrumentation() wraps with counters
+_COUNTED_METHODS = ('encrypt', 'encryptPairs', '_lookup')
+
+# Names of the rules, in the order of the counts kept by _Instrumentation
+_RULE_NAMES = ('playfairRuleOne', 'playfairRuleTwo', 'playfairRuleThree', 'playfairRuleFour')
+
+class _Instrumentation:
+    '''
+    Counters kept while instrumentation is on.  Every pair encrypted goes
+    through playfairRuleOne() (counted only when it substitutes a doubled
+    letter) and then exactly one of the other three rules.
+    
+    Input:   function:  called as hook(stage, seconds) after each timed stage, or None
+    '''
+    def __init__(self, hook):
+        self.hook = hook
+        self.pairs = 0
+        self.rules = [0, 0, 0, 0]
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def addRuleCodes(self, codes):
+        '''
+        Adds up pairs by the codes made by _ruleCode().
+        
+        Input:   list:  number of pairs with each of the six codes
+        '''
+        with self.lock:
+            for code, count in enumerate(codes):
+                self.pairs += count
+                self.rules[1 + code % 3] += count
+                if code >= 3:
+                    self.rules[0] += count
+
+    def addStage(self, stage, seconds):
+        '''
+        Records one call of a stage and how long it took.
+        
+        Input:   string:  stage name
+        Input:   float:   seconds
+        '''
+        with self.lock:
+            calls, total = self.stages.get(stage, (0, 0.0))
+            self.stages[stage] = (calls + 1, total + seconds)
+        if self.hook is not None:
+            self.hook(stage, seconds)
+
+    def snapshot(self):
+        '''
+        Copies the counters into plain dicts.
+        
+        Output:  dict:  pairs, rules and stages
+        '''
+        with self.lock:
+            return {
+                'pairs': self.pairs,
+                'rules': dict(zip(_RULE_NAMES, self.rules)),
+                'stages': {stage: {'calls': calls, 'seconds': seconds}
+                           for stage, (calls, seconds) in self.stages.items()},
+            }
+
+def enableInstrumentation(hook=None):
+    '''
+    Turns on instrumentation, starting from zeroed counters.  While it is
+    on, createTable(), splitString(), encrypt() and joinPairs() are
+    replaced in this module by timed wrappers, and the lookup methods of
+    PlayfairCipher behind its pair, message, batch, stream and file paths
+    by counting ones, so building a cipher and every lookup are timed and
+    every pair encrypted through any of them is counted against the
+    rules it went through.  Turned off, the plain functions and methods
+    are put back and none of this code runs, so it costs nothing.
+    Callers that did "from playfair import encrypt" keep the plain
+    function and are not counted.
+    
+    Input:   function:  optional hook(stage, seconds), called after each timed stage
+    '''
+    global _instrumentation
+    if _instrumentation is None:
+        for name in _TIMED_STAGES:
+            globals()[name] = _timed(name, globals()[name])
+        for name in _COUNTED_METHODS:
+            setattr(PlayfairCipher, name, _counted(name, getattr(PlayfairCipher, name)))
+    _instrumentation = _Instrumentation(hook)
+
+def disableInstrumentation():
+    '''
+    Turns instrumentation off and puts the plain functions and methods
+    back.
+    
+    Output:  dict:  the final snapshot, or None if it was already off
+    '''
+    global _instrumentation
+    if _instrumentation is None:
+        return None
+    snapshot = _instrumentation.snapshot()
+    _instrumentation = None
+    for name in _TIMED_STAGES:
+        globals()[name] = _reference(name)
+    for name in _COUNTED_METHODS:
+        setattr(PlayfairCipher, name, getattr(PlayfairCipher, name).__wrapped__)
+    return snapshot
+
+def instrumentationSnapshot():
+    '''
+    Returns the current counters: the number of pairs encrypted, how many
+    went through each rule (for playfairRuleOne, how many doubled letters
+    it substituted) and the number of calls and total seconds per stage.
+    
+    Output:  dict:  pairs, rules and stages, or None while instrumentation is off
+    '''
+    instrumentation = _instrumentation
+    return None if instrumentation is None else instrumentation.snapshot()
+
+def _timed(stage, function):
+    '''
+    Wraps a module function so each call is timed, and for encrypt() so
+    each pair is counted against its rules.
+    
+    Input:   string:    stage name
+    Input:   function:  function to wrap
+    Output:  function:  timed wrapper
+    '''
+    @functools.wraps(function)
+    def wrapper(*args):
+        start = time.perf_counter()
+        result = function(*args)
+        instrumentation = _instrumentation
+        if instrumentation is not None:
+            if stage == 'encrypt':
+                pair, table = args
+                positions = {char: (row, col)
+                             for row, line in enumerate(table)
+                             for col, char in enumerate(line)}
+                codes = [0] * 6
+                codes[_ruleCode(pair, positions)] = 1
+                instrumentation.addRuleCodes(codes)
+            instrumentation.addStage(stage, time.perf_counter() - start)
+        return result
+    return wrapper
+
+def _counted(name, method):
+    '''
+    Wraps a lookup method of PlayfairCipher so each call is timed as a
+    lookup, and every pair it encrypts is counted against its rules:
+    the pair of encrypt(), the list of encryptPairs(), or the filtered
+    text of _lookup() when it is encrypting.
+    
+    Input:   string:    method name, from _COUNTED_METHODS
+    Input:   function:  method to wrap
+    Output:  function:  counting wrapper
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        start = time.perf_counter()
+        result = method(self, *args)
+        instrumentation = _instrumentation
+        if instrumentation is not None:
+            if name == 'encrypt':
+                instrumentation.addRuleCodes(_ruleCounts(self, [args[0]]))
+            elif name == 'encryptPairs':
+                instrumentation.addRuleCodes(_ruleCounts(self, args[0]))
+            elif len(args) > 3 and args[3]:
+                filtered = args[0]
+                if np is not None:
+                    indexes = self._indexes[np.frombuffer(filtered, dtype=np.uint8)]
+                    rows = indexes[0::2].astype(np.intp) * len(self.letters) + indexes[1::2]
+                    instrumentation.addRuleCodes(np.bincount(self._ruleArray[rows], minlength=6).tolist())
+                else:
+                    text = str(filtered, 'ascii')
+                    instrumentation.addRuleCodes(_ruleCounts(self, [text[i:i+2] for i in range(0, len(text), 2)]))
+            instrumentation.addStage('lookup', time.perf_counter() - start)
+        return result
+    return wrapper
+
+def _ruleCounts(cipher, pairs):
+    '''
+    Counts the rule codes of some plaintext pairs of a cipher.
+    
+    Input:   PlayfairCipher:  cipher the pairs were encrypted with
+    Input:   list:            plaintext bigrams
+    Output:  list:            number of pairs with each rule code
+    '''
+    codes = [0] * 6
+    ruleCodes = cipher.ruleCodes
+    for pair in pairs:
+        codes[ruleCodes[pair]] += 1
+    return codes
+
+def _reference(name):
+    '''
+    Returns a module function as written, without any instrumentation
+    wrapper around it.
+    
+    Input:   string:    function name
+    Output:  function:  the plain function
+    '''
+    function = globals()[name]
+    return getattr(function, '__wrapped__', function)
+
+def _ruleCode(pair, positions, ruleOne=playfairRuleOne):
+    '''
+    Works out which rules a plaintext pair goes through in encrypt():
+    0, 1 or 2 for playfairRuleTwo, Three or Four, plus 3 when
+    playfairRuleOne substitutes a doubled letter first.
+    
+    Input:   string:    plaintext bigram
+    Input:   dict:      (row, col) of every letter in the table
+    Input:   function:  rule one to apply first
+    Output:  int:       rule code from 0 to 5
+    '''
+    substituted = ruleOne(pair)
+    (row1, col1), (row2, col2) = positions[substituted[0]], positions[substituted[1]]
+    if row1 == row2:
+        rule = 0
+    elif col1 == col2:
+        rule = 1
+    else:
+        rule = 2
+    return rule + 3 * (substituted != pair)
+
+def canonicalKey(phrase, nonAscii='strict'):
+    '''
+    Reduces a passphrase to the 25-letter key order of its table.  Any
+    two phrases that createTable() turns into the same table -- for
+    example ones that differ only in case, punctuation, repeated letters
+    or Qs -- have the same canonical key.  Letters outside ASCII are
+    handled by the nonAscii policy, as in createTable().
+    
+    Input:   string:  a passphrase
+    Input:   string:  'strict', 'drop' or 'fold' (see normaliseText)
+    Output:  string:  the 25 letters of the table, row by row
+    '''
+    # Keeps the first time each letter shows up, then the rest of the alphabet
+    return ''.join(dict.fromkeys(_filterPhrase(phrase, nonAscii) + _ALPHABET))
+
+class TableCache:
+    '''
+    A bounded, thread-safe LRU cache of compiled ciphers.  Passphrases
+    are reduced with canonicalKey() first, so every phrase that gives
+    the same table shares one PlayfairCipher.  When the cache is full
+    the least recently used cipher is dropped.
+    
+    Input:   int:  largest number of ciphers to keep
+    '''
+    def __init__(self, maxsize=1024):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._ciphers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, phrase):
+        '''
+        Returns the compiled cipher for a passphrase, building it only if
+        no equivalent phrase is cached.
+        
+        Input:   string:          a passphrase
+        Output:  PlayfairCipher:  compiled cipher for its table
+        '''
+        key = canonicalKey(phrase)
+        with self._lock:
+            cipher = self._ciphers.get(key)
+            if cipher is not None:
+                self.hits += 1
+                self._ciphers.move_to_end(key)
+                return cipher
+            self.misses += 1
+
+        # Compiles outside the lock so other keys are not held up
+        cipher = PlayfairCipher(PlayfairTable(key))
+
+        with self._lock:
+            # Another thread may have compiled the same key meanwhile
+            cipher = self._ciphers.setdefault(key, cipher)
+            self._ciphers.move_to_end(key)
+            while len(self._ciphers) > self.maxsize:
+                self._ciphers.popitem(last=False)
+                self.evictions += 1
+        return cipher
+
+    def stats(self):
+        '''
+        Returns the cache counters.
+        
+        Output:  dict:  hits, misses, evictions, size and maxsize
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': len(self._ciphers),
+                    'maxsize': self.maxsize}
+
+    def clear(self):
+        '''
+        Drops every cached cipher and resets the counters.
+        '''
+        with self._lock:
+            self._ciphers.clear()
+            self.hits = self.misses = self.evictions = 0
+
+# Cache shared by getCipher()
+_defaultCache = TableCache()
+
+def getCipher(phrase):
+    '''
+    Returns the compiled cipher for a passphrase from the shared cache.
+    
+    Input:   string:          a passphrase
+    Output:  PlayfairCipher:  compiled cipher for its table
+    '''
+    return _defaultCache.get(phrase)
+
+def encryptMany(records, workers=None, processes=False, chunkSize=10000, cache=None):
+    '''
+    Encrypts a mixed batch of (passphrase, message) records.  Records are
+    taken chunkSize at a time; inside a chunk they are grouped by the
+    canonical key of their passphrase so each table is compiled once, and
+    every group is encrypted in one encryptMessages() call on a thread
+    pool (or a process pool when processes is True).  Ciphertexts are
+    yielded in input order, and only one chunk is held at a time, so
+    memory stays bounded however many records there are.
+    
+    Input:   iterable:    (passphrase, message) records
+    Input:   int:         number of workers (default: chosen by the pool)
+    Input:   bool:        use processes instead of threads
+    Input:   int:         records per chunk
+    Input:   TableCache:  cache for thread workers (default: getCipher()'s cache)
+    Output:  generator:   ciphertexts, in input order
+    '''
+    if processes:
+        pool = ProcessPoolExecutor(workers)
+    else:
+        pool = ThreadPoolExecutor(workers)
+        cache = cache or _defaultCache
+
+    with pool:
+        records = iter(records)
+        while True:
+            chunk = list(itertools.islice(records, chunkSize))
+            if not chunk:
+                return
+
+            # Groups the positions and messages of records that share a table
+            groups = {}
+            for position, (phrase, message) in enumerate(chunk):
+                positions, messages = groups.setdefault(canonicalKey(phrase), ([], []))
+                positions.append(position)
+                messages.append(message)
+
+            futures = []
+            for key, (positions, messages) in groups.items():
+                # Process workers use their own cache since TableCache can't be pickled
+                if processes:
+                    future = pool.submit(_encryptGroup, key, messages)
+                else:
+                    future = pool.submit(_encryptGroup, key, messages, cache)
+                futures.append((positions, future))
+
+            results = [None] * len(chunk)
+            for positions, future in futures:
+                for position, ciphertext in zip(positions, future.result()):
+                    results[position] = ciphertext
+            yield from results
+
+def _encryptGroup(key, messages, cache=None):
+    '''
+    Encrypts all the messages of one group from encryptMany().
+    
+    Input:   string:      canonical key of the group
+    Input:   list:        plaintexts
+    Input:   TableCache:  cache to compile the table in (default: getCipher()'s cache)
+    Output:  list:        ciphertexts, in the same order
+    '''
+    return (cache or _defaultCache).get(key).encryptMessages(messages)
+
+def encryptFileParallel(inPath, outPath, table, workers=None, chunkSize=1 << 24, nonAscii='strict',
+                        index=None):
+    '''
+    Encrypts a large file on several processes.  The input is memory-
+    mapped and cut into byte ranges.  A first pass counts how many
+    letters survive the splitString() filtering in each range, which
+    tells every worker whether its first letter finishes a pair started
+    in an earlier range.  Workers then encrypt only the pairs that lie
+    wholly inside their range, and the few letters left at the edges are
+    stitched together here, so pairs are never split between workers.
+    Range edges are moved to the nearest UTF-8 character boundary.
+    Results are written back in order and match PlayfairCipher.encryptFile().
+    Only two ranges per worker are handed out at a time, so memory is
+    bounded by chunkSize and workers rather than by the file size.
+    When an OffsetIndex is given, a checkpoint is added at the start of
+    every range, from the letter counts of the first pass.
+    
+    Input:   string:         path of the plaintext file
+    Input:   string:         path of the ciphertext file to write
+    Input:   list of lists:  ciphertable
+    Input:   int:            number of worker processes (default: all CPUs)
+    Input:   int:            bytes of input per work item
+    Input:   string:         'strict', 'drop' or 'fold' (see normaliseText)
+    Input:   OffsetIndex:    index to fill in (optional)
+    Output:  int:            number of ciphertext characters written
+    '''
+    return _transformFileParallel(inPath, outPath, table, workers, chunkSize, False, nonAscii, index)
+
+def decryptFileParallel(inPath, outPath, table, workers=None, chunkSize=1 << 24, nonAscii='strict'):
+    '''
+    Decrypts a large file on several processes, splitting the work the
+    same way as encryptFileParallel().  The output matches
+    PlayfairCipher.decryptFile().
+    
+    Input:   string:         path of the ciphertext file
+    Input:   string:         path of the plaintext file to write
+    Input:   list of lists:  ciphertable
+    Input:   int:            number of worker processes (default: all CPUs)
+    Input:   int:            bytes of input per work item
+    Input:   string:         'strict', 'drop' or 'fold' (see normaliseText)
+    Output:  int:            number of plaintext characters written
+    '''
+    return _transformFileParallel(inPath, outPath, table, workers, chunkSize, True, nonAscii, None)
+
+def _transformFileParallel(inPath, outPath, table, workers, chunkSize, decrypting, nonAscii, index):
+    '''
+    Shared body of encryptFileParallel() and decryptFileParallel().
+    
+    Input:   string:         path of the input file
+    Input:   string:         path of the output file to write
+    Input:   list of lists:  ciphertable
+    Input:   int:            number of worker processes
+    Input:   int:            bytes of input per work item
+    Input:   bool:           True to decrypt, False to encrypt
+    Input:   string:         non-ASCII policy
+    Input:   OffsetIndex:    index to fill in, or None
+    Output:  int:            number of characters written
+    '''
+    cipher = PlayfairCipher(table, nonAscii)
+    transform = cipher._decryptFiltered if decrypting else cipher._encryptFiltered
+    size = os.path.getsize(inPath)
+    ranges = [(inPath, start, min(start + chunkSize, size), nonAscii) for start in range(0, size, chunkSize)]
+    written = 0
+
+    with ProcessPoolExecutor(workers, initializer=_initWorker, initargs=(cipher.table, nonAscii)) as pool, \
+         open(outPath, 'wb') as outfile:
+        # Works out whether each range starts in the middle of a pair
+        parities = []
+        letters = 0
+        for start, count in pool.map(countRange, ranges):
+            parities.append(letters % 2)
+            if index is not None:
+                index.add(start, letters)
+            letters += count
+
+        # Keeps two ranges per worker in flight and writes each one as soon
+        # as it is next in order, so only the window is ever held in memory
+        window = 2 * (workers or os.cpu_count() or 1)
+        jobs = (item + (parity, decrypting) for item, parity in zip(ranges, parities))
+        futures = [pool.submit(_transformRange, job) for job in itertools.islice(jobs, window)]
+        pending = b''
+        while futures:
+            lead, body, tail = futures.pop(0).result()
+            futures.extend(pool.submit(_transformRange, job) for job in itertools.islice(jobs, 1))
+            # Finishes the pair left open by an earlier range
+            if lead:
+                body = transform(pending + lead) + body
+                pending = b''
+            if tail:
+                pending = tail
+            outfile.write(body.encode('ascii'))
+            written += len(body)
+
+        if pending:
+            if decrypting:
+                raise ValueError("ciphertext has an odd number of letters")
+            body = transform(pending + b'x')
+            outfile.write(body.encode('ascii'))
+            written += len(body)
+
+    if index is not None:
+        index.add(size, written)
+    return written
+
+# Compiled cipher for each worker process of _transformFileParallel()
+_workerCipher = None
+
+def _initWorker(table, nonAscii):
+    '''
+    Compiles the cipher once when a worker process starts.
+    
+    Input:   list of lists:  ciphertable
+    Input:   string:         non-ASCII policy
+    '''
+    global _workerCipher
+    _workerCipher = PlayfairCipher(table, nonAscii)
+
+def readRange(path, start, end, nonAscii):
+    '''
+    Reads one byte range of a file through a read-only memory map and
+    returns it already filtered.  Both edges are moved forward past any
+    UTF-8 continuation bytes, so neighbouring ranges still meet and no
+    character is cut in two.
+    
+    Input:   string:  path of the file
+    Input:   int:     first byte of the range
+    Input:   int:     end of the range (exclusive)
+    Input:   string:  non-ASCII policy
+    Output:  tuple:   (first byte after moving, filtered text)
+    '''
+    with open(path, 'rb') as infile, \
+         mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        while start < len(mapped) and 0x80 <= mapped[start] < 0xC0:
+            start += 1
+        while end < len(mapped) and 0x80 <= mapped[end] < 0xC0:
+            end += 1
+        return start, normaliseText(mapped[start:end], nonAscii)
+
+def countRange(job):
+    '''
+    Counts the letters of a byte range that survive filtering.  It takes
+    one tuple so it can be handed to Executor.map().
+    
+    Input:   tuple:  (path, start, end, non-ASCII policy)
+    Output:  tuple:  (first byte of the range, number of letters)
+    '''
+    start, filtered = readRange(*job)
+    return start, len(filtered)
+
+def _transformRange(job):
+    '''
+    Encrypts or decrypts the pairs that lie wholly inside a byte range.
+    The first letter is handed back untouched when it belongs to a pair
+    opened in an earlier range, and so is a last letter that has no
+    partner yet.
+    
+    Input:   tuple:  (path, start, end, policy, parity of letters before start, decrypting)
+    Output:  tuple:  (leading letter, output text, trailing letter)
+    '''
+    path, start, end, nonAscii, parity, decrypting = job
+    _, filtered = readRange(path, start, end, nonAscii)
+    lead, filtered = filtered[:parity], filtered[parity:]
+    cut = len(filtered) - len(filtered) % 2
+    if decrypting:
+        return lead, _workerCipher._decryptFiltered(filtered[:cut]), filtered[cut:]
+    return lead, _workerCipher._encryptFiltered(filtered[:cut]), filtered[cut:]
+
+class SharedMemoryPool:
+    '''
+    A pool of worker processes for encrypting large in-memory buffers.
+    The filtered input and the output both live in shared memory, so a
+    worker is only sent a pair of segment names and a range of offsets,
+    and writes its ciphertext straight into the output segment.  Nothing
+    but those few numbers is pickled per work item; the compact
+    PlayfairTable goes to each worker once, when it starts.
+    
+    The pool keeps its processes between calls, so it pays off when it
+    is reused.  Close it, or use it in a "with" block, when done.
+    
+    Input:   list of lists or PlayfairTable:  ciphertable
+    Input:   int:     number of worker processes (default: all CPUs)
+    Input:   int:     letters per work item
+    Input:   string:  'strict', 'drop' or 'fold' (see normaliseText)
+    '''
+    def __init__(self, table, workers=None, chunkSize=1 << 22, nonAscii='strict'):
+        self.cipher = PlayfairCipher(table, nonAscii)
+        # Work items must hold whole pairs
+        self.chunkSize = max(2, chunkSize - chunkSize % 2)
+        self._pool = ProcessPoolExecutor(workers, initializer=_initWorker,
+                                         initargs=(self.cipher.table, nonAscii))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''
+        Shuts the worker processes down.
+        '''
+        self._pool.shutdown()
+
+    def encrypt(self, data):
+        '''
+        Encrypts a whole buffer.  The result is the same as
+        PlayfairCipher.encryptBatch() on it.
+        
+        Input:   string or bytes:  plaintext
+        Output:  string:           ciphertext
+        '''
+        return self._transform(data, False)
+
+    def decrypt(self, data):
+        '''
+        Decrypts a whole buffer.  The result is the same as
+        PlayfairCipher.decryptBatch() on it.
+        
+        Input:   string or bytes:  ciphertext
+        Output:  string:           plaintext
+        '''
+        return self._transform(data, True)
+
+    def _transform(self, data, decrypting):
+        '''
+        Shared body of encrypt() and decrypt().
+        
+        Input:   string or bytes:  input text
+        Input:   bool:             True to decrypt, False to encrypt
+        Output:  string:           output text
+        '''
+        filtered = normaliseText(data, self.cipher.nonAscii)
+        if len(filtered) % 2 != 0:
+            if decrypting:
+                raise ValueError("ciphertext has an odd number of letters")
+            filtered += b'x'
+        size = len(filtered)
+        if not size:
+            return ''
+
+        source = shared_memory.SharedMemory(create=True, size=size)
+        target = shared_memory.SharedMemory(create=True, size=size)
+        try:
+            source.buf[:size] = filtered
+            del filtered
+            jobs = [(source.name, target.name, start, min(start + self.chunkSize, size), decrypting)
+                    for start in range(0, size, self.chunkSize)]
+            for error in self._pool.map(_transformShared, jobs):
+                if error is not None:
+                    raise ValueError(error)
+            return str(target.buf[:size], 'ascii')
+        finally:
+            source.close()
+            source.unlink()
+            target.close()
+            target.unlink()
+
+def _transformShared(job):
+    '''
+    Encrypts or decrypts one range of a shared input segment into the
+    same range of a shared output segment.  Errors are handed back as
+    text, so the segments can always be closed.
+    
+    Input:   tuple:  (input segment name, output segment name, start, end, decrypting)
+    Output:  string or None:  error message
+    '''
+    inName, outName, start, end, decrypting = job
+    source = shared_memory.SharedMemory(inName)
+    target = shared_memory.SharedMemory(outName)
+    error = None
+    try:
+        transform = _workerCipher._decryptFiltered if decrypting else _workerCipher._encryptFiltered
+        transform(source.buf[start:end], target.buf[start:end])
+    except ValueError as problem:
+        error = str(problem)
+    finally:
+        source.close()
+        target.close()
+    return error
+
+class OffsetIndex:
+    '''
+    A sidecar index for a ciphertext file, so that part of it can be
+    decrypted without reading the rest.  Every checkpoint pairs an
+    offset in the original input with the number of letters that
+    survived filtering before it, which is also the offset of the
+    matching letter in the ciphertext.  The last checkpoint holds the
+    input size and the ciphertext size.  Offsets are bytes for binary
+    input and characters for text input, and always fall between
+    characters.
+    
+    PlayfairCipher.encryptFile() and encryptFileParallel() fill one in
+    as they encrypt; save() writes it next to the ciphertext and
+    decryptFileRange() reads ranges back through it.
+    '''
+    def __init__(self):
+        self.plainOffsets = array.array('Q')
+        self.cipherOffsets = array.array('Q')
+
+    def __len__(self):
+        return len(self.plainOffsets)
+
+    def add(self, plainOffset, cipherOffset):
+        '''
+        Adds a checkpoint after the ones already there.
+        
+        Input:   int:  offset in the original input
+        Input:   int:  letters before it, which is its ciphertext offset
+        '''
+        if self.plainOffsets and plainOffset < self.plainOffsets[-1]:
+            raise ValueError("checkpoints must be added in order")
+        self.plainOffsets.append(plainOffset)
+        self.cipherOffsets.append(cipherOffset)
+
+    def locate(self, start, end):
+        '''
+        Finds the part of the ciphertext that holds a range of the
+        original input.  The part starts and ends on a bigram at the
+        nearest checkpoints around the range, so it may hold a few
+        letters either side of it.
+        
+        Input:   int:    first offset of the range in the original input
+        Input:   int:    end of the range (exclusive)
+        Output:  tuple:  (first ciphertext offset, end ciphertext offset)
+        '''
+        if not self.plainOffsets:
+            raise ValueError("the index is empty")
+        if not 0 <= start <= end:
+            raise ValueError("bad range")
+        first = max(bisect.bisect_right(self.plainOffsets, start) - 1, 0)
+        last = min(bisect.bisect_left(self.plainOffsets, end), len(self.plainOffsets) - 1)
+        cipherStart = self.cipherOffsets[first] - self.cipherOffsets[first] % 2
+        cipherEnd = self.cipherOffsets[last] + self.cipherOffsets[last] % 2
+        return cipherStart, min(max(cipherEnd, cipherStart), self.cipherOffsets[-1])
+
+    def save(self, path):
+        '''
+        Writes the index to a file: a magic number, the number of
+        checkpoints and then every pair of offsets as little-endian
+        64-bit integers.
+        
+        Input:   string:  path of the index file
+        '''
+        pairs = array.array('Q', [0]) * (2 * len(self))
+        pairs[0::2] = self.plainOffsets
+        pairs[1::2] = self.cipherOffsets
+        if sys.byteorder != 'little':
+            pairs.byteswap()
+        with open(path, 'wb') as indexfile:
+            indexfile.write(_INDEX_MAGIC + struct.pack('<Q', len(self)))
+            indexfile.write(pairs.tobytes())
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Reads an index written by save().
+        
+        Input:   string:       path of the index file
+        Output:  OffsetIndex:  the index
+        '''
+        with open(path, 'rb') as indexfile:
+            data = indexfile.read()
+        header = len(_INDEX_MAGIC) + 8
+        if data[:len(_INDEX_MAGIC)] != _INDEX_MAGIC or len(data) < header:
+            raise ValueError(f"'{path}' is not a playfair offset index")
+        count, = struct.unpack_from('<Q', data, len(_INDEX_MAGIC))
+        if len(data) != header + 16 * count:
+            raise ValueError(f"'{path}' is truncated")
+
+        pairs = array.array('Q')
+        pairs.frombytes(data[header:])
+        if sys.byteorder != 'little':
+            pairs.byteswap()
+        index = cls()
+        index.plainOffsets = pairs[0::2]
+        index.cipherOffsets = pairs[1::2]
+        return index
+
+def decryptFileRange(path, index, table, start, end):
+    '''
+    Decrypts only the part of a ciphertext file that holds a range of
+    the original input.  The ciphertext is memory-mapped and the index
+    gives the bigram-aligned slice to read, so the cost depends on the
+    size of the range and the spacing of the checkpoints rather than on
+    the size of the file.  The plaintext comes back as decryptMessage()
+    would give it, including a few letters either side of the range.
+    A table is compiled through getCipher()'s cache, so only the first
+    read with it pays for compiling; a compiled cipher is used as it is.
+    
+    Input:   string:                          path of the ciphertext file
+    Input:   OffsetIndex:                     index written when encrypting
+    Input:   PlayfairCipher, list of lists or PlayfairTable:  cipher or ciphertable
+    Input:   int:                             first offset in the original input
+    Input:   int:                             end offset (exclusive)
+    Output:  string:                          plaintext
+    '''
+    cipherStart, cipherEnd = index.locate(start, end)
+    if cipherStart == cipherEnd:
+        return ''
+    with open(path, 'rb') as infile, \
+         mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if cipherEnd > len(mapped):
+            raise ValueError("the index does not match the ciphertext file")
+        if not isinstance(table, PlayfairCipher):
+            table = getCipher(PlayfairTable.fromList(table).letters)
+        return table._decryptFiltered(mapped[cipherStart:cipherEnd])
+
+def _compileBigrams(table):
+    '''
+    Works out the 625-entry encryption and decryption tables of a
+    PlayfairCipher straight from the letter positions, without running
+    the rule functions, for filling a KeyRing quickly.  Each holds the
+    two output letters of bigram first*25+second, with letters in table
+    order; doubled pairs are b'\\0\\0' in the decryption table.
+    
+    Input:   PlayfairTable:  ciphertable
+    Output:  tuple:          (encryption bytes, decryption bytes)
+    '''
+    key = table.key
+    letters = table.letters
+    encrypted = bytearray(1250)
+    plain = bytearray(1250)
+    for first in range(25):
+        row1, col1 = divmod(first, 5)
+        for second in range(25):
+            offset = 2 * (first * 25 + second)
+            target = second
+            if first == second:
+                # playfairRuleOne() replaces the doubled letter first
+                target = letters.find('z' if letters[first] == 'x' else 'x')
+                if target < 0:
+                    raise ValueError("the table has no letter for playfairRuleOne()")
+            row2, col2 = divmod(target, 5)
+            if row1 == row2:
+                encrypted[offset] = key[row1 * 5 + (col1 + 1) % 5]
+                encrypted[offset + 1] = key[row2 * 5 + (col2 + 1) % 5]
+            elif col1 == col2:
+                encrypted[offset] = key[(row1 + 1) % 5 * 5 + col1]
+                encrypted[offset + 1] = key[(row2 + 1) % 5 * 5 + col2]
+            else:
+                encrypted[offset] = key[row1 * 5 + col2]
+                encrypted[offset + 1] = key[row2 * 5 + col1]
+
+            if first == second:
+                continue
+            if row1 == row2:
+                plain[offset] = key[row1 * 5 + (col1 - 1) % 5]
+                plain[offset + 1] = key[row2 * 5 + (col2 - 1) % 5]
+            elif col1 == col2:
+                plain[offset] = key[(row1 - 1) % 5 * 5 + col1]
+                plain[offset + 1] = key[(row2 - 1) % 5 * 5 + col2]
+            else:
+                plain[offset] = key[row1 * 5 + col2]
+                plain[offset + 1] = key[row2 * 5 + col1]
+    return bytes(encrypted), bytes(plain)
+
+class KeyRing:
+    '''
+    A persistent keyring of precompiled tables, opened with a read-only
+    memory map.  The file holds one fixed-size record per key id, sorted
+    by id:
+    
+        id (idSize bytes, UTF-8, padded with NULs)
+        table letters (25 bytes)
+        row and column of every letter a-z (26 + 26 bytes)
+        encryption table (625 x 2 bytes)
+        decryption table (625 x 2 bytes)
+    
+    Looking a key up is a binary search over the records, and cipher()
+    builds a PlayfairCipher with fromCompiled() from the stored tables,
+    so the rule functions never run.  With NumPy its lookup arrays are
+    views of the record in the map, so nothing is copied and the cipher
+    costs little more than table(); its lookup dicts are only filled in
+    if something asks for them.  Those views keep the map alive after
+    close() until the last such cipher is gone.  write() and append()
+    build a new file next to the old one and swap it in with
+    os.replace(), so readers only ever see a whole keyring.
+    
+    Input:   string:  path of the keyring file
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as keyfile:
+            self._mapped = mmap.mmap(keyfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header = len(_KEYRING_MAGIC) + _KEYRING_HEADER.size
+            if len(self._mapped) < header or self._mapped[:len(_KEYRING_MAGIC)] != _KEYRING_MAGIC:
+                raise ValueError(f"'{path}' is not a playfair keyring")
+            self.idSize, self.count = _KEYRING_HEADER.unpack_from(self._mapped, len(_KEYRING_MAGIC))
+            self.recordSize = self.idSize + _KEYRING_RECORD
+            self._start = header
+            if len(self._mapped) != header + self.count * self.recordSize:
+                raise ValueError(f"'{path}' is truncated")
+        except BaseException:
+            self._mapped.close()
+            raise
+        # The whole map as bytes, for handing out views of the stored tables
+        self._array = np.frombuffer(self._mapped, dtype=np.uint8) if np is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, keyId):
+        return self._find(keyId) is not None
+
+    def close(self):
+        '''
+        Closes the keyring, so looking anything up raises ValueError.
+        The file is unmapped at once, or, while ciphers made by cipher()
+        still read their tables from it, when the last of them is gone;
+        they keep working either way.  Closing twice is harmless.
+        '''
+        if self._mapped is None:
+            return
+        self._array = None
+        try:
+            self._mapped.close()
+        except BufferError:
+            # Views held by ciphers keep the map; it goes with the last of them
+            pass
+        self._mapped = None
+
+    def ids(self):
+        '''
+        Yields every key id, in sorted order.
+        
+        Output:  generator:  key ids as strings
+        '''
+        for index in range(self.count):
+            yield self._id(index).rstrip(b'\0').decode('utf-8')
+
+    def table(self, keyId):
+        '''
+        Returns the table stored for a key id.  Raises KeyError when the
+        id is not in the keyring.
+        
+        Input:   string:         key id
+        Output:  PlayfairTable:  its table
+        '''
+        offset = self._record(keyId)
+        return PlayfairTable(self._mapped[offset:offset + 25])
+
+    def cipher(self, keyId, nonAscii='strict'):
+        '''
+        Returns a compiled cipher for a key id, built from the stored
+        tables.  Raises KeyError when the id is not in the keyring.
+        
+        Input:   string:          key id
+        Input:   string:          'strict', 'drop' or 'fold' (see normaliseText)
+        Output:  PlayfairCipher:  compiled cipher
+        '''
+        offset = self._record(keyId)
+        tables = offset + 25 + 52
+        # Views of the map with NumPy; without it, slices copy the tables
+        source = self._array if self._array is not None else self._mapped
+        return PlayfairCipher.fromCompiled(PlayfairTable(self._mapped[offset:offset + 25]),
+                                           source[tables:tables + 1250],
+                                           source[tables + 1250:tables + 2500], nonAscii)
+
+    @classmethod
+    def write(cls, path, items, idSize=32):
+        '''
+        Builds a new keyring from (key id, key) items, replacing any file
+        already at path in one step.  A key can be a passphrase, a
+        list-of-lists table or a PlayfairTable.  When an id comes up more
+        than once the last key wins.
+        
+        Input:   string:    path of the keyring file
+        Input:   iterable:  (key id, key) items
+        Input:   int:       largest key id in bytes of UTF-8
+        Output:  int:       number of keys written
+        '''
+        return cls._build(path, None, items, idSize)
+
+    @classmethod
+    def append(cls, path, items):
+        '''
+        Adds (key id, key) items to an existing keyring, or replaces the
+        keys of ids it already holds, swapping the new file in in one
+        step.  Records that do not change are copied over as they are.
+        
+        Input:   string:    path of the keyring file
+        Input:   iterable:  (key id, key) items
+        Output:  int:       number of keys in the new keyring
+        '''
+        with cls(path) as old:
+            return cls._build(path, old, items, old.idSize)
+
+    @classmethod
+    def _build(cls, path, old, items, idSize):
+        '''
+        Shared body of write() and append(): merges the sorted new ids
+        with the records of the old keyring into a temporary file and
+        moves it over path.
+        
+        Input:   string:          path of the keyring file
+        Input:   KeyRing or None: keyring whose records are kept
+        Input:   iterable:        (key id, key) items
+        Input:   int:             size of the id field
+        Output:  int:             number of keys written
+        '''
+        tables = {}
+        for keyId, key in items:
+            encoded = _keyId(keyId, idSize)
+            if isinstance(key, str):
+                tables[encoded] = PlayfairTable.fromPhrase(key)
+            else:
+                tables[encoded] = PlayfairTable.fromList(key)
+        newIds = sorted(tables)
+        oldCount = len(old) if old is not None else 0
+
+        folder = os.path.dirname(os.path.abspath(path))
+        handle, tempPath = tempfile.mkstemp(dir=folder, prefix='.keyring-')
+        try:
+            with os.fdopen(handle, 'wb') as keyfile:
+                keyfile.write(_KEYRING_MAGIC + _KEYRING_HEADER.pack(idSize, 0))
+                count = 0
+                oldIndex = newIndex = 0
+                # Merges the two sorted lists of ids
+                while oldIndex < oldCount or newIndex < len(newIds):
+                    oldId = old._id(oldIndex) if oldIndex < oldCount else None
+                    newId = newIds[newIndex] if newIndex < len(newIds) else None
+                    if newId is None or (oldId is not None and oldId < newId):
+                        start = old._start + oldIndex * old.recordSize
+                        keyfile.write(old._mapped[start:start + old.recordSize])
+                        oldIndex += 1
+                    else:
+                        if oldId == newId:
+                            oldIndex += 1
+                        table = tables[newId]
+                        encrypted, plain = _compileBigrams(table)
+                        keyfile.write(newId + table.key + table.rows + table.cols + encrypted + plain)
+                        newIndex += 1
+                    count += 1
+
+                keyfile.seek(len(_KEYRING_MAGIC))
+                keyfile.write(_KEYRING_HEADER.pack(idSize, count))
+                keyfile.flush()
+                os.fsync(keyfile.fileno())
+            os.replace(tempPath, path)
+        except BaseException:
+            os.unlink(tempPath)
+            raise
+        return count
+
+    def _id(self, index):
+        '''
+        Returns the padded id of a record.
+        
+        Input:   int:    record number
+        Output:  bytes:  id field
+        '''
+        if self._mapped is None:
+            raise ValueError("the keyring is closed")
+        start = self._start + index * self.recordSize
+        return self._mapped[start:start + self.idSize]
+
+    def _find(self, keyId):
+        '''
+        Binary-searches the records for a key id.
+        
+        Input:   string:       key id
+        Output:  int or None:  offset of the record's table, or None
+        '''
+        if self._mapped is None:
+            raise ValueError("the keyring is closed")
+        try:
+            encoded = _keyId(keyId, self.idSize)
+        except ValueError:
+            return None
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._id(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._id(low) == encoded:
+            return self._start + low * self.recordSize + self.idSize
+        return None
+
+    def _record(self, keyId):
+        '''
+        Like _find(), but raises KeyError for a missing id.
+        
+        Input:   string:  key id
+        Output:  int:     offset of the record's table
+        '''
+        offset = self._find(keyId)
+        if offset is None:
+            raise KeyError(keyId)
+        return offset
+
+def _keyId(keyId, idSize):
+    '''
+    Encodes a key id as a KeyRing id field.
+    
+    Input:   string:  key id
+    Input:   int:     size of the id field
+    Output:  bytes:   UTF-8 id padded with NULs
+    '''
+    encoded = keyId.encode('utf-8')
+    if len(encoded) > idSize or b'\0' in encoded or not encoded:
+        raise ValueError(f"key id must be 1 to {idSize} bytes of UTF-8 without NULs")
+    return encoded.ljust(idSize, b'\0')
+
+def cli(argv=None, stdin=None, stdout=None):
+    '''
+    Command-line entry point, run by "python -m playfair" with arguments.
+    Encrypts or decrypts a file or stdin and writes to a file or stdout,
+    reading and writing in large buffered chunks so it can sit in a
+    shell pipeline.  It never runs the test functions.
+    
+    Input:   list:  command-line arguments (default: sys.argv[1:])
+    Input:   file:  binary stream used for "-" input (default: stdin)
+    Input:   file:  binary stream used for "-" output (default: stdout)
+    Output:  int:   exit status
+    '''
+    parser = argparse.ArgumentParser(prog="python -m playfair",
+                                     description="Encrypt or decrypt text with a playfair cipher.")
+    parser.add_argument('mode', choices=['encrypt', 'decrypt'])
+    keys = parser.add_mutually_exclusive_group(required=True)
+    keys.add_argument('-k', '--key', help="passphrase")
+    keys.add_argument('--key-file', help="file holding the passphrase")
+    parser.add_argument('-i', '--input', default='-', help="input file (default: stdin)")
+    parser.add_argument('-o', '--output', default='-', help="output file (default: stdout)")
+    parser.add_argument('--chunk-size', type=int, default=1 << 20,
+                        help="bytes read and written at a time (default: 1 MiB)")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="worker processes; more than one needs --input and --output files")
+    parser.add_argument('--non-ascii', choices=_NON_ASCII_POLICIES, default='strict',
+                        help="what to do with letters outside ASCII (default: strict)")
+    parser.add_argument('--index', help="offset index file, written when encrypting (one checkpoint "
+                                         "per --index-interval) and read by --range when decrypting")
+    parser.add_argument('--index-interval', type=int,
+                        help="bytes of input between index checkpoints (default: --chunk-size; "
+                             "with several workers every --chunk-size range gets one)")
+    parser.add_argument('--range', help="decrypt only START:END of the original input; needs --index")
+    parser.add_argument('--variant', choices=sorted(_VARIANTS), default='default',
+                        help="table variant (default: 5x5 without q); others need one worker and no --range")
+    args = parser.parse_args(argv)
+
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+    if args.index_interval is not None and (args.index_interval < 1 or args.workers > 1):
+        parser.error("--index-interval must be at least 1, and works with one worker only")
+    if args.workers > 1 and '-' in (args.input, args.output):
+        parser.error("--workers needs --input and --output files")
+    if args.range is not None:
+        if args.mode != 'decrypt' or args.index is None or args.input == '-':
+            parser.error("--range needs decrypt, --index and an --input file")
+        try:
+            start, end = (int(part) for part in args.range.split(':'))
+        except ValueError:
+            parser.error("--range must look like START:END")
+    elif args.index is not None and args.mode == 'decrypt':
+        parser.error("--index needs --range when decrypting")
+    if args.variant != 'default' and (args.workers > 1 or args.range is not None):
+        parser.error("--variant needs one worker and no --range")
+
+    if args.key_file is not None:
+        try:
+            with open(args.key_file) as keyfile:
+                phrase = keyfile.read()
+        except (OSError, ValueError) as error:
+            print(f"playfair: can't read the key file: {error}", file=sys.stderr)
+            return 1
+    else:
+        phrase = args.key
+
+    index = OffsetIndex() if args.index is not None and args.range is None else None
+    try:
+        table = createTable(phrase, args.non_ascii)
+        if args.workers > 1:
+            if args.mode == 'decrypt':
+                decryptFileParallel(args.input, args.output, table, args.workers, args.chunk_size, args.non_ascii)
+            else:
+                encryptFileParallel(args.input, args.output, table, args.workers, args.chunk_size, args.non_ascii,
+                                    index)
+                if index is not None:
+                    index.save(args.index)
+            return 0
+
+        if args.variant == 'default':
+            cipher = PlayfairCipher(table, args.non_ascii)
+        else:
+            cipher = _VARIANTS[args.variant]().cipher(phrase, args.non_ascii)
+        stream = cipher.decryptStream if args.mode == 'decrypt' else cipher.encryptStream
+        infile = (stdin or sys.stdin.buffer) if args.input == '-' else open(args.input, 'rb', buffering=args.chunk_size)
+        outfile = (stdout or sys.stdout.buffer) if args.output == '-' else open(args.output, 'wb', buffering=args.chunk_size)
+        try:
+            if args.range is not None:
+                plaintext = decryptFileRange(args.input, OffsetIndex.load(args.index), cipher, start, end)
+                outfile.write(plaintext.encode('ascii'))
+            elif index is not None:
+                # encryptFile() writes text, so it gets a text layer over the binary output
+                text = io.TextIOWrapper(outfile, 'ascii', newline='', write_through=True)
+                cipher.encryptFile(infile, text, args.chunk_size, index, args.index_interval)
+                text.detach()
+                index.save(args.index)
+            else:
+                for piece in stream(infile, args.chunk_size):
+                    outfile.write(piece.encode('ascii'))
+            outfile.flush()
+        finally:
+            if args.input != '-':
+                infile.close()
+            if args.output != '-':
+                outfile.close()
+    except BrokenPipeError:
+        # The reader went away, as with "| head"; nothing more to write
+        return 0
+    except (OSError, ValueError) as error:
+        print(f"playfair: {error}", file=sys.stderr)
+        return 1
+    return 0
+
 def main():
     '''
     Example main() function; can be commented out when running your
@@ -279,6 +2683,72 @@ def main():
     test_joinPairs_empty_list()
     test_joinPairs_single_character()
     test_joinPairs_mixed_length()
+    
+    test_PlayfairCipher_allBigrams()
+    test_PlayfairCipher_positions()
+    test_PlayfairCipher_message()
+    test_PlayfairCipher_messagePolicies()
+    test_PlayfairCipher_copiesTable()
+    test_PlayfairCipher_encryptBatch()
+    test_PlayfairCipher_encryptBatchDoubles()
+    test_PlayfairCipher_encryptBatchEmpty()
+    test_PlayfairCipher_encryptStreamChunks()
+    test_PlayfairCipher_encryptStreamIterable()
+    test_PlayfairCipher_encryptFile()
+    test_decrypt_rules()
+    test_decrypt_roundTripAllBigrams()
+    test_PlayfairCipher_decryptMessage()
+    test_PlayfairCipher_decryptBatchAndStream()
+    test_PlayfairCipher_decryptInvalid()
+    
+    test_encryptFileParallel_matchesSequential()
+    test_encryptFileParallel_empty()
+    test_decryptFileParallel_roundTrip()
+    
+    test_cli_files()
+    test_cli_streams()
+    test_cli_missingFiles()
+    
+    test_instrumentation_referencePath()
+    test_instrumentation_compiledCipher()
+    test_instrumentation_off()
+    
+    test_canonicalKey_equivalentPhrases()
+    test_canonicalKey_accentedPhrase()
+    test_TableCache_sharesTables()
+    test_TableCache_evictsLeastRecent()
+    
+    test_PlayfairCipher_encryptMessages()
+    test_encryptMany_inputOrder()
+    test_encryptMany_processes()
+    
+    test_normaliseText_matchesSplitString()
+    test_normaliseText_policies()
+    test_splitString_createTable_asciiFastPath()
+    test_PlayfairCipher_utf8Chunks()
+    
+    test_PlayfairTable_listCompatible()
+    test_PlayfairTable_hashPickleImmutable()
+    
+    test_PlayfairSession_fragments()
+    test_PlayfairSession_decrypt()
+    test_PlayfairSession_mixedFragments()
+    
+    test_OffsetIndex_decryptFileRange()
+    test_cli_indexRange()
+    
+    test_PlayfairCascade_matchesRounds()
+    test_PlayfairCascade_oneRound()
+    
+    test_SharedMemoryPool_matchesBatch()
+    
+    test_compileBigrams_matchesCipher()
+    test_KeyRing_writeAppend()
+    test_KeyRing_close()
+    
+    test_PlayfairVariant_default()
+    test_PlayfairVariant_classic()
+    test_PlayfairVariant_alphanumeric()
 ###############################################################
 
 # Here is where you will write your test case functions
@@ -631,7 +3101,835 @@ def test_joinPairs_mixed_length():
     assert actual_ciphertext == expected_ciphertext, f"Failed with mixed length bigrams. Expected '{expected_ciphertext}', got '{actual_ciphertext}'."
     pass
 
+# Below are the tests for PlayfairCipher
+def test_PlayfairCipher_allBigrams():
+    # Tests that every one of the 625 bigrams matches encrypt()
+    table = createTable("i am entering a pass phrase")
+    cipher = PlayfairCipher(table)
+    assert len(cipher.bigrams) == 625, "Cipher should hold all 625 bigrams."
+    for pair, expected in cipher.bigrams.items():
+        assert expected == encrypt(pair, table), f"Lookup for '{pair}' does not match encrypt()."
+    pass
+
+def test_PlayfairCipher_positions():
+    # Tests the letter positions against the table
+    table = createTable("simple")
+    cipher = PlayfairCipher(table)
+    assert cipher.positions['s'] == (0, 0), "Failed on position of 's'."
+    assert cipher.positions['z'] == (4, 4), "Failed on position of 'z'."
+    assert 'q' not in cipher.positions, "Cipher should not contain 'q'."
+    pass
+
+def test_PlayfairCipher_message():
+    # Tests the compiled cipher against the example from main()
+    cipher = PlayfairCipher(createTable("i am entering a pass phrase"))
+    assert cipher.encryptMessage("this is a test message") == "hjntntirnpginprnpm", "Failed on example message."
+    assert cipher.encrypt("gg") == "cm", "Failed on bigram 'gg'."
+    pass
+
+def test_PlayfairCipher_messagePolicies():
+    # Tests that encryptMessage() filters letters outside ASCII like the batch path
+    table = createTable("i am entering a pass phrase")
+    for policy in ('drop', 'fold'):
+        cipher = PlayfairCipher(table, policy)
+        assert cipher.encryptMessage("café crème") == cipher.encryptBatch("café crème"), f"Failed to {policy} letters."
+    try:
+        PlayfairCipher(table).encryptMessage("café")
+        assert False, "Strict policy should reject accented letters."
+    except ValueError:
+        pass
+    pass
+
+def test_PlayfairCipher_copiesTable():
+    # Tests that changing the table afterwards does not change the cipher
+    table = createTable("simple")
+    cipher = PlayfairCipher(table)
+    table[0][0] = 'z'
+    assert cipher.table[0][0] == 's', "Cipher should keep its own copy of the table."
+    pass
+
+def test_PlayfairCipher_encryptBatch():
+    # Tests the batch path against the encrypt() pipeline on mixed text
+    table = createTable("i am entering a pass phrase")
+    cipher = PlayfairCipher(table)
+    message = "Quick! The Quiet Quail, 42 times; ODD length" * 7
+    expected = joinPairs([encrypt(pair, table) for pair in splitString(message)])
+    assert cipher.encryptBatch(message) == expected, "Batch output does not match encrypt()."
+    pass
+
+def test_PlayfairCipher_encryptBatchDoubles():
+    # Tests doubled letters, including xx which becomes xz
+    table = createTable("simple")
+    cipher = PlayfairCipher(table)
+    message = "aabbxxssxzzx"
+    expected = joinPairs([encrypt(pair, table) for pair in splitString(message)])
+    assert cipher.encryptBatch(message) == expected, "Batch output does not match encrypt() on doubled letters."
+    pass
+
+def test_PlayfairCipher_encryptBatchEmpty():
+    # Tests that a message with no letters gives no ciphertext
+    cipher = PlayfairCipher(createTable("simple"))
+    assert cipher.encryptBatch("") == "", "Failed on empty message."
+    assert cipher.encryptBatch("123 ?! qqq") == "", "Failed on message without usable letters."
+    pass
+
+def test_PlayfairCipher_encryptStreamChunks():
+    # Tests that every chunk size gives the same ciphertext as one shot
+    cipher = PlayfairCipher(createTable("i am entering a pass phrase"))
+    message = "Odd: Quiet aa, xx! bookkeeper q zebra. " * 3
+    expected = cipher.encryptMessage(message)
+    for size in range(1, 12):
+        pieces = cipher.encryptStream(io.StringIO(message), chunkSize=size)
+        assert ''.join(pieces) == expected, f"Stream with chunk size {size} failed."
+    pass
+
+def test_PlayfairCipher_encryptStreamIterable():
+    # Tests an iterable of fragments with odd letters at the boundaries
+    cipher = PlayfairCipher(createTable("simple"))
+    fragments = ["a", "b", "", "123", "Qc", "d e", "f"]
+    expected = cipher.encryptMessage(''.join(fragments))
+    assert ''.join(cipher.encryptStream(fragments)) == expected, "Stream over fragments failed."
+    assert ''.join(cipher.encryptStream([])) == "", "Empty stream should give no ciphertext."
+    pass
+
+def test_PlayfairCipher_encryptFile():
+    # Tests encrypting one file object into another
+    cipher = PlayfairCipher(createTable("i am entering a pass phrase"))
+    outfile = io.StringIO()
+    written = cipher.encryptFile(io.StringIO("this is a test message"), outfile, chunkSize=5)
+    assert outfile.getvalue() == "hjntntirnpginprnpm", "Failed to write ciphertext to file."
+    assert written == 18, "Failed to count written characters."
+    pass
+
+# Below are the tests for decrypt() and decryption in PlayfairCipher
+def test_decrypt_rules():
+    # Tests one pair for each rule with the table from the encrypt tests
+    table = [
+        ['i', 'a', 'm', 'e', 'n'],
+        ['t', 'r', 'g', 'p', 's'],
+        ['h', 'b', 'c', 'd', 'f'],
+        ['j', 'k', 'l', 'o', 'u'],
+        ['v', 'w', 'x', 'y', 'z']
+    ]
+    assert decrypt("ni", table) == "en", "Failed on pair in the same row."
+    assert decrypt("ti", table) == "iv", "Failed on pair in the same column."
+    assert decrypt("cn", table) == "fm", "Failed on pair in a rectangle."
+    assert decrypt("mw", table) == "ax", "Failed on pair that came from a doubled letter."
+    pass
+
+def test_decrypt_roundTripAllBigrams():
+    # Tests that decrypt() undoes encrypt() for every pair without a doubled letter
+    table = createTable("Hello, World! This is a Test.")
+    for first in _ALPHABET:
+        for second in _ALPHABET:
+            pair = first + second
+            assert decrypt(encrypt(pair, table), table) == playfairRuleOne(pair), f"Round trip failed for '{pair}'."
+    pass
+
+def test_PlayfairCipher_decryptMessage():
+    # Tests decrypting the example from main()
+    cipher = PlayfairCipher(createTable("i am entering a pass phrase"))
+    assert cipher.decryptMessage("hjntntirnpginprnpm") == "thisisatestmessage", "Failed on example ciphertext."
+    assert cipher.decryptMessage("HJNT ntir-npgi nprnpm") == "thisisatestmessage", "Failed on spaced ciphertext."
+    pass
+
+def test_PlayfairCipher_decryptBatchAndStream():
+    # Tests that every decryption path gives back the encrypted text
+    table = createTable("i am entering a pass phrase")
+    cipher = PlayfairCipher(table)
+    message = "Quiet, odd text! aa xx bookkeeper zebra" * 5
+    ciphertext = joinPairs([encrypt(pair, table) for pair in splitString(message)])
+    expected = joinPairs([playfairRuleOne(pair) for pair in splitString(message)])
+    assert cipher.decryptMessage(ciphertext) == expected, "decryptMessage() failed."
+    assert cipher.decryptBatch(ciphertext) == expected, "decryptBatch() failed."
+    for size in (1, 3, 64):
+        pieces = cipher.decryptStream(io.StringIO(ciphertext), chunkSize=size)
+        assert ''.join(pieces) == expected, f"decryptStream() with chunk size {size} failed."
+    outfile = io.StringIO()
+    cipher.decryptFile(io.StringIO(ciphertext), outfile, chunkSize=5)
+    assert outfile.getvalue() == expected, "decryptFile() failed."
+    pass
+
+def test_PlayfairCipher_decryptInvalid():
+    # Tests ciphertext that encrypt() could never have made
+    cipher = PlayfairCipher(createTable("simple"))
+    for ciphertext in ("abc", "aabb", "ab\u00e9a"):
+        for method in (cipher.decryptMessage, cipher.decryptBatch,
+                       lambda text: ''.join(cipher.decryptStream([text]))):
+            try:
+                method(ciphertext)
+            except ValueError:
+                continue
+            assert False, f"Invalid ciphertext '{ciphertext}' should raise ValueError."
+    pass
+
+# Below are the tests for encryptMessages() and encryptMany()
+def test_PlayfairCipher_encryptMessages():
+    # Tests that each message is padded on its own
+    cipher = PlayfairCipher(createTable("simple"))
+    messages = ["odd", "", "even", "a", "Quiet, please!"]
+    assert cipher.encryptMessages(messages) == [cipher.encryptMessage(message) for message in messages], "encryptMessages() failed."
+    ciphertexts = cipher.encryptMessages(messages)
+    assert cipher.decryptMessages(ciphertexts) == [cipher.decryptMessage(text) for text in ciphertexts], "decryptMessages() failed."
+    pass
+
+def test_encryptMany_inputOrder():
+    # Tests mixed keys across several small chunks
+    phrases = ["simple", "SIMPLE!", "i am entering a pass phrase", "Hello, World!"]
+    records = [(phrases[i % 4], f"message number {i} is odd" * (i % 3)) for i in range(23)]
+    cache = TableCache()
+    results = list(encryptMany(records, workers=3, chunkSize=5, cache=cache))
+    expected = [PlayfairCipher(createTable(phrase)).encryptMessage(message) for phrase, message in records]
+    assert results == expected, "encryptMany() returned wrong or reordered ciphertexts."
+    assert cache.stats()['size'] == 3, "Equivalent passphrases should share one table."
+    pass
+
+def test_encryptMany_processes():
+    # Tests the process pool path
+    records = [("simple", "hello there"), ("other key", "general kenobi"), ("Simple", "bye")]
+    expected = [PlayfairCipher(createTable(phrase)).encryptMessage(message) for phrase, message in records]
+    assert list(encryptMany(records, workers=2, processes=True)) == expected, "Process pool path failed."
+    pass
+
+# Below are the tests for encryptFileParallel()
+def test_encryptFileParallel_matchesSequential():
+    # Tests tiny ranges so that many pairs cross range boundaries
+    table = createTable("i am entering a pass phrase")
+    message = "Quiet, odd text! aa xx 1234 bookkeeper. Q q Q" * 20
+    expected = PlayfairCipher(table).encryptMessage(message)
+    with tempfile.TemporaryDirectory() as folder:
+        inPath = os.path.join(folder, "plain.txt")
+        outPath = os.path.join(folder, "cipher.txt")
+        with open(inPath, 'w') as infile:
+            infile.write(message)
+        for chunkSize in (1, 7, 64, 1 << 20):
+            written = encryptFileParallel(inPath, outPath, table, workers=2, chunkSize=chunkSize)
+            with open(outPath) as outfile:
+                assert outfile.read() == expected, f"Parallel output differs with chunk size {chunkSize}."
+            assert written == len(expected), "Failed to count written characters."
+    pass
+
+def test_encryptFileParallel_empty():
+    # Tests an empty input file
+    table = createTable("simple")
+    with tempfile.TemporaryDirectory() as folder:
+        inPath = os.path.join(folder, "plain.txt")
+        outPath = os.path.join(folder, "cipher.txt")
+        open(inPath, 'w').close()
+        assert encryptFileParallel(inPath, outPath, table, workers=1) == 0, "Empty file should give no ciphertext."
+        with open(outPath) as outfile:
+            assert outfile.read() == "", "Empty file should give an empty output."
+    pass
+
+# Below are the tests for canonicalKey() and TableCache
+def test_canonicalKey_equivalentPhrases():
+    # Tests that phrases giving the same table give the same key
+    key = canonicalKey("simple")
+    assert key == ''.join(''.join(row) for row in createTable("simple")), "Key does not match createTable()."
+    for phrase in ("SIMPLE", "s-i-m-p-l-e!", "simmpplle", "qsimqple"):
+        assert canonicalKey(phrase) == key, f"Failed on equivalent phrase '{phrase}'."
+    assert canonicalKey("") == "abcdefghijklmnoprstuvwxyz", "Failed on empty phrase."
+    pass
+
+def test_canonicalKey_accentedPhrase():
+    # Tests that an accented passphrase gives a valid table or a clear error
+    assert canonicalKey("café", 'fold') == canonicalKey("cafe"), "Failed to fold the passphrase."
+    assert canonicalKey("café", 'drop') == canonicalKey("caf"), "Failed to drop from the passphrase."
+    assert createTable("Ünïcödé", 'fold') == createTable("unicode"), "createTable() should fold too."
+    for call in (lambda: canonicalKey("café"), lambda: createTable("café")):
+        try:
+            call()
+            assert False, "An accented passphrase should fail under 'strict'."
+        except ValueError as error:
+            assert "passphrase" in str(error), "The error should name the passphrase."
+    stderr, sys.stderr = sys.stderr, io.StringIO()
+    try:
+        status = cli(['encrypt', '-k', 'café'], stdin=io.BytesIO(b"hello"), stdout=io.BytesIO())
+    finally:
+        sys.stderr = stderr
+    stdout = io.BytesIO()
+    assert status == 1, "The command line should report a bad passphrase."
+    assert cli(['encrypt', '-k', 'café', '--non-ascii', 'fold'], stdin=io.BytesIO(b"hello"), stdout=stdout) == 0 \
+        and stdout.getvalue().decode() == PlayfairCipher(createTable("cafe")).encryptMessage("hello"), \
+        "Failed to fold the passphrase on the command line."
+    pass
+
+def test_TableCache_sharesTables():
+    # Tests that equivalent phrases share one compiled cipher
+    cache = TableCache(maxsize=4)
+    first = cache.get("Hello, World!")
+    second = cache.get("hello world")
+    assert first is second, "Equivalent phrases should share a cipher."
+    assert first.table == createTable("Hello, World!"), "Cached cipher has the wrong table."
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1, 'maxsize': 4}, "Failed on cache counters."
+    pass
+
+def test_TableCache_evictsLeastRecent():
+    # Tests that the least recently used cipher is dropped first
+    cache = TableCache(maxsize=2)
+    cache.get("alpha")
+    cache.get("bravo")
+    cache.get("alpha")
+    cache.get("charlie")
+    assert cache.stats()['evictions'] == 1, "Cache should have evicted one cipher."
+    cache.get("alpha")
+    assert cache.stats()['hits'] == 2, "Recently used cipher should still be cached."
+    cache.get("bravo")
+    assert cache.stats()['misses'] == 4, "Least recently used cipher should have been evicted."
+    pass
+
+def test_decryptFileParallel_roundTrip():
+    # Tests that the parallel paths decrypt what they encrypt
+    table = createTable("i am entering a pass phrase")
+    message = "Quiet, odd text! aa xx 1234 bookkeeper. Q q Q" * 20
+    expected = PlayfairCipher(table).decryptMessage(PlayfairCipher(table).encryptMessage(message))
+    with tempfile.TemporaryDirectory() as folder:
+        plainPath = os.path.join(folder, "plain.txt")
+        cipherPath = os.path.join(folder, "cipher.txt")
+        resultPath = os.path.join(folder, "result.txt")
+        with open(plainPath, 'w') as infile:
+            infile.write(message)
+        encryptFileParallel(plainPath, cipherPath, table, workers=2, chunkSize=13)
+        decryptFileParallel(cipherPath, resultPath, table, workers=2, chunkSize=9)
+        with open(resultPath) as outfile:
+            assert outfile.read() == expected, "Parallel round trip failed."
+    pass
+
+# Below are the tests for cli()
+def test_cli_files():
+    # Tests encrypting and decrypting files, with and without workers
+    message = "This is a test message, with Quite a few odd bits!"
+    with tempfile.TemporaryDirectory() as folder:
+        plainPath = os.path.join(folder, "plain.txt")
+        keyPath = os.path.join(folder, "key.txt")
+        cipherPath = os.path.join(folder, "cipher.txt")
+        resultPath = os.path.join(folder, "result.txt")
+        with open(plainPath, 'w') as infile:
+            infile.write(message)
+        with open(keyPath, 'w') as keyfile:
+            keyfile.write("i am entering a pass phrase\n")
+        expected = PlayfairCipher(createTable("i am entering a pass phrase")).encryptMessage(message)
+        for workers in ('1', '2'):
+            status = cli(['encrypt', '--key-file', keyPath, '-i', plainPath, '-o', cipherPath,
+                          '--chunk-size', '7', '--workers', workers])
+            assert status == 0, "Encrypting should succeed."
+            with open(cipherPath) as outfile:
+                assert outfile.read() == expected, f"Wrong ciphertext with {workers} worker(s)."
+            status = cli(['decrypt', '-k', 'i am entering a pass phrase', '-i', cipherPath, '-o', resultPath,
+                          '--workers', workers])
+            assert status == 0, "Decrypting should succeed."
+            with open(resultPath) as outfile:
+                assert outfile.read() == "thisisatestmessagewithuiteafewoddbitsx", f"Wrong plaintext with {workers} worker(s)."
+    pass
+
+def test_cli_streams():
+    # Tests stdin to stdout, and an error for bad ciphertext
+    stdout = io.BytesIO()
+    status = cli(['encrypt', '-k', 'i am entering a pass phrase'],
+                 stdin=io.BytesIO(b"this is a test message"), stdout=stdout)
+    assert status == 0 and stdout.getvalue() == b"hjntntirnpginprnpm", "Failed on stdin to stdout."
+    stderr, sys.stderr = sys.stderr, io.StringIO()
+    try:
+        status = cli(['decrypt', '-k', 'simple'], stdin=io.BytesIO(b"abc"), stdout=io.BytesIO())
+    finally:
+        sys.stderr = stderr
+    assert status == 1, "Odd ciphertext should fail."
+    pass
+
+def test_cli_missingFiles():
+    # Tests that a missing key file or input file is reported, not raised
+    with tempfile.TemporaryDirectory() as folder:
+        missing = os.path.join(folder, "missing.txt")
+        for args in (['encrypt', '--key-file', missing], ['encrypt', '-k', 'simple', '-i', missing]):
+            stderr, sys.stderr = sys.stderr, io.StringIO()
+            try:
+                status = cli(args, stdin=io.BytesIO(b"text"), stdout=io.BytesIO())
+                message = sys.stderr.getvalue()
+            finally:
+                sys.stderr = stderr
+            assert status == 1 and message.startswith("playfair: ") and "missing.txt" in message, \
+                f"Failed to report the missing file for {args}."
+    pass
+
+# Below are the tests for the instrumentation layer
+def test_instrumentation_referencePath():
+    # Tests counts and timings for the reference pipeline
+    table = [
+        ['i', 'a', 'm', 'e', 'n'],
+        ['t', 'r', 'g', 'p', 's'],
+        ['h', 'b', 'c', 'd', 'f'],
+        ['j', 'k', 'l', 'o', 'u'],
+        ['v', 'w', 'x', 'y', 'z']
+    ]
+    calls = []
+    enableInstrumentation(lambda stage, seconds: calls.append(stage))
+    try:
+        pairs = splitString("enivfmaa")
+        joinPairs([encrypt(pair, table) for pair in pairs])
+        snapshot = instrumentationSnapshot()
+    finally:
+        final = disableInstrumentation()
+    assert snapshot['pairs'] == 4, "Failed to count pairs."
+    assert snapshot['rules'] == {'playfairRuleOne': 1, 'playfairRuleTwo': 1,
+                                 'playfairRuleThree': 1, 'playfairRuleFour': 2}, "Failed to count rules."
+    assert snapshot['stages']['encrypt']['calls'] == 4, "Failed to time encrypt()."
+    assert calls == ['splitString', 'encrypt', 'encrypt', 'encrypt', 'encrypt', 'joinPairs'], "Failed to call the hook."
+    assert final == snapshot, "Disabling should return the final snapshot."
+    pass
+
+def test_instrumentation_compiledCipher():
+    # Tests that building a cipher isn't counted but every path encrypting with it is
+    enableInstrumentation()
+    try:
+        cipher = PlayfairCipher(createTable("i am entering a pass phrase"))
+        assert instrumentationSnapshot()['pairs'] == 0, "Building a cipher should not count as traffic."
+        cipher.encryptBatch("enivfmaa" * 3)
+        batch = instrumentationSnapshot()
+        cipher.encryptMessage("enivfmaa")
+        cipher.encryptPairs(["en", "iv"])
+        cipher.encrypt("aa")
+        snapshot = instrumentationSnapshot()
+    finally:
+        disableInstrumentation()
+    assert batch['pairs'] == 12, "Failed to count pairs of the batch path."
+    assert snapshot['pairs'] == 12 + 4 + 2 + 1, "Failed to count pairs of the message and pair paths."
+    assert snapshot['rules']['playfairRuleOne'] == 3 + 1 + 1, "Failed to count doubled letters."
+    assert snapshot['stages']['PlayfairCipher']['calls'] == 1, "Failed to time building the cipher."
+    assert snapshot['stages']['createTable']['calls'] == 1, "Failed to time createTable()."
+    pass
+
+def test_instrumentation_off():
+    # Tests that turning it off puts the plain functions back
+    enableInstrumentation()
+    disableInstrumentation()
+    assert not hasattr(encrypt, '__wrapped__'), "encrypt() should not be wrapped any more."
+    assert not any(hasattr(getattr(PlayfairCipher, name), '__wrapped__') for name in _COUNTED_METHODS), \
+        "The lookup methods should not be wrapped any more."
+    assert instrumentationSnapshot() is None, "There should be no snapshot while off."
+    assert disableInstrumentation() is None, "Disabling twice should be harmless."
+    pass
+
+# Below are the tests for normaliseText()
+def test_normaliseText_matchesSplitString():
+    # Tests that every kind of ASCII input filters like splitString()
+    for text in ("Quiet, odd text! aa 1234", "", "qQq", "\x00\x7fAbZ \t\n"):
+        expected = ''.join(filter(lambda x: x.isalpha() and x != 'q', text.lower()))
+        data = text.encode('ascii')
+        for item in (text, data, bytearray(data), memoryview(data)):
+            result = normaliseText(item)
+            assert type(result) is bytes and result.decode('ascii') == expected, f"Failed on {item!r}."
+    pass
+
+def test_normaliseText_policies():
+    # Tests the three ways of handling letters outside ASCII
+    text = "Café Noël, 3 €"
+    for item in (text, text.encode('utf-8')):
+        try:
+            normaliseText(item)
+            assert False, "Strict policy should reject accented letters."
+        except ValueError:
+            pass
+        assert normaliseText(item, 'drop') == b"cafnol", "Failed to drop accented letters."
+        assert normaliseText(item, 'fold') == b"cafenoel", "Failed to fold accented letters."
+    assert normaliseText("a—b €".encode('utf-8')) == b"ab", "Non-ASCII punctuation should just be dropped."
+    try:
+        normaliseText("abc", 'ignore')
+        assert False, "Unknown policy should fail."
+    except ValueError:
+        pass
+    pass
+
+def test_splitString_createTable_asciiFastPath():
+    # Tests that the fast path gives the same output as the original filters
+    text = ''.join(map(chr, range(128))) * 2 + "Bookkeeper"
+    filtered = ''.join(filter(lambda x: x.isalpha() and x != 'q', text.lower()))
+    assert ''.join(splitString(text)) == filtered + ('x' if len(filtered) % 2 else ''), "splitString() changed."
+    assert splitString("Café") == ['ca', 'fé'], "Non-ASCII text should keep the original filter."
+    letters = list(dict.fromkeys(filtered + _ALPHABET))
+    assert createTable(text) == [letters[i:i+5] for i in range(0, 25, 5)], "createTable() changed."
+    pass
+
+def test_PlayfairCipher_utf8Chunks():
+    # Tests UTF-8 characters cut in two between stream chunks and file ranges
+    table = createTable("i am entering a pass phrase")
+    message = "Crème brûlée, naïve café — déjà vu! " * 5
+    expected = PlayfairCipher(table).encryptBatch(normaliseText(message, 'fold'))
+    data = message.encode('utf-8')
+    cipher = PlayfairCipher(table, 'fold')
+    for size in (1, 2, 3, 5):
+        chunks = [data[i:i+size] for i in range(0, len(data), size)]
+        assert ''.join(cipher.encryptStream(chunks)) == expected, f"Stream failed with {size}-byte chunks."
+    with tempfile.TemporaryDirectory() as folder:
+        inPath = os.path.join(folder, "plain.txt")
+        outPath = os.path.join(folder, "cipher.txt")
+        with open(inPath, 'wb') as infile:
+            infile.write(data)
+        for chunkSize in (1, 3, 7):
+            encryptFileParallel(inPath, outPath, table, workers=2, chunkSize=chunkSize, nonAscii='fold')
+            with open(outPath) as outfile:
+                assert outfile.read() == expected, f"Parallel output differs with chunk size {chunkSize}."
+    stdout = io.BytesIO()
+    status = cli(['encrypt', '-k', 'i am entering a pass phrase', '--non-ascii', 'fold'],
+                 stdin=io.BytesIO(data), stdout=stdout)
+    assert status == 0 and stdout.getvalue() == expected.encode('ascii'), "Failed on --non-ascii."
+    pass
+
+# Below are the tests for PlayfairTable
+def test_PlayfairTable_listCompatible():
+    # Tests that the rule functions give the same results on both forms
+    phrase = "i am entering a pass phrase"
+    listTable = createTable(phrase)
+    table = PlayfairTable.fromPhrase(phrase)
+    assert table == listTable and table.toList() == listTable, "Failed to match createTable()."
+    assert PlayfairTable.fromList(listTable) == table, "Failed to build from a list."
+    assert table[1][2] == listTable[1][2] and len(table) == 5, "Failed to index like a list."
+    assert table[1:3] == tuple(''.join(row) for row in listTable[1:3]) and table[::-2] == (table[4], table[2], table[0]), \
+        "Failed to slice like a list."
+    assert table[7:] == () and table[-1] == table[4], "Failed on slices and indexes from the end."
+    assert table.position('z') == (4, 4), "Failed on position of 'z'."
+    for first in table.letters:
+        for second in table.letters:
+            pair = first + second
+            assert encrypt(pair, table) == encrypt(pair, listTable), f"Failed to encrypt '{pair}'."
+            if first != second:
+                assert decrypt(pair, table) == decrypt(pair, listTable), f"Failed to decrypt '{pair}'."
+    pass
+
+def test_PlayfairTable_hashPickleImmutable():
+    # Tests hashing, pickling, immutability and bad keys
+    table = PlayfairTable.fromPhrase("simple")
+    assert hash(table) == hash(PlayfairTable.fromPhrase("SIMPLE!")), "Equal tables should hash the same."
+    assert {table: 1}[PlayfairTable.fromList(createTable("simple"))] == 1, "Failed as a dict key."
+    copy = pickle.loads(pickle.dumps(table))
+    assert copy == table and copy.rows == table.rows, "Failed to pickle."
+    assert len(pickle.dumps(table)) < len(pickle.dumps(createTable("simple"))), "Pickle should be smaller."
+    try:
+        table.key = b"x" * 25
+        assert False, "Tables should be immutable."
+    except AttributeError:
+        pass
+    for key in ("abc", "a" * 25, "ABCDEFGHIJKLMNOPRSTUVWXYZ", "abcdefghijklmnoprstuvwxyé"):
+        try:
+            PlayfairTable(key)
+            assert False, f"'{key}' should not make a table."
+        except ValueError:
+            pass
+    pass
+
+# Below are the tests for PlayfairSession
+def test_PlayfairSession_fragments():
+    # Tests that any way of cutting a message gives the one-shot ciphertext
+    cipher = PlayfairCipher(createTable("i am entering a pass phrase"))
+    message = "Hello there, bookkeeper! Quick odd messages arrive: aa, xx, q."
+    expected = joinPairs([encrypt(pair, cipher.table) for pair in splitString(message)])
+    for size in (1, 2, 3, 7, len(message)):
+        session = cipher.encryptSession()
+        pieces = [session.feed(message[i:i+size]) for i in range(0, len(message), size)]
+        assert ''.join(pieces) + session.finish() == expected, f"Failed with {size}-character fragments."
+    session = cipher.encryptSession()
+    assert session.feed("h") == "" and session.feed("e") == expected[:2], "Pairs should come out as soon as complete."
+    try:
+        session.finish()
+        session.feed("more")
+        assert False, "Feeding a finished session should fail."
+    except ValueError:
+        pass
+    pass
+
+def test_PlayfairSession_decrypt():
+    # Tests decrypting in fragments, bytes cut inside a character, and an odd end
+    cipher = PlayfairCipher(createTable("i am entering a pass phrase"), 'fold')
+    session = cipher.decryptSession()
+    text = "hjntn—tirnpginprnpm".encode('utf-8')
+    output = ''.join(session.feed(text[i:i+1]) for i in range(len(text))) + session.finish()
+    assert output == "thisisatestmessage", "Failed to decrypt in fragments."
+    session = cipher.decryptSession()
+    session.feed("abc")
+    try:
+        session.finish()
+        assert False, "Odd ciphertext should fail."
+    except ValueError:
+        pass
+    pass
+
+def test_PlayfairSession_mixedFragments():
+    # Tests str and bytes fragments in one session, and a cut character followed by str
+    cipher = PlayfairCipher(createTable("i am entering a pass phrase"), 'fold')
+    session = cipher.encryptSession()
+    pieces = [session.feed(piece) for piece in (b"thi", "s is", bytearray(b" a t"), "est m", memoryview(b"essag"), "e")]
+    assert ''.join(pieces) + session.finish() == "hjntntirnpginprnpm", "Failed on mixed fragments."
+    session = cipher.encryptSession()
+    output = session.feed(b"caf\xc3")
+    assert session.letters == 3, "The cut character should be kept back."
+    try:
+        session.feed("s")
+        assert False, "A str fragment can't finish a cut character."
+    except ValueError:
+        pass
+    output += session.feed(b"\xa9s") + session.finish()
+    assert output == cipher.encryptMessage("cafes"), "A failed feed should leave the session as it was."
+    pass
+
+# Below are the tests for OffsetIndex and decryptFileRange()
+def test_OffsetIndex_decryptFileRange():
+    # Tests that ranges read through the index match a full decryption
+    table = createTable("i am entering a pass phrase")
+    cipher = PlayfairCipher(table, 'fold')
+    data = ("Record %d: Crème brûlée, 12 odd bookkeepers! " * 40 % tuple(range(40))).encode('utf-8')
+    full = cipher.decryptMessage(cipher.encryptBatch(data))
+    with tempfile.TemporaryDirectory() as folder:
+        inPath = os.path.join(folder, "plain.txt")
+        outPath = os.path.join(folder, "cipher.txt")
+        indexPath = os.path.join(folder, "cipher.idx")
+        with open(inPath, 'wb') as infile:
+            infile.write(data)
+        for parallel in (False, True):
+            index = OffsetIndex()
+            if parallel:
+                encryptFileParallel(inPath, outPath, table, workers=2, chunkSize=97, nonAscii='fold', index=index)
+            else:
+                with open(inPath, 'rb') as infile, open(outPath, 'w') as outfile:
+                    cipher.encryptFile(infile, outfile, chunkSize=97, index=index)
+            index.save(indexPath)
+            index = OffsetIndex.load(indexPath)
+            assert index.plainOffsets[-1] == len(data), "The last checkpoint should be the end of the input."
+            for start, end in ((0, 0), (0, 10), (150, 400), (97, 194), (1000, len(data)), (len(data), len(data))):
+                cipherStart, cipherEnd = index.locate(start, end)
+                before = len(normaliseText(data[:start], 'fold'))
+                through = len(normaliseText(data[:end], 'fold'))
+                assert cipherStart <= before and cipherEnd >= min(through, len(full)), f"Range {start}:{end} is not covered."
+                assert cipherEnd - cipherStart <= through - before + 2 * 97, f"Range {start}:{end} reads too much."
+                assert decryptFileRange(outPath, index, table, start, end) == full[cipherStart:cipherEnd], \
+                    f"Failed to decrypt range {start}:{end}."
+        # Checkpoints every 31 bytes while reading 97 at a time, read back with the compiled cipher
+        index = OffsetIndex()
+        with open(inPath, 'rb') as infile, open(outPath, 'w') as outfile:
+            assert cipher.encryptFile(infile, outfile, chunkSize=97, index=index, indexInterval=31) == len(full), \
+                "The index interval should not change the ciphertext."
+        assert len(index.plainOffsets) == -(-len(data) // 31) + 1, "There should be one checkpoint per interval."
+        for start, end in ((0, 10), (150, 400), (31, 62), (1000, len(data))):
+            cipherStart, cipherEnd = index.locate(start, end)
+            through = len(normaliseText(data[:end], 'fold'))
+            assert cipherEnd - cipherStart <= through - len(normaliseText(data[:start], 'fold')) + 2 * 31, \
+                f"Range {start}:{end} reads too much for the interval."
+            assert decryptFileRange(outPath, index, cipher, start, end) == full[cipherStart:cipherEnd], \
+                f"Failed to decrypt range {start}:{end} with a compiled cipher."
+    pass
+
+def test_cli_indexRange():
+    # Tests writing an index and reading a range back from the command line
+    with tempfile.TemporaryDirectory() as folder:
+        inPath = os.path.join(folder, "plain.txt")
+        outPath = os.path.join(folder, "cipher.txt")
+        indexPath = os.path.join(folder, "cipher.idx")
+        with open(inPath, 'w') as infile:
+            infile.write("first record. " * 50 + "the target" + " last record." * 50)
+        assert cli(['encrypt', '-k', 'simple', '-i', inPath, '-o', outPath, '--index', indexPath,
+                    '--chunk-size', '64']) == 0, "Encrypting with an index failed."
+        stdout = io.BytesIO()
+        assert cli(['decrypt', '-k', 'simple', '-i', outPath, '--index', indexPath,
+                    '--range', '700:710'], stdout=stdout) == 0, "Reading a range failed."
+        assert b"thetarget" in stdout.getvalue() and len(stdout.getvalue()) < 200, "Failed to read the range."
+    pass
+
+# Below are the tests for PlayfairCascade
+def test_PlayfairCascade_matchesRounds():
+    # Tests every bigram and some messages against running the rounds one by one
+    tables = [createTable(phrase) for phrase in ("i am entering a pass phrase", "simple", "xylophone quartz")]
+    cascade = PlayfairCascade(tables)
+    for pair in cascade.bigrams:
+        expected = pair
+        for table in tables:
+            expected = encrypt(expected, table)
+        assert cascade.encrypt(pair) == expected, f"Failed on '{pair}'."
+    message = "Hello there, bookkeeper! Odd xx aa zz messages."
+    expected = message
+    for table in tables:
+        expected = PlayfairCipher(table).encryptMessage(expected)
+    assert cascade.encryptMessage(message) == expected, "encryptMessage() differs from the rounds."
+    assert cascade.encryptBatch(message) == expected, "encryptBatch() differs from the rounds."
+    assert ''.join(cascade.encryptStream([message[:5], message[5:]])) == expected, "encryptStream() differs."
+    assert cascade.decryptBatch(expected) == PlayfairCipher(tables[0]).decryptBatch(
+        PlayfairCipher(tables[0]).encryptBatch(message)), "Failed to decrypt through every round."
+    pass
+
+def test_PlayfairCascade_oneRound():
+    # Tests that one round is the plain cipher, and that bad input fails
+    table = createTable("simple")
+    assert PlayfairCascade([table]).bigrams == PlayfairCipher(table).bigrams, "One round should be the plain cipher."
+    for tables in ([], [table, [['a'] * 5] * 5]):
+        try:
+            PlayfairCascade(tables)
+            assert False, "A bad list of tables should fail."
+        except ValueError:
+            pass
+    pass
+
+# Below are the tests for SharedMemoryPool
+def test_SharedMemoryPool_matchesBatch():
+    # Tests small work items against the one-process batch path, and errors
+    table = createTable("i am entering a pass phrase")
+    cipher = PlayfairCipher(table)
+    message = "Quiet, odd text! aa xx 1234 bookkeeper. Q q Q" * 50
+    with SharedMemoryPool(table, workers=2, chunkSize=101) as pool:
+        ciphertext = pool.encrypt(message)
+        assert ciphertext == cipher.encryptBatch(message), "Failed to encrypt."
+        assert pool.encrypt(message.encode('ascii')) == ciphertext, "Failed on bytes input."
+        assert pool.decrypt(ciphertext) == cipher.decryptBatch(ciphertext), "Failed to decrypt."
+        assert pool.encrypt("") == "", "Empty input should give empty output."
+        for bad in ("abc", "aabb" * 50):
+            try:
+                pool.decrypt(bad)
+                assert False, f"Decrypting '{bad[:8]}' should fail."
+            except ValueError:
+                pass
+    pass
+
+# Below are the tests for KeyRing
+def test_compileBigrams_matchesCipher():
+    # Tests the fast compiler against the rule functions on random tables
+    rng = random.Random(5)
+    tables = [createTable("simple"), createTable("xylophone"), createTable("")]
+    for _ in range(20):
+        letters = list(_ALPHABET)
+        rng.shuffle(letters)
+        tables.append(PlayfairTable(''.join(letters)))
+    for table in tables:
+        cipher = PlayfairCipher(table)
+        compiled = PlayfairCipher.fromCompiled(cipher.table, *_compileBigrams(cipher.table))
+        assert compiled.bigrams == cipher.bigrams, f"Encryption differs for {cipher.table!r}."
+        assert compiled.plainBigrams == cipher.plainBigrams, f"Decryption differs for {cipher.table!r}."
+    pass
+
+def test_KeyRing_writeAppend():
+    # Tests building, looking up, appending and replacing keys
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "keys.ring")
+        assert KeyRing.write(path, [(f"tenant-{i}", f"phrase {i}") for i in range(50)]) == 50, "Wrong count."
+        with KeyRing(path) as ring:
+            assert len(ring) == 50 and "tenant-7" in ring and "tenant-70" not in ring, "Failed to find ids."
+            assert ring.table("tenant-7") == createTable("phrase 7"), "Failed to store the table."
+            cipher = ring.cipher("tenant-7")
+            reference = PlayfairCipher(createTable("phrase 7"))
+            message = "Quiet, odd text! aa xx bookkeeper" * 10
+            assert cipher.encryptBatch(message) == reference.encryptBatch(message), "Failed to encrypt."
+            assert cipher.encryptMessage(message) == reference.encryptMessage(message), "Failed on short lookups."
+            try:
+                ring.table("tenant-70")
+                assert False, "A missing id should fail."
+            except KeyError:
+                pass
+
+        assert KeyRing.append(path, [("tenant-7", "new phrase"), ("a-first", createTable("simple"))]) == 51, \
+            "Failed to append."
+        with KeyRing(path) as ring:
+            assert list(ring.ids())[:2] == ["a-first", "tenant-0"], "Ids should stay sorted."
+            assert ring.table("tenant-7") == createTable("new phrase"), "Failed to replace a key."
+            assert ring.table("tenant-8") == createTable("phrase 8"), "Failed to keep old keys."
+        assert os.listdir(folder) == ["keys.ring"], "Temporary files were left behind."
+        try:
+            KeyRing.write(path, [("x" * 33, "too long")])
+            assert False, "An id that is too long should fail."
+        except ValueError:
+            pass
+        with KeyRing(path) as ring:
+            assert len(ring) == 51, "A failed write should leave the old keyring."
+    pass
+
+def test_KeyRing_close():
+    # Tests that closing unmaps the file once no cipher reads from it, and leaves its ciphers working
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "keys.ring")
+        KeyRing.write(path, [("k1", "i am entering a pass phrase")])
+        with KeyRing(path) as ring:
+            mapped = ring._mapped
+            ring.table("k1")
+        assert mapped.closed, "Leaving the with block should unmap the file."
+        with KeyRing(path) as ring:
+            cipher = ring.cipher("k1")
+            if np is not None:
+                assert 'bigrams' not in vars(cipher) and 'ruleCodes' not in vars(cipher), \
+                    "The lookup dicts should only be filled in when used."
+        ring.close()
+        assert cipher.encryptBatch("this is a test message") == "hjntntirnpginprnpm", "The cipher should outlive the map."
+        assert cipher.encrypt("th") == "hj" and cipher.decrypt("hj") == "th", "The lookup dicts should fill in after close."
+        try:
+            ring.cipher("k1")
+            assert False, "A closed keyring should refuse lookups."
+        except ValueError:
+            pass
+        with open(path, 'r+b') as keyfile:
+            keyfile.truncate(os.path.getsize(path) - 1)
+        try:
+            KeyRing(path)
+            assert False, "A truncated keyring should be refused."
+        except ValueError:
+            pass
+    pass
+
+# Below are the tests for PlayfairVariant and PlayfairVariantCipher
+def test_PlayfairVariant_default():
+    # Tests that the default variant compiles to the same cipher as PlayfairCipher
+    table = createTable("i am entering a pass phrase")
+    variant = PlayfairVariant()
+    cipher = PlayfairVariantCipher(variant.createTable("i am entering a pass phrase"), variant)
+    reference = PlayfairCipher(table)
+    assert cipher.table == table, "Default variant should make the same table."
+    assert cipher.bigrams == reference.bigrams and cipher.plainBigrams == reference.plainBigrams, "Tables differ."
+    assert cipher.ruleCodes == reference.ruleCodes, "Rule codes differ."
+    message = "Quite a long test message, with doubled letters: bookkeeper, xx and zz!" * 5
+    assert cipher.encryptMessage(message) == reference.encryptMessage(message), "Failed on encryptMessage."
+    assert cipher.encryptBatch(message) == reference.encryptBatch(message), "Failed on encryptBatch."
+    assert variant.normaliseText(message) == normaliseText(message), "Filtering differs."
+    pass
+
+def test_PlayfairVariant_classic():
+    # Tests the I/J-merged table on the textbook example and from the command line
+    cipher = PlayfairVariant.classic().cipher("playfair example")
+    assert ''.join(cipher.table[1]) == "irexm", "Failed to build the classic table."
+    assert cipher.encryptMessage("hide the gold in the tr") == "bmodzbxdnabekudmui", "Failed on the textbook example."
+    assert cipher.encryptBatch("HJDE the gold in the TR") == "bmodzbxdnabekudmui", "J should be read as I."
+    assert cipher.encryptMessage("q") == cipher.encrypt("qx"), "Q should be kept and padded."
+    try:
+        PlayfairVariant.classic().cipher("café")
+        assert False, "A strict variant should reject accented letters in the passphrase."
+    except ValueError:
+        pass
+    assert PlayfairVariant.classic().createTable("café", 'fold') == PlayfairVariant.classic().createTable("cafe"), \
+        "Failed to fold the passphrase."
+    assert PlayfairVariant.classic().cipher("café", 'drop').table == PlayfairVariant.classic().createTable("caf"), \
+        "Failed to drop from the passphrase."
+    stdout = io.BytesIO()
+    status = cli(['encrypt', '-k', 'playfair example', '--variant', 'classic'],
+                 stdin=io.BytesIO(b"hide the gold in the tr"), stdout=stdout)
+    assert status == 0 and stdout.getvalue() == b"bmodzbxdnabekudmui", "Failed on --variant."
+    pass
+
+def test_PlayfairVariant_alphanumeric():
+    # Tests the 6x6 table with digits, its wrap-around and its streaming paths
+    variant = PlayfairVariant.alphanumeric()
+    cipher = variant.cipher("")
+    assert len(cipher.table) == 6 and cipher.table[5] == list("456789"), "Failed to build the 6x6 table."
+    # Same row wraps at column 6, same column, rectangle, then 99 becomes 9x
+    assert cipher.encryptMessage("af a4 bi 99") == "bagachf3", "Failed on the 6x6 rules."
+    message = "Order 66 shipped to 221B Baker St. at 10:45, all 1296 bigrams!" * 9
+    expected = cipher.encryptMessage(message)
+    assert cipher.encryptBatch(message) == expected, "Failed on encryptBatch."
+    assert ''.join(cipher.encryptStream(message[i:i+11] for i in range(0, len(message), 11))) == expected, \
+        "Failed on encryptStream."
+    assert cipher.decryptBatch(expected) == ''.join(variant.playfairRuleOne(pair) for pair in variant.splitString(message)), \
+        "Failed to decrypt."
+    for spec in [("abc", 2), (_ALPHABET, 5, None, 'q'), (_ALPHABET, 5, {'q': 'k', 'a': 'b'})]:
+        try:
+            PlayfairVariant(*spec)
+            assert False, f"{spec} should not be a valid variant."
+        except ValueError:
+            pass
+    pass
+
 ###############################################################    
     
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(cli())
     main()        
\ No newline at end of file
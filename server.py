@@ -0,0 +1,486 @@
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import deque
+
+from playfair import PlayfairCipher, TableCache, canonicalKey, createTable
+
+class PlayfairServer:
+    '''
+    An asyncio encryption service for localhost.  Clients send one JSON
+    request per line, such as
+
+        {"id": 1, "op": "encrypt", "key": "a pass phrase", "text": "hello"}
+
+    and get back one JSON line with the same id and either a "result" or
+    an "error".  The op can be "encrypt", "decrypt" or "stats".
+
+    Requests that share a table and arrive within a short window are
+    coalesced into one encryptMessages() or decryptMessages() call on the
+    compiled cipher.  At most maxPending requests are in flight at once;
+    past that the server stops reading from its sockets, which pushes
+    back on the clients through TCP.  A request line longer than maxLine
+    bytes gets an error reply with a null id, and the connection is
+    closed, since the rest of that line can't be told from the next
+    request.
+
+    Input:   string:      address to listen on
+    Input:   int:         port to listen on (0 picks a free one)
+    Input:   float:       seconds to wait for more requests with the same key
+    Input:   int:         largest number of requests in flight
+    Input:   int:         largest number of messages in one batch
+    Input:   TableCache:  cache of compiled tables
+    Input:   int:         longest request line in bytes
+    '''
+    def __init__(self, host='127.0.0.1', port=0, window=0.002, maxPending=1024,
+                 maxBatch=512, cache=None, maxLine=1 << 20):
+        self.host = host
+        self.port = port
+        self.window = window
+        self.maxBatch = maxBatch
+        self.maxLine = maxLine
+        self.cache = cache or TableCache()
+        self.requests = 0
+        self.batches = 0
+        self._latencies = deque(maxlen=10000)
+        self._slots = asyncio.Semaphore(maxPending)
+        self._queues = {}
+        self._server = None
+        self._started = None
+
+    async def start(self):
+        '''
+        Starts listening.  When port was 0 the chosen port is stored in
+        self.port.
+        '''
+        self._server = await asyncio.start_server(self._handleConnection, self.host, self.port, limit=self.maxLine)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started = time.perf_counter()
+
+    async def stop(self):
+        '''
+        Stops listening and closes the server.
+        '''
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def serveForever(self):
+        '''
+        Starts the server and runs until it is cancelled.
+        '''
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def stats(self):
+        '''
+        Returns the service counters.  Latencies are measured from the
+        time a request is read to the time its answer is written, over
+        the last 10000 requests.
+
+        Output:  dict:  requests, batches, requests/sec, p50 and p99 in seconds
+        '''
+        latencies = sorted(self._latencies)
+        elapsed = time.perf_counter() - self._started if self._started else 0
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'rps': self.requests / elapsed if elapsed else 0.0,
+            'p50': _percentile(latencies, 0.50),
+            'p99': _percentile(latencies, 0.99),
+        }
+
+    async def submit(self, op, key, text):
+        '''
+        Queues one message for the next batch with the same table and
+        waits for its result.
+
+        Input:   string:  "encrypt" or "decrypt"
+        Input:   string:  a passphrase
+        Input:   string:  message
+        Output:  string:  result
+        '''
+        if op not in ('encrypt', 'decrypt'):
+            raise ValueError(f"unknown op '{op}'")
+        if not isinstance(key, str) or not isinstance(text, str):
+            raise TypeError("key and text must be strings")
+
+        batchKey = (op, canonicalKey(key))
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(batchKey)
+        if queue is None:
+            # The first request for a key opens the window for that key
+            queue = self._queues[batchKey] = []
+            asyncio.get_running_loop().call_later(self.window, self._flush, batchKey, queue)
+        queue.append((text, future))
+
+        if len(queue) >= self.maxBatch:
+            self._flush(batchKey, queue)
+        return await future
+
+    def _flush(self, batchKey, queue):
+        '''
+        Runs one queued batch through the compiled cipher and hands every
+        request its result.
+
+        Input:   tuple:  (op, canonical key)
+        Input:   list:   (message, future) pairs
+        '''
+        # The timer may fire after the batch was already flushed for being full
+        if self._queues.get(batchKey) is not queue:
+            return
+        del self._queues[batchKey]
+        self.batches += 1
+
+        op, key = batchKey
+        texts = [text for text, _ in queue]
+        try:
+            cipher = self.cache.get(key)
+            transform = cipher.encryptMessages if op == 'encrypt' else cipher.decryptMessages
+            try:
+                results = transform(texts)
+            except Exception:
+                # Falls back to one message at a time so only bad requests fail
+                results = []
+                for text in texts:
+                    try:
+                        results.append(transform([text])[0])
+                    except Exception as error:
+                        results.append(error)
+        except Exception as error:
+            # A timer callback must never leave its futures waiting
+            results = [error] * len(queue)
+
+        for (_, future), result in zip(queue, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _handleConnection(self, reader, writer):
+        '''
+        Reads requests from one client until it disconnects.
+
+        Input:   StreamReader:  client input
+        Input:   StreamWriter:  client output
+        '''
+        tasks = set()
+        try:
+            while True:
+                # Waits for a free slot before reading, for backpressure;
+                # the slot goes to the request's task, or back right away
+                await self._slots.acquire()
+                task = None
+                try:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    task = asyncio.create_task(self._handleRequest(line, writer, time.perf_counter()))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                except (ValueError, asyncio.LimitOverrunError):
+                    # readline() gives up on a line past the limit
+                    response = {'id': None, 'error': f"request line longer than {self.maxLine} bytes"}
+                    writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                    await writer.drain()
+                    break
+                finally:
+                    if task is None:
+                        self._slots.release()
+        except ConnectionError:
+            pass
+        finally:
+            # Lets the requests already read finish before closing
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    async def _handleRequest(self, line, writer, received):
+        '''
+        Answers one request line.
+
+        Input:   bytes:         JSON request
+        Input:   StreamWriter:  client output
+        Input:   float:         time the request was read
+        '''
+        try:
+            response = {}
+            try:
+                request = json.loads(line)
+                response['id'] = request.get('id')
+                if request.get('op') == 'stats':
+                    response['result'] = self.stats()
+                else:
+                    response['result'] = await self.submit(request.get('op'), request['key'], request['text'])
+            except (KeyError, TypeError, ValueError, AttributeError) as error:
+                response['error'] = str(error) or type(error).__name__
+
+            writer.write(json.dumps(response).encode('utf-8') + b'\n')
+            await writer.drain()
+            self.requests += 1
+            self._latencies.append(time.perf_counter() - received)
+        except ConnectionError:
+            pass
+        finally:
+            self._slots.release()
+
+def _percentile(values, fraction):
+    '''
+    Returns a percentile of a sorted list, or 0.0 when it is empty.
+
+    Input:   list:   sorted values
+    Input:   float:  fraction between 0 and 1
+    Output:  float:  percentile
+    '''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class PlayfairClient:
+    '''
+    A small client for PlayfairServer that can have many requests in
+    flight on one connection; answers are matched to requests by id.
+
+    When the connection closes or fails, every request still waiting
+    fails with ConnectionError, and so does any later one.
+
+    Input:   string:  server address
+    Input:   int:     server port
+    Input:   int:     longest answer line in bytes
+    '''
+    def __init__(self, host, port, maxLine=1 << 20):
+        self.host = host
+        self.port = port
+        self.maxLine = maxLine
+        self._ids = itertools.count()
+        self._waiting = {}
+        self._reader = None
+        self._writer = None
+        self._readTask = None
+
+    async def connect(self):
+        '''
+        Opens the connection.
+        '''
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port, limit=self.maxLine)
+        self._readTask = asyncio.create_task(self._readResponses())
+
+    async def close(self):
+        '''
+        Closes the connection.
+        '''
+        self._writer.close()
+        await self._writer.wait_closed()
+        self._readTask.cancel()
+
+    async def request(self, op, key=None, text=None):
+        '''
+        Sends one request and waits for its answer.
+
+        Input:   string:  "encrypt", "decrypt" or "stats"
+        Input:   string:  a passphrase
+        Input:   string:  message
+        Output:  string or dict:  the result
+        '''
+        if self._readTask.done():
+            raise ConnectionError("the connection to the server is closed")
+        requestId = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[requestId] = future
+        request = {'id': requestId, 'op': op, 'key': key, 'text': text}
+        self._writer.write(json.dumps(request).encode('utf-8') + b'\n')
+        await self._writer.drain()
+        return await future
+
+    async def encrypt(self, key, text):
+        '''
+        Encrypts a message on the server.
+
+        Input:   string:  a passphrase
+        Input:   string:  plaintext
+        Output:  string:  ciphertext
+        '''
+        return await self.request('encrypt', key, text)
+
+    async def decrypt(self, key, text):
+        '''
+        Decrypts a message on the server.
+
+        Input:   string:  a passphrase
+        Input:   string:  ciphertext
+        Output:  string:  plaintext
+        '''
+        return await self.request('decrypt', key, text)
+
+    async def _readResponses(self):
+        '''
+        Hands every answer line to the request waiting for it.  When the
+        connection ends, the requests still waiting fail.
+        '''
+        reason = "the server closed the connection"
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self._waiting.pop(response['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in response:
+                    future.set_exception(ValueError(response['error']))
+                else:
+                    future.set_result(response['result'])
+        except Exception as error:
+            reason = f"the connection failed: {error}"
+        finally:
+            waiting, self._waiting = self._waiting, {}
+            for future in waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(reason))
+
+def main():
+    '''
+    Runs the server from the command line until it is interrupted
+    '''
+    parser = argparse.ArgumentParser(description="Playfair encryption service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8750)
+    parser.add_argument('--window', type=float, default=0.002,
+                        help="seconds to wait for more requests with the same key")
+    parser.add_argument('--max-pending', type=int, default=1024,
+                        help="largest number of requests in flight")
+    parser.add_argument('--max-line', type=int, default=1 << 20, help="longest request line in bytes")
+    args = parser.parse_args()
+
+    async def run():
+        server = PlayfairServer(args.host, args.port, args.window, args.max_pending, maxLine=args.max_line)
+        await server.serveForever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+###############################################################
+
+# Below are the tests for PlayfairServer and PlayfairClient
+def test_PlayfairServer_batchesByKey():
+    # Tests that concurrent requests come back right and are batched
+    async def run():
+        server = PlayfairServer(window=0.01)
+        await server.start()
+        client = PlayfairClient(server.host, server.port)
+        await client.connect()
+        phrases = ["simple", "SIMPLE", "i am entering a pass phrase"]
+        messages = [f"message {i} with odd letters" * (i % 3 + 1) for i in range(40)]
+        results = await asyncio.gather(*(client.encrypt(phrases[i % 3], message)
+                                         for i, message in enumerate(messages)))
+        await client.close()
+        await server.stop()
+        return server, phrases, messages, results
+
+    server, phrases, messages, results = asyncio.run(run())
+    for i, message in enumerate(messages):
+        expected = PlayfairCipher(createTable(phrases[i % 3])).encryptMessage(message)
+        assert results[i] == expected, f"Wrong ciphertext for request {i}."
+    assert server.batches < len(messages), "Requests with the same key should be batched."
+    assert server.requests == len(messages), "Failed to count requests."
+    pass
+
+def test_PlayfairServer_decryptAndErrors():
+    # Tests decryption, a bad request next to good ones, and stats
+    async def run():
+        server = PlayfairServer(window=0.01)
+        await server.start()
+        client = PlayfairClient(server.host, server.port)
+        await client.connect()
+        good, bad = await asyncio.gather(client.decrypt("i am entering a pass phrase", "hjntntirnpginprnpm"),
+                                         client.decrypt("i am entering a pass phrase", "odd"),
+                                         return_exceptions=True)
+        unknown = await asyncio.gather(client.request('shuffle', 'key', 'text'), return_exceptions=True)
+        stats = await client.request('stats')
+        await client.close()
+        await server.stop()
+        return good, bad, unknown[0], stats
+
+    good, bad, unknown, stats = asyncio.run(run())
+    assert good == "thisisatestmessage", "Failed to decrypt."
+    assert isinstance(bad, ValueError), "Odd ciphertext should give an error."
+    assert isinstance(unknown, ValueError), "Unknown op should give an error."
+    assert stats['requests'] == 3 and stats['p99'] >= stats['p50'] > 0, "Failed on stats."
+    pass
+
+def test_PlayfairServer_badPayloads():
+    # Tests that bad keys and texts get an error reply instead of hanging
+    async def run():
+        server = PlayfairServer(window=0.001, maxPending=2)
+        await server.start()
+        client = PlayfairClient(server.host, server.port)
+        await client.connect()
+        replies = await asyncio.wait_for(asyncio.gather(
+            client.encrypt("café", "hello"), client.encrypt("simple", 123),
+            client.encrypt("simple", None), client.encrypt(["simple"], "hello"),
+            client.encrypt("simple", "hello"), return_exceptions=True), timeout=5)
+        await client.close()
+        await server.stop()
+        return replies
+
+    replies = asyncio.run(run())
+    for reply in replies[:4]:
+        assert isinstance(reply, ValueError), f"A bad request should get an error reply, not {reply!r}."
+    assert replies[4] == PlayfairCipher(createTable("simple")).encryptMessage("hello"), "Good request failed."
+    pass
+
+def test_PlayfairServer_longLines():
+    # Tests that lines past the limit get an error and give their slot back
+    async def run():
+        server = PlayfairServer(window=0.001, maxPending=2, maxLine=1024)
+        await server.start()
+        failures = []
+        for _ in range(4):
+            client = PlayfairClient(server.host, server.port)
+            await client.connect()
+            try:
+                await asyncio.wait_for(client.encrypt("simple", "a" * 5000), timeout=5)
+            except ConnectionError as error:
+                failures.append(error)
+            try:
+                await client.encrypt("simple", "hello")
+            except ConnectionError as error:
+                failures.append(error)
+            await client.close()
+        client = PlayfairClient(server.host, server.port)
+        await client.connect()
+        result = await asyncio.wait_for(client.encrypt("simple", "hello"), timeout=5)
+        await client.close()
+        await server.stop()
+        return failures, result
+
+    failures, result = asyncio.run(run())
+    assert len(failures) == 8, "Requests on a dropped connection should fail, not hang."
+    assert result == PlayfairCipher(createTable("simple")).encryptMessage("hello"), "The slots were not given back."
+    pass
+
+def test_PlayfairServer_backpressure():
+    # Tests that more requests than slots still all finish
+    async def run():
+        server = PlayfairServer(window=0.001, maxPending=2, maxBatch=2)
+        await server.start()
+        client = PlayfairClient(server.host, server.port)
+        await client.connect()
+        results = await asyncio.gather(*(client.encrypt("simple", "abc" * i) for i in range(20)))
+        await client.close()
+        await server.stop()
+        return results
+
+    cipher = PlayfairCipher(createTable("simple"))
+    assert asyncio.run(run()) == [cipher.encryptMessage("abc" * i) for i in range(20)], "Backpressure lost requests."
+    pass
+
+if __name__ == "__main__":
+    main()